@@ -6,6 +6,8 @@ Query for expired production AMI images and remove
 
 #  Imports are bundled local to the lambda function
 from ami_shared import *
+from ami_catalog import *
+from ami_prune import *
 
 
 def lambda_handler(event, context):
@@ -13,106 +15,34 @@ def lambda_handler(event, context):
     Find images to be pruned
     """
 
-    #  Determine Expiration Date for comparison
-    expiry_date = today - datetime.timedelta(days=RETENTION_DAYS)
-    variables_add(
-        var_title='Expiration date',
-        var_value=expiry_date.isoformat()
-    )
-
-    #  Loop thru tagged + stable EC2 images
-    images = ec2.describe_images(
-        Filters=[
-            {
-                'Name': 'tag-key',
-                'Values': ['instance_id']
-            },
-            {
-                'Name': 'state',
-                'Values': ['available']
-            },
-            {
-                'Key': 'CreatedBy',
-                'Value': 'ami-automation'
-            }
-        ],
-        Owners=['self']
-    )
-    for image in images['Images']:
-
-        #  Get image info
-        image_id = image["ImageId"]
-        image_date = dateutil.parser.parse(image["CreationDate"])
-
-        if 'Tags' in image:
-            instance_id = [
-                tag['Value']
-                for tag in image['Tags']
-                if tag['Key'] == 'instance_id'
-            ][0]
-            instance_name = [
-                tag['Value']
-                for tag in image['Tags']
-                if tag['Key'] == 'instance_name'
-            ][0]
-
-            #  check if expired
-            if image_date < expiry_date:
-
-                #  Deregister image/ami
-                try:
-                    ec2.deregister_image(
-                        ImageId=image_id
-                    )
-                    logger.info('Great Success! Deleting ami [%s] for instance [%s:%s] created on [%s]' %
-                                (image_id, instance_name, instance_id, image_date.isoformat()))
-
-                    #  Record deleted image
-                    image_status_add(
-                        instance_id=instance_id,
-                        instance_name=instance_name,
-                        image_id=image_id,
-                        image_name=image["Name"],
-                        create_dt=image_date,
-                        action='DELETE',
-                        is_success=True
-                    )
-
-                    # TODO: You can remove this block if snapshots should not to be deleted
-                    for bdm in image['BlockDeviceMappings']:
-                        if 'Ebs' in bdm:
-                            snapshot_id = bdm['Ebs']['SnapshotId']
-
-                            #  Delete snapshot
-                            try:
-                                ec2.delete_snapshot(
-                                    SnapshotId=snapshot_id
-                                )
-                                logger.info('Great Success! Deleting snapshot [%s] created by ami [%s]' %
-                                            (snapshot_id, image_id))
-                            except Exception as e:
-                                logger.error('ERR! Unable to delete snapshot [%s] created by ami [%s]' %
-                                             (snapshot_id, image_id))
-                                logger.exception(e)
-
-                except Exception as e:
-                    logger.error('ERR! Unable to delete ami [%s] for instance [%s:%s] created on [%s]' %
-                                 (image_id, instance_name, instance_id, image_date.isoformat()))
-                    logger.exception(e)
-
-                    #  Record failure
-                    image_status_add(
-                        instance_id=instance_id,
-                        instance_name=instance_name,
-                        image_id=image_id,
-                        image_name=image["Name"],
-                        create_dt=image_date,
-                        action='DELETE',
-                        is_success=False
-                    )
-
-    #  Report on actions
-    generate_report(__file__, 'Remove expired AMI backups')
+    run = RunContext(event, context)
+    try:
+        run.catalog = open_catalog()
+
+        #  Determine dates for comparison
+        expiry_date, candidate_date = prune_dates(run)
+
+        #
+        #  Two-stage pipeline:
+        #  - Deregister expired images concurrently
+        #  - Delete each image's snapshots on a second pool as soon as it is deregistered, unless other AMIs use them
+        #  All regions run at once and share the snapshot pool.
+        #
+        stats = StageStats()
+        snapshot_pool = ThreadPool(processes=run.setting('snapshot_workers', SNAPSHOT_WORKERS))
+        try:
+            run_regions(run, lambda run, region: prune_region(run, region, candidate_date, snapshot_pool, stats))
+        finally:
+            snapshot_pool.close()
+            snapshot_pool.join()
+        stats.report(run)
+
+        #  Report on actions, once the last invocation of the run is done
+        if not continue_run(run):
+            generate_report(run, __file__, 'Remove expired AMI backups')
+    finally:
+        #  API call counts + latencies for CloudWatch, failed runs included
+        emit_metrics(run, __file__)
 
     return
 
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""
+Take, prune and check AMI backups of tagged EC2 instances from a single listing per region
+(the create, prune and monitor functions in one run, with one report)
+"""
+
+#  Imports are bundled local to the lambda function
+from ami_shared import *
+from ami_catalog import *
+from ami_create import *
+from ami_prune import *
+from ami_monitor import *
+
+#  Stages run on each region's inventory, in order
+STAGES = ('create', 'prune', 'monitor')
+
+#  Stages a resumed invocation carries on from their own cursor, without listing the region again
+RESUME_UNLISTED = ('create', 'prune')
+
+
+def reconcile_region(run, region, shard, shards, candidate_date, recent_backup_date, expired_backup_date,
+                     snapshot_pool, stats):
+    """
+    List a region's instances + backups once, then create, prune and check backups from that listing
+
+    An invocation running out of time records the stage it stopped in. The
+    next invocation of the run carries on with that stage first, from where
+    the stage itself stopped, and only lists the region for the stages after it.
+    """
+    stages = {
+        'create': lambda inventory: backup_region(run, region, shard, shards, inventory),
+        'prune': lambda inventory: prune_region(run, region, candidate_date, snapshot_pool, stats, inventory),
+        'monitor': lambda inventory: check_region(run, region, recent_backup_date, expired_backup_date, inventory)
+    }
+    cursor = run.region_cursor(region)
+    first = STAGES.index(cursor.get('stage', STAGES[0]))
+    resumed = 'stage' in cursor
+
+    inventory = None
+    for stage in STAGES[first:]:
+        #  Every invocation gets the stage it starts with going, however late that is
+        if stage != STAGES[first] and run.out_of_time():
+            run.save_cursor(region, {'stage': stage})
+            return
+
+        unlisted = resumed and stage == STAGES[first] and stage in RESUME_UNLISTED
+        if inventory is None and not unlisted:
+            #  The orphan snapshot sweep (when due) works from the inventory's snapshot listing
+            inventory = RegionInventory(region, snapshots=run.part == 1 and sweep_due(run, region))
+
+            #  Backups earlier invocations of the run created (may still be pending) or deleted
+            inventory.apply(run)
+
+        stages[stage](inventory)
+
+        #  Stage stopped early, the next invocation picks it up where it left off
+        if region in run.cursors:
+            run.save_cursor(region, dict(run.cursors[region], stage=stage))
+            return
+
+        #  Later stages see what this one did
+        if inventory:
+            inventory.apply(run)
+    return
+
+
+def lambda_handler(event, context):
+    """
+    Find instances to image, images to be pruned and instances missing AMIs
+    """
+
+    run = RunContext(event, context)
+    try:
+        run.catalog = open_catalog()
+
+        #  Only image one shard of the fleet per run, spreading load over the backup window
+        shard, shards = run_shard(run)
+        if shards > 1:
+            run.variables_add(
+                var_title='Shard',
+                var_value='%d of %d' % (shard + 1, shards)
+            )
+
+        #  Determine dates for comparison
+        expiry_date, candidate_date = prune_dates(run)
+        recent_backup_date, expired_backup_date = monitor_dates(run)
+
+        #  All regions at once, sharing the snapshot pool prune deletes snapshots on
+        stats = StageStats()
+        snapshot_pool = ThreadPool(processes=run.setting('snapshot_workers', SNAPSHOT_WORKERS))
+        try:
+            run_regions(run, lambda run, region: reconcile_region(
+                run, region, shard, shards, candidate_date, recent_backup_date, expired_backup_date, snapshot_pool,
+                stats))
+        finally:
+            snapshot_pool.close()
+            snapshot_pool.join()
+        stats.report(run)
+
+        #  Report on actions, once the last invocation of the run is done
+        if not continue_run(run):
+            generate_report(
+                run=run,
+                script_file=__file__,
+                title='Reconcile AMI backups',
+                email_report=True,
+                complete_actions=('CHECK_MISSING', 'CHECK_EXPIRED', 'CHECK_RECENT'))
+    finally:
+        #  API call counts + latencies for CloudWatch, failed runs included
+        emit_metrics(run, __file__)
+
+    return
+
+
+#  This allows us to test locally
+if __name__ == "__main__":
+    logging.basicConfig()
+    lambda_handler('event', 'handler')
@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+
+"""
+ Persistent catalog of AMIs created by the lambda functions
+
+ Rows use the same fields as image_entry() on ami_shared.py:
+ region, image_id, image_name, image_create_dt, instance_id,
+ instance_name, snapshot_ids and state
+"""
+
+#  General libraries
+import datetime
+import json
+import threading
+import dateutil.tz
+
+#  Imports are bundled local to the lambda function
+from ami_shared import automation_backups, aws_client, backup_states, logger, parse_datetime, CATALOG_URI, CATALOG_RECONCILE_HOURS
+
+#  Image states that still hold a backup
+ACTIVE_STATES = ('pending', 'available')
+
+#  Columns stored for every row
+CATALOG_FIELDS = (
+    'region', 'image_id', 'image_name', 'image_create_dt',
+    'instance_id', 'instance_name', 'snapshot_ids', 'state'
+)
+
+#  Columns stored for every per-instance summary (see ami_monitor.py)
+SUMMARY_FIELDS = (
+    'instance_id', 'newest_id', 'newest_name', 'newest_dt', 'oldest_id', 'oldest_dt'
+)
+
+#  Open catalogs, reused by warm invocations
+catalogs = {}
+catalogs_lock = threading.Lock()
+
+
+def catalog_time(dt):
+    """
+    Format a datetime the way EC2 does, so stored values sort by time
+    """
+    dt = dt.astimezone(dateutil.tz.tzutc())
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (dt.microsecond // 1000)
+
+
+def summary_values(summary):
+    """
+    Flatten a summary into storable strings and numbers
+    """
+    values = dict(summary)
+    for field in ('newest_dt', 'oldest_dt'):
+        values[field] = catalog_time(summary[field]) if summary[field] else None
+    return values
+
+
+def summary_from_values(values):
+    """
+    Rebuild a summary from stored values
+    """
+    summary = dict((field, values.get(field)) for field in SUMMARY_FIELDS)
+    for field in ('newest_dt', 'oldest_dt'):
+        summary[field] = parse_datetime(summary[field]) if summary[field] else None
+    return summary
+
+
+class Catalog(object):
+    """
+    Interface shared by catalog backends
+    """
+
+    def put(self, row):
+        """
+        Add or replace a row
+        """
+        raise NotImplementedError
+
+    def get(self, image_id):
+        """
+        Get a row by image id, None if unknown
+        """
+        raise NotImplementedError
+
+    def update(self, image_id, **fields):
+        """
+        Change some fields of an existing row
+        """
+        row = self.get(image_id)
+        if row:
+            row.update(fields)
+            self.put(row)
+        return
+
+    def active(self, region):
+        """
+        Yield rows for a region still holding a backup
+        """
+        raise NotImplementedError
+
+    def expired(self, region, before):
+        """
+        Yield active rows for a region created before a date, oldest first
+        """
+        raise NotImplementedError
+
+    def recent(self, region, since):
+        """
+        Yield active rows for a region created on or after a date
+        """
+        raise NotImplementedError
+
+    def newest(self, region, instance_id):
+        """
+        Get the newest available row for an instance, None if there is none
+
+        Pending rows are skipped: an AMI that never completes is no backup.
+        """
+        raise NotImplementedError
+
+    def summaries(self, region):
+        """
+        Get all per-instance summaries for a region, keyed by instance id
+        """
+        raise NotImplementedError
+
+    def put_summaries(self, region, summaries):
+        """
+        Add or replace per-instance summaries for a region
+        """
+        raise NotImplementedError
+
+    def get_meta(self, key, default=None):
+        """
+        Get a bookkeeping value
+        """
+        raise NotImplementedError
+
+    def put_meta(self, key, value):
+        """
+        Set a bookkeeping value
+        """
+        raise NotImplementedError
+
+    def meta_items(self, group):
+        """
+        Get a group of bookkeeping values stored one item each, keyed by name
+        """
+        raise NotImplementedError
+
+    def put_meta_items(self, group, values):
+        """
+        Add or replace some values (by name) of a group
+        """
+        raise NotImplementedError
+
+    def delete_meta_items(self, group, names):
+        """
+        Remove some values (by name) of a group
+        """
+        raise NotImplementedError
+
+
+class SqliteCatalog(Catalog):
+    """
+    Catalog kept in a local SQLite file (for testing)
+    """
+
+    def __init__(self, path):
+        import sqlite3
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS images ('
+                'image_id TEXT PRIMARY KEY, region TEXT, image_name TEXT, image_create_dt TEXT, '
+                'instance_id TEXT, instance_name TEXT, snapshot_ids TEXT, state TEXT)'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS images_by_date ON images (region, state, image_create_dt)')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS images_by_instance ON images (region, instance_id, image_create_dt)'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS summaries (region TEXT, instance_id TEXT, newest_id TEXT, '
+                'newest_name TEXT, newest_dt TEXT, oldest_id TEXT, oldest_dt TEXT, '
+                'PRIMARY KEY (region, instance_id))'
+            )
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS meta_items (grp TEXT, name TEXT, value TEXT, PRIMARY KEY (grp, name))'
+            )
+
+    def _rows(self, where, params, order='image_create_dt', states=ACTIVE_STATES):
+        sql = 'SELECT %s FROM images WHERE %s AND state IN (%s) ORDER BY %s' % (
+            ', '.join(CATALOG_FIELDS), where, ', '.join('?' * len(states)), order)
+        with self.lock:
+            rows = self.conn.execute(sql, tuple(params) + tuple(states)).fetchall()
+        for values in rows:
+            row = dict(zip(CATALOG_FIELDS, values))
+            row['image_create_dt'] = parse_datetime(row['image_create_dt'])
+            row['snapshot_ids'] = json.loads(row['snapshot_ids'])
+            yield row
+
+    def put(self, row):
+        values = dict(row)
+        values['image_create_dt'] = catalog_time(row['image_create_dt'])
+        values['snapshot_ids'] = json.dumps(row['snapshot_ids'])
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO images (%s) VALUES (%s)' % (
+                    ', '.join(CATALOG_FIELDS), ', '.join('?' * len(CATALOG_FIELDS))),
+                tuple(values[field] for field in CATALOG_FIELDS)
+            )
+        return
+
+    def get(self, image_id):
+        with self.lock:
+            values = self.conn.execute(
+                'SELECT %s FROM images WHERE image_id = ?' % (', '.join(CATALOG_FIELDS)), (image_id,)
+            ).fetchone()
+        if not values:
+            return None
+        row = dict(zip(CATALOG_FIELDS, values))
+        row['image_create_dt'] = parse_datetime(row['image_create_dt'])
+        row['snapshot_ids'] = json.loads(row['snapshot_ids'])
+        return row
+
+    def active(self, region):
+        return self._rows('region = ?', [region])
+
+    def expired(self, region, before):
+        return self._rows('region = ? AND image_create_dt < ?', [region, catalog_time(before)])
+
+    def recent(self, region, since):
+        return self._rows('region = ? AND image_create_dt >= ?', [region, catalog_time(since)])
+
+    def newest(self, region, instance_id):
+        for row in self._rows('region = ? AND instance_id = ?', [region, instance_id], 'image_create_dt DESC',
+                              states=('available',)):
+            return row
+        return None
+
+    def summaries(self, region):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT %s FROM summaries WHERE region = ?' % (', '.join(SUMMARY_FIELDS)), (region,)
+            ).fetchall()
+        return dict((values[0], summary_from_values(dict(zip(SUMMARY_FIELDS, values)))) for values in rows)
+
+    def put_summaries(self, region, summaries):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO summaries (region, %s) VALUES (?, %s)' % (
+                    ', '.join(SUMMARY_FIELDS), ', '.join('?' * len(SUMMARY_FIELDS))),
+                [
+                    (region,) + tuple(summary_values(summary)[field] for field in SUMMARY_FIELDS)
+                    for summary in summaries
+                ]
+            )
+        return
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            values = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(values[0]) if values else default
+
+    def put_meta(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+        return
+
+    def meta_items(self, group):
+        with self.lock:
+            rows = self.conn.execute('SELECT name, value FROM meta_items WHERE grp = ?', (group,)).fetchall()
+        return dict((name, json.loads(value)) for name, value in rows)
+
+    def put_meta_items(self, group, values):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO meta_items (grp, name, value) VALUES (?, ?, ?)',
+                [(group, name, json.dumps(value)) for name, value in values.items()]
+            )
+        return
+
+    def delete_meta_items(self, group, names):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'DELETE FROM meta_items WHERE grp = ? AND name = ?', [(group, name) for name in names]
+            )
+        return
+
+
+class DynamoCatalog(Catalog):
+    """
+    Catalog kept in a DynamoDB table (for production)
+
+    Table: hash key "image_id" (S), plus sparse global secondary indexes:
+    - "active-region-index": hash "active_region" (S), range "image_create_dt" (S)
+    - "active-instance-index": hash "active_instance" (S), range "image_create_dt" (S)
+    - "summary-region-index": hash "summary_region" (S)
+    - "meta-group-index": hash "meta_group" (S)
+    The "active" indexes only hold rows still holding a backup, the
+    "summary" index only holds per-instance summaries and the "meta"
+    index only holds grouped bookkeeping values (alert state, ...).
+    """
+
+    def __init__(self, table):
+        from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+        self.table = table
+        self.client = aws_client('dynamodb')
+        self.serializer = TypeSerializer()
+        self.deserializer = TypeDeserializer()
+
+    def _item(self, row):
+        item = dict((field, row[field]) for field in CATALOG_FIELDS)
+        item['image_create_dt'] = catalog_time(row['image_create_dt'])
+        if row['state'] in ACTIVE_STATES:
+            item['active_region'] = row['region']
+            item['active_instance'] = '%s|%s' % (row['region'], row['instance_id'])
+        return dict((k, self.serializer.serialize(v)) for k, v in item.items() if v is not None)
+
+    def _row(self, item):
+        values = dict((k, self.deserializer.deserialize(v)) for k, v in item.items())
+        row = dict((field, values.get(field)) for field in CATALOG_FIELDS)
+        row['image_create_dt'] = parse_datetime(row['image_create_dt'])
+        row['snapshot_ids'] = list(row['snapshot_ids'] or [])
+        return row
+
+    def _query(self, index, key_name, key_value, condition='', values=None, forward=True, limit=None, state=None):
+        expression = '%s = :key' % (key_name)
+        attributes = {':key': {'S': key_value}}
+        if condition:
+            expression += ' AND ' + condition
+            attributes.update(dict((k, {'S': v}) for k, v in values.items()))
+        params = {
+            'TableName': self.table,
+            'IndexName': index,
+            'KeyConditionExpression': expression,
+            'ExpressionAttributeValues': attributes,
+            'ScanIndexForward': forward
+        }
+
+        #  Filters apply after each page is read, so keep paging until enough rows match
+        if state:
+            params['FilterExpression'] = '#state = :state'
+            params['ExpressionAttributeNames'] = {'#state': 'state'}
+            attributes[':state'] = {'S': state}
+        if limit:
+            params['Limit'] = limit
+        found = 0
+        for page in self.client.get_paginator('query').paginate(**params):
+            for item in page['Items']:
+                yield self._row(item)
+                found += 1
+                if found == limit:
+                    return
+
+    def _write(self, requests):
+        #  Write in batches of 25 (the DynamoDB limit), resending anything left unprocessed
+        while requests:
+            batch, requests = requests[:25], requests[25:]
+            result = self.client.batch_write_item(RequestItems={self.table: batch})
+            requests.extend(result.get('UnprocessedItems', {}).get(self.table, []))
+        return
+
+    def put(self, row):
+        self.client.put_item(TableName=self.table, Item=self._item(row))
+        return
+
+    def get(self, image_id):
+        item = self.client.get_item(TableName=self.table, Key={'image_id': {'S': image_id}}).get('Item')
+        return self._row(item) if item else None
+
+    def active(self, region):
+        return self._query('active-region-index', 'active_region', region)
+
+    def expired(self, region, before):
+        return self._query('active-region-index', 'active_region', region,
+                           'image_create_dt < :dt', {':dt': catalog_time(before)})
+
+    def recent(self, region, since):
+        return self._query('active-region-index', 'active_region', region,
+                           'image_create_dt >= :dt', {':dt': catalog_time(since)})
+
+    def newest(self, region, instance_id):
+        for row in self._query('active-instance-index', 'active_instance', '%s|%s' % (region, instance_id),
+                               forward=False, limit=1, state='available'):
+            return row
+        return None
+
+    def summaries(self, region):
+        summaries = {}
+        params = {
+            'TableName': self.table,
+            'IndexName': 'summary-region-index',
+            'KeyConditionExpression': 'summary_region = :region',
+            'ExpressionAttributeValues': {':region': {'S': region}}
+        }
+        for page in self.client.get_paginator('query').paginate(**params):
+            for item in page['Items']:
+                values = dict((k, self.deserializer.deserialize(v)) for k, v in item.items())
+                summaries[values['instance_id']] = summary_from_values(values)
+        return summaries
+
+    def put_summaries(self, region, summaries):
+        requests = []
+        for summary in summaries:
+            item = summary_values(summary)
+            item['image_id'] = 'summary#%s#%s' % (region, summary['instance_id'])
+            item['summary_region'] = region
+            requests.append({'PutRequest': {'Item': dict(
+                (k, self.serializer.serialize(v)) for k, v in item.items() if v is not None
+            )}})
+        self._write(requests)
+        return
+
+    def get_meta(self, key, default=None):
+        item = self.client.get_item(TableName=self.table, Key={'image_id': {'S': 'meta#%s' % (key)}}).get('Item')
+        return json.loads(item['value']['S']) if item else default
+
+    def put_meta(self, key, value):
+        self.client.put_item(
+            TableName=self.table,
+            Item={'image_id': {'S': 'meta#%s' % (key)}, 'value': {'S': json.dumps(value)}}
+        )
+        return
+
+    def meta_items(self, group):
+        values = {}
+        params = {
+            'TableName': self.table,
+            'IndexName': 'meta-group-index',
+            'KeyConditionExpression': 'meta_group = :group',
+            'ExpressionAttributeValues': {':group': {'S': group}}
+        }
+        for page in self.client.get_paginator('query').paginate(**params):
+            for item in page['Items']:
+                values[item['meta_name']['S']] = json.loads(item['value']['S'])
+        return values
+
+    def put_meta_items(self, group, values):
+        self._write([
+            {'PutRequest': {'Item': {
+                'image_id': {'S': 'meta#%s#%s' % (group, name)},
+                'meta_group': {'S': group},
+                'meta_name': {'S': name},
+                'value': {'S': json.dumps(value)}
+            }}}
+            for name, value in values.items()
+        ])
+        return
+
+    def delete_meta_items(self, group, names):
+        self._write([
+            {'DeleteRequest': {'Key': {'image_id': {'S': 'meta#%s#%s' % (group, name)}}}}
+            for name in names
+        ])
+        return
+
+
+def open_catalog(uri=None):
+    """
+    Open (or reuse) the catalog for a URI, None if no catalog is configured
+    """
+    uri = CATALOG_URI if uri is None else uri
+    if not uri:
+        return None
+    with catalogs_lock:
+        if uri not in catalogs:
+            scheme, _, location = uri.partition('://')
+            if scheme == 'sqlite':
+                catalogs[uri] = SqliteCatalog(location)
+            elif scheme == 'dynamodb':
+                catalogs[uri] = DynamoCatalog(location)
+            else:
+                raise ValueError('Unknown catalog backend [%s]' % (uri))
+        return catalogs[uri]
+
+
+def reconcile_due(run, catalog, region):
+    """
+    Check if a region's catalog is due to be reconciled against EC2 (at most once per run)
+    """
+    last = catalog.get_meta('reconciled:%s' % (region))
+    if last and parse_datetime(last) >= run.today:
+        return False
+    if run.setting('reconcile') or not last:
+        return True
+    return parse_datetime(last) < run.today - datetime.timedelta(hours=CATALOG_RECONCILE_HOURS)
+
+
+def promote_pending(catalog, region, rows):
+    """
+    Look up pending rows in EC2 (in bulk), store the ones no longer pending, and return them updated
+
+    Rows EC2 no longer lists stay pending, until the catalog is next reconciled.
+    """
+    pending = [row for row in rows if row['state'] == 'pending']
+    if not pending:
+        return []
+    states = backup_states(region, pending)
+    promoted = []
+    for row in pending:
+        state, snapshot_ids = states.get(row['image_id'], ('pending', row['snapshot_ids']))
+        if state != 'pending':
+            row = dict(row, state=state, snapshot_ids=snapshot_ids)
+            catalog.update(row['image_id'], state=state, snapshot_ids=snapshot_ids)
+            promoted.append(row)
+    return promoted
+
+
+def reconcile_catalog(run, catalog, region):
+    """
+    Sync a region's catalog rows with the automation AMIs (and snapshot sets) EC2 actually has
+    """
+    seen = set()
+    for entry in automation_backups(region, states=None):
+        if entry['instance_id']:
+            catalog.put(entry)
+            seen.add(entry['image_id'])
+
+    #  Rows EC2 no longer knows about were removed outside of the lambda functions
+    missing = [row['image_id'] for row in catalog.active(region) if row['image_id'] not in seen]
+    for image_id in missing:
+        catalog.update(image_id, state='deregistered')
+    catalog.put_meta('reconciled:%s' % (region), run.today.isoformat())
+
+    logger.info('Catalog for [%s] reconciled: %d image(s) found, %d gone' % (region, len(seen), len(missing)))
+    run.variables_add(
+        var_title='Catalog sync %s' % (region),
+        var_value='%d found, %d gone' % (len(seen), len(missing))
+    )
+    return
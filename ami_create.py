@@ -0,0 +1,549 @@
+# -*- coding: utf-8 -*-
+
+"""
+ Create stage: image tagged EC2 instances, used by the create and reconcile lambda functions
+"""
+
+#  Imports are bundled local to the lambda function
+from ami_shared import *
+from ami_catalog import *
+
+
+class PendingBackups(object):
+    """
+    AMIs (and snapshot sets) created in a region by this run, followed until they are available
+
+    Every poll looks all of them up in bulk (see backup_states) instead of one call per image.
+    With a catalog, the ones still pending are handed over to the next run (see follow_up_pending).
+    """
+
+    def __init__(self, region):
+        self.region = region
+        self.lock = threading.Lock()
+        self.images = {}
+
+    def add(self, instance_id, instance_name, image_id, image_name, started, snapshot_ids=None):
+        """
+        Start following a newly created AMI or snapshot set
+        """
+        with self.lock:
+            self.images[image_id] = {
+                "instance_id": instance_id,
+                "instance_name": instance_name,
+                "image_id": image_id,
+                "image_name": image_name,
+                "started": started,
+                "state": 'pending',
+                "duration": None,
+                "snapshot_ids": snapshot_ids or []
+            }
+        return
+
+    def poll(self):
+        """
+        Look up every AMI still pending, returning how many are left
+        """
+        states = backup_states(self.region, [image for image in self.images.values() if image['state'] == 'pending'])
+        seen = time.time()
+        for image_id, (state, snapshot_ids) in states.items():
+            image = self.images[image_id]
+            if state != 'pending':
+                image['state'] = state
+                image['duration'] = seen - image['started']
+                image['snapshot_ids'] = snapshot_ids
+        return len([image for image in self.images.values() if image['state'] == 'pending'])
+
+    def wait(self, run):
+        """
+        Poll until every AMI is done, the wait is over or lambda is about to time out
+        """
+        deadline = time.time() + 60 * run.setting('wait_minutes', CREATE_WAIT_MINUTES)
+        if hasattr(run.context, 'get_remaining_time_in_millis'):
+            #  Leave time to report back
+            deadline = min(deadline, time.time() + run.context.get_remaining_time_in_millis() / 1000.0 - 30)
+        poll_seconds = run.setting('poll_seconds', CREATE_POLL_SECONDS)
+
+        while self.images and self.poll() and time.time() + poll_seconds < deadline:
+            time.sleep(poll_seconds)
+        return
+
+    def report(self, run):
+        """
+        Record each AMI's real outcome, plus how long backups took
+        """
+        durations = []
+        handed_over = {}
+        for image in self.images.values():
+            if image['state'] == 'available':
+                durations.append((image['duration'], image['instance_name']))
+            if image['state'] == 'pending' and run.catalog:
+                #  Requested fine, the next run looks up how it ended
+                action, is_success = 'CREATE', True
+                handed_over[image['image_id']] = {
+                    "instance_id": image['instance_id'],
+                    "instance_name": image['instance_name'],
+                    "image_name": image['image_name'],
+                    "create_dt": run.today.isoformat(),
+                    "snapshot_ids": image['snapshot_ids']
+                }
+            elif image['state'] == 'pending':
+                action, is_success = 'CREATE_PENDING', False
+                logger.warning('Backup [%s:%s] for instance [%s:%s] is still pending' %
+                               (image['image_name'], image['image_id'], image['instance_name'], image['instance_id']))
+            else:
+                action, is_success = 'CREATE', image['state'] == 'available'
+                if not is_success:
+                    logger.error('ERR! Backup [%s:%s] for instance [%s:%s] ended up [%s]' %
+                                 (image['image_name'], image['image_id'], image['instance_name'],
+                                  image['instance_id'], image['state']))
+
+            run.image_status_add(
+                instance_id=image['instance_id'],
+                instance_name=image['instance_name'],
+                image_id=image['image_id'],
+                image_name=image['image_name'],
+                create_dt=run.today,
+                action=action,
+                is_success=is_success,
+                region=self.region,
+                duration=image['duration'] if is_success else None
+            )
+
+            #  Catalog learns the final state and snapshot ids
+            if run.catalog and image['state'] != 'pending':
+                run.catalog.update(image['image_id'], state=image['state'], snapshot_ids=image['snapshot_ids'])
+        if handed_over:
+            run.catalog.put_meta_items('pending:%s' % (self.region), handed_over)
+
+        if durations:
+            durations.sort()
+            values = [duration for duration, _ in durations]
+            run.variables_add(
+                var_title='Backup time %s' % (self.region),
+                var_value='p50 %s, p90 %s, p99 %s, max %s (%d backups)' % (
+                    format_duration(percentile(values, 0.50)), format_duration(percentile(values, 0.90)),
+                    format_duration(percentile(values, 0.99)), format_duration(values[-1]), len(values))
+            )
+            run.variables_add(
+                var_title='Slowest backups %s' % (self.region),
+                var_value=', '.join('%s (%s)' % (name, format_duration(duration))
+                                    for duration, name in reversed(durations[-5:]))
+            )
+        return
+
+
+def follow_up_pending(run, region):
+    """
+    Look up how the backups earlier runs left pending ended (see PendingBackups.report), all in one go
+
+    Backups that failed (or are gone) are reported, and so are the ones
+    still pending CREATE_PENDING_HOURS after they were requested. The
+    catalog learns the state of every backup no longer pending.
+    """
+    group = 'pending:%s' % (region)
+    images = run.catalog.meta_items(group)
+    if not images:
+        return
+    states = backup_states(region, [dict(image, image_id=image_id) for image_id, image in images.items()])
+
+    settled = []
+    for image_id, image in images.items():
+        #  Images EC2 no longer lists were deregistered (failed AMIs are cleaned up by EC2)
+        state, snapshot_ids = states.get(image_id, ('deregistered', image['snapshot_ids']))
+        create_dt = parse_datetime(image['create_dt'])
+        if state == 'pending':
+            if create_dt > run.today - datetime.timedelta(hours=CREATE_PENDING_HOURS):
+                continue
+            action = 'CREATE_PENDING'
+            logger.warning('Backup [%s:%s] for instance [%s:%s] is still pending' %
+                           (image['image_name'], image_id, image['instance_name'], image['instance_id']))
+        else:
+            settled.append(image_id)
+            run.catalog.update(image_id, state=state, snapshot_ids=snapshot_ids)
+            if state == 'available':
+                continue
+            action = 'CREATE'
+            logger.error('ERR! Backup [%s:%s] for instance [%s:%s] ended up [%s]' %
+                         (image['image_name'], image_id, image['instance_name'], image['instance_id'], state))
+
+        run.image_status_add(
+            instance_id=image['instance_id'],
+            instance_name=image['instance_name'],
+            image_id=image_id,
+            image_name=image['image_name'],
+            create_dt=create_dt,
+            action=action,
+            is_success=False,
+            region=region
+        )
+
+    run.catalog.delete_meta_items(group, settled)
+    run.variables_add(
+        var_title='Followed up %s' % (region),
+        var_value='%d backup(s) settled, %d still pending' % (len(settled), len(images) - len(settled))
+    )
+    return
+
+
+def create_snapshot_set(ec2, instance, set_id, tags):
+    """
+    Take a crash-consistent snapshot of the instance's EBS volumes (all at the same point in time)
+
+    Returns the new snapshot ids, the "data" backup mode leaves out the boot volume.
+    """
+    response = ec2.create_snapshots(
+        InstanceSpecification={
+            'InstanceId': instance["instance_id"],
+            'ExcludeBootVolume': instance["backup_mode"] == 'data'
+        },
+        Description='Automated backup for [%s]' % (instance["instance_hostname"]),
+        TagSpecifications=[{
+            'ResourceType': 'snapshot',
+            'Tags': tags + [{'Key': 'backup_set', 'Value': set_id}]
+        }]
+    )
+    return [snapshot['SnapshotId'] for snapshot in response.get('Snapshots', [])]
+
+
+def create_backup(run, region, instance, pending=None):
+    """
+    Create and tag an AMI (or snapshot set) for a single instance,
+    following it in pending (if any) until it is available
+    """
+    ec2 = aws_client('ec2', region)
+
+    #  Timestamp with today's date in UTC
+    now = run.today.strftime("%Y-%m-%dT%H-%M-%S")
+
+    instance_id = instance["instance_id"]
+    instance_name = instance["instance_hostname"]
+
+    #  Tags for the new AMI and its snapshots (prune only deletes what is tagged as ours)
+    tags = [
+        {
+            'Key': 'Name',
+            'Value': instance["instance_fullname"]
+        },
+        {
+            'Key': 'instance_id',
+            'Value': instance_id
+        },
+        {
+            'Key': 'instance_name',
+            'Value': instance_name
+        },
+        {
+            'Key': 'instance_type',
+            'Value': instance["instance_type"]
+        },
+        {
+            'Key': 'instance_keyname',
+            'Value': instance["instance_keyname"]
+        },
+        {
+            'Key': 'instance_state',
+            'Value': instance["instance_state"]
+        },
+        {
+            'Key': 'instance_avail_zone',
+            'Value': instance["instance_avail_zone"]
+        },
+        {
+            'Key': 'instance_sec_groups',
+            'Value': ','.join(instance["instance_sec_groups"])
+        },
+        {
+            'Key': 'instance_fingerprint',
+            'Value': instance_fingerprint(instance)
+        },
+        {
+            'Key': 'CreatedBy',
+            'Value': 'ami-automation'
+        }
+    ]
+
+    #  Create + tag AMI, or snapshot set (named like the AMI would be)
+    ami_name = '%s_%s' % (instance_name, now)
+    image_ami = None
+    snapshot_ids = []
+    kind = 'AMI' if instance["backup_mode"] == 'image' else 'snapshot set'
+    started = time.time()
+    try:
+        if kind == 'snapshot set':
+            set_id = '%s%s-%s' % (SNAPSHOT_SET_PREFIX, instance_id, now)
+            snapshot_ids = create_snapshot_set(
+                ec2, instance, set_id, tags + [{'Key': 'backup_name', 'Value': ami_name}])
+            image_ami = {"ImageId": set_id} if snapshot_ids else None
+        else:
+            image_ami = ec2.create_image(
+                InstanceId=instance_id,
+                Name=ami_name,
+                Description='Automated backup for [%s]' % (instance_name),
+                NoReboot=True,
+                TagSpecifications=[
+                    {
+                        'ResourceType': 'image',
+                        'Tags': tags
+                    },
+                    {
+                        'ResourceType': 'snapshot',
+                        'Tags': tags
+                    }
+                ]
+            )
+        if image_ami:
+            logger.info('Great Success! %s [%s:%s] created for instance [%s:%s]' %
+                        (kind, ami_name, image_ami["ImageId"], instance_name, instance_id))
+
+            #  Record new image creation, once it is available when following it
+            if pending is not None:
+                pending.add(instance_id, instance_name, image_ami["ImageId"], ami_name, started, snapshot_ids)
+            else:
+                run.image_status_add(
+                    instance_id=instance_id,
+                    instance_name=instance_name,
+                    image_id=image_ami["ImageId"],
+                    image_name=ami_name,
+                    create_dt=run.today,
+                    action='CREATE',
+                    is_success=True,
+                    region=region
+                )
+
+            #  Add new AMI to catalog (an AMI's snapshot ids are filled in once it is available)
+            if run.catalog:
+                run.catalog.put({
+                    "region": region,
+                    "image_id": image_ami["ImageId"],
+                    "image_name": ami_name,
+                    "image_create_dt": run.today,
+                    "instance_id": instance_id,
+                    "instance_name": instance_name,
+                    "snapshot_ids": snapshot_ids,
+                    "state": 'pending'
+                })
+        else:
+            logger.error('ERR! Unable to create %s [%s] for instance [%s:%s]' %
+                         (kind, ami_name, instance_name, instance_id))
+
+            #  Record image create failure
+            run.image_status_add(
+                instance_id=instance_id,
+                instance_name=instance_name,
+                image_id=None,
+                image_name=ami_name,
+                create_dt=run.today,
+                action='CREATE',
+                is_success=False,
+                region=region
+            )
+
+    except Exception as e:
+        logger.error('ERR! Unable to create %s [%s] for instance [%s:%s]' %
+                     (kind, ami_name, instance_name, instance_id))
+        logger.exception(e)
+
+        #  Record image create failure (catalog errors leave the AMI recorded as created)
+        if not image_ami:
+            run.image_status_add(
+                instance_id=instance_id,
+                instance_name=instance_name,
+                image_id=None,
+                image_name=ami_name,
+                create_dt=run.today,
+                action='CREATE',
+                is_success=False,
+                region=region
+            )
+
+    return
+
+
+def newest_backups(region, instance_ids):
+    """
+    Find the newest available backup (AMI or snapshot set) of some instances, by instance id
+
+    Looked up in bulk, 200 instances per call.
+    """
+    if not instance_ids:
+        return {}
+
+    ec2 = aws_client('ec2', region)
+    wanted = set(instance_ids)
+    newest = {}
+
+    def consider(instance_id, image_id, image_name, create_dt, fingerprint):
+        if instance_id in wanted and (instance_id not in newest or create_dt > newest[instance_id]['create_dt']):
+            newest[instance_id] = {
+                "image_id": image_id,
+                "image_name": image_name,
+                "create_dt": create_dt,
+                "fingerprint": fingerprint
+            }
+
+    instance_ids = sorted(wanted)
+    for i in range(0, len(instance_ids), 200):
+        by_instance = [
+            {
+                'Name': 'tag:instance_id',
+                'Values': instance_ids[i:i + 200]
+            },
+            {
+                'Name': 'tag:CreatedBy',
+                'Values': ['ami-automation']
+            }
+        ]
+
+        #  AMIs
+        pages = ec2.get_paginator('describe_images').paginate(
+            Filters=by_instance + [{'Name': 'state', 'Values': ['available']}],
+            Owners=['self']
+        )
+        for page in pages:
+            for image in page['Images']:
+                entry = image_entry(region, image)
+                consider(entry['instance_id'], entry['image_id'], entry['image_name'], entry['image_create_dt'],
+                         tag_value(image.get('Tags'), 'instance_fingerprint'))
+
+        #  Snapshot sets, only once every snapshot in the set is done
+        sets = {}
+        pages = ec2.get_paginator('describe_snapshots').paginate(
+            Filters=by_instance + [{'Name': 'tag-key', 'Values': ['backup_set']}],
+            OwnerIds=['self']
+        )
+        for page in pages:
+            for snapshot in page['Snapshots']:
+                set_id = tag_value(snapshot.get('Tags'), 'backup_set')
+                backup = sets.setdefault(set_id, [snapshot, []])
+                backup[0] = min(backup[0], snapshot, key=lambda k: k['StartTime'])
+                backup[1].append(snapshot['State'])
+        for set_id, (snapshot, states) in sets.items():
+            if snapshot_set_state(states) == 'available':
+                consider(tag_value(snapshot['Tags'], 'instance_id'), set_id,
+                         tag_value(snapshot['Tags'], 'backup_name', set_id), snapshot['StartTime'],
+                         tag_value(snapshot['Tags'], 'instance_fingerprint'))
+
+    return newest
+
+
+def needs_lookup(instance, skip_unchanged):
+    """
+    Check if an instance could be skipped, depending on its newest backup
+    """
+    if instance["backup_policy"].backup_hours > BACKUP_HOURS:
+        return True
+    return skip_unchanged and instance["instance_state"] == 'stopped'
+
+
+def skip_reason(run, instance, backup, skip_unchanged):
+    """
+    Why an instance needs no backup this run, given its newest backup (None if it does)
+
+    - not due: its policy backs it up less often than the schedule runs, and
+      the next backup is more than half a schedule interval away
+    - unchanged: stopped, with the same stop, volumes and backup mode as
+      when the newest backup was taken (see instance_fingerprint), as long
+      as that backup is not due a refresh
+    """
+    policy = instance["backup_policy"]
+    age = run.today - backup["create_dt"]
+    if policy.backup_hours > BACKUP_HOURS and age < datetime.timedelta(hours=policy.backup_hours - BACKUP_HOURS / 2.0):
+        return 'not due'
+    refresh_hours = min(CREATE_SKIP_REFRESH_HOURS, policy.horizon_days() * 24 / 2.0)
+    if skip_unchanged and instance["instance_state"] == 'stopped' and \
+            backup["fingerprint"] == instance_fingerprint(instance) and age < datetime.timedelta(hours=refresh_hours):
+        return 'unchanged'
+    return None
+
+
+def skip_backup(run, region, instance, backup, reason):
+    """
+    Record an instance left out because its newest backup is still current
+    """
+    logger.info('Great Success! Skipping instance [%s:%s] (%s), newest backup [%s:%s]' %
+                (instance["instance_hostname"], instance["instance_id"], reason, backup["image_id"],
+                 backup["create_dt"].isoformat()))
+    run.image_status_add(
+        instance_id=instance["instance_id"],
+        instance_name=instance["instance_hostname"],
+        image_id=backup["image_id"],
+        image_name=backup["image_name"],
+        create_dt=backup["create_dt"],
+        action='SKIP',
+        is_success=True,
+        region=region
+    )
+    return
+
+
+def backup_region(run, region, shard, shards, inventory=None):
+    """
+    Image tagged EC2 instances in a region (in this run's shard), several at a time, then follow up the AMIs
+
+    inventory: instances + backups already listed (see RegionInventory), instead of listing them here
+    """
+    wait_minutes = run.setting('wait_minutes', CREATE_WAIT_MINUTES)
+    pending = PendingBackups(region) if wait_minutes or run.catalog else None
+
+    #  Carry on from the page (and instance in it) an earlier invocation of the run stopped at, past
+    #  any instance an invocation working from an inventory took on (in one id order, across every page)
+    cursor = run.region_cursor(region)
+    after = cursor.get('after')
+    upto = cursor.get('upto')
+
+    #  Settle what the last run left pending, before this one starts on the region
+    if run.catalog and not cursor:
+        follow_up_pending(run, region)
+
+    skip_unchanged = run.setting('skip_unchanged', CREATE_SKIP_UNCHANGED)
+
+    if inventory:
+        pages = [(None, inventory.instances)]
+        find_newest = inventory.newest_backups
+    else:
+        pages = instance_pages(region, cursor.get('token'))
+        find_newest = lambda instance_ids: newest_backups(region, instance_ids)
+
+    for token, instances in pages:
+        taken = []
+        #  In instance id order, so where an invocation stopped is just the last instance it took on
+        instances = sorted([
+            instance for instance in instances
+            if (not after or instance['instance_id'] > after) and (not upto or instance['instance_id'] > upto) and
+            (shards == 1 or instance_shard(instance['instance_id'], shards) == shard)
+        ], key=lambda instance: instance['instance_id'])
+
+        #  Leave out instances not due yet under their policy, or stopped and unchanged since their last backup
+        newest = find_newest([
+            instance['instance_id'] for instance in instances if needs_lookup(instance, skip_unchanged)
+        ])
+        skipped = set()
+        for instance in instances:
+            backup = newest.get(instance['instance_id'])
+            reason = skip_reason(run, instance, backup, skip_unchanged) if backup else None
+            if reason:
+                skip_backup(run, region, instance, backup, reason)
+                skipped.add(instance['instance_id'])
+        instances = [instance for instance in instances if instance['instance_id'] not in skipped]
+
+        def backup(instance):
+            taken.append(instance['instance_id'])
+            create_backup(run, region, instance, pending)
+
+        finished = run_parallel(
+            func=backup,
+            items=instances,
+            workers=run.setting('workers', CREATE_WORKERS),
+            stop=run.out_of_time
+        )
+        if not finished:
+            last = instances[len(taken) - 1]['instance_id']
+            run.save_cursor(region, {'upto': last} if inventory else {'token': token, 'after': last, 'upto': upto})
+            break
+        after = None
+
+    if pending:
+        if wait_minutes:
+            pending.wait(run)
+        pending.report(run)
+    return
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+
+"""
+ Monitor stage: check AMI backups are recent + pruned, used by the monitor and reconcile lambda functions
+"""
+
+#  Imports are bundled local to the lambda function
+from ami_shared import *
+from ami_catalog import *
+
+
+def check_instance(run, region, instance, newest_ami, expired_amis, recent_backup_date):
+    """
+    Check one instance's newest AMI and its expired AMIs (oldest first)
+    """
+
+    instance_id = instance["instance_id"]
+    instance_name = instance["instance_name"]
+
+    if newest_ami:
+        #
+        #  Found AMI backups for this instance:
+        #  - Check newest AMI for missing backups
+        #  - Check oldest AMIs for expired backups missing pruning
+        #
+
+        #
+        #  Find most recent AMI and figure out if it's recent
+        #  (create skips stopped instances that haven't changed, for up to CREATE_SKIP_REFRESH_HOURS)
+        #
+        image_create_dt = newest_ami['image_create_dt']
+        if CREATE_SKIP_UNCHANGED and instance["instance_state"] == 'stopped':
+            recent_backup_date -= datetime.timedelta(hours=CREATE_SKIP_REFRESH_HOURS)
+        if image_create_dt < recent_backup_date:
+            run.image_status_add(
+                instance_id=instance_id,
+                instance_name=instance_name,
+                image_id=newest_ami['image_id'],
+                image_name=newest_ami['image_name'],
+                create_dt=image_create_dt,
+                action='CHECK_RECENT',
+                is_success=False,
+                region=region
+            )
+            logger.error('ERR! Last backup for server=%s, instance_id=%s taken on [%s]', instance_name,
+                         instance_id, image_create_dt)
+
+        #
+        #  Find expired AMIs NOT being removed
+        #  i.e., AMI creation date is older than computed expiration date
+        #        (expiration date = now - retention grace period)
+        #
+        for expired_list in expired_amis:
+            run.image_status_add(
+                instance_id=instance_id,
+                instance_name=instance_name,
+                image_id=expired_list['image_id'],
+                image_name=expired_list['image_name'],
+                create_dt=expired_list['image_create_dt'],
+                action='CHECK_EXPIRED',
+                is_success=False,
+                region=region
+            )
+            logger.error('ERR! Expired backup for server=%s, instance_id=%s taken on [%s]',
+                         instance_name,
+                         instance_id,
+                         expired_list['image_create_dt'])
+    else:
+        #  No AMIs found!
+        run.image_status_add(
+            instance_id=instance_id,
+            instance_name=instance_name,
+            image_id=None,
+            image_name=None,
+            create_dt=None,
+            action='CHECK_MISSING',
+            is_success=False,
+            region=region
+        )
+        logger.error('ERR! No AMIs found for server=%s, instance_id=%s', instance_name, instance_id)
+
+    return
+
+
+def check_region(run, region, recent_backup_date, expired_backup_date, inventory=None):
+    """
+    Check AMIs for tagged instances in a region, using one bulk EC2 query
+
+    inventory: instances + backups already listed (see RegionInventory), instead of listing them here
+    """
+
+    #  Find completed AMIs for all instances in one bulk query
+    ami_index = inventory.backups if inventory else image_index(region)
+
+    #  Find EC2 instances with backup tag
+    for instance in inventory.instances if inventory else iter_instances(region):
+        policy = instance["backup_policy"]
+
+        #  Completed AMIs for this instance (newest first)
+        instance_ami_list = ami_index.get(instance["instance_id"], [])
+
+        #  Expired AMIs are at the end of the list, walk back until the first unexpired one
+        expired_amis = []
+        instance_expired_date = policy.expired_date(run.today)
+        for ami in reversed(instance_ami_list):
+            if ami['image_create_dt'] >= instance_expired_date:
+                break
+            expired_amis.append(ami)
+
+        check_instance(
+            run=run,
+            region=region,
+            instance=instance,
+            newest_ami=instance_ami_list[0] if instance_ami_list else None,
+            expired_amis=expired_amis,
+            recent_backup_date=policy.recent_date(run.today)
+        )
+
+    return
+
+
+def check_region_catalog(run, region, recent_backup_date, expired_backup_date):
+    """
+    Check AMIs for tagged instances in a region, using catalog queries
+    """
+
+    #  Keep catalog honest
+    if reconcile_due(run, run.catalog, region):
+        reconcile_catalog(run, run.catalog, region)
+
+    #  EC2 instances with backup tag, and the widest dates their policies need
+    instances = list(iter_instances(region))
+    recent_backup_date = min(
+        [recent_backup_date] + [instance["backup_policy"].recent_date(run.today) for instance in instances])
+    expired_backup_date = max(
+        [expired_backup_date] + [instance["backup_policy"].expired_date(run.today) for instance in instances])
+
+    #  Newest recent AMI per instance, and expired AMIs per instance (oldest first)
+    recent_amis = {}
+    recent_pending = []
+    for row in run.catalog.recent(region, recent_backup_date):
+        if row['state'] == 'available':
+            recent_amis[row['instance_id']] = row
+        elif row['state'] == 'pending':
+            recent_pending.append(row)
+
+    #  AMIs still pending in the catalog may have completed since (create runs don't always wait for them)
+    for row in promote_pending(
+            run.catalog, region, [row for row in recent_pending if row['instance_id'] not in recent_amis]):
+        newest_ami = recent_amis.get(row['instance_id'])
+        if row['state'] == 'available' and (not newest_ami or row['image_create_dt'] > newest_ami['image_create_dt']):
+            recent_amis[row['instance_id']] = row
+    expired_amis = {}
+    for row in run.catalog.expired(region, expired_backup_date):
+        if row['state'] == 'available':
+            expired_amis.setdefault(row['instance_id'], []).append(row)
+
+    for instance in instances:
+        instance_id = instance["instance_id"]
+        policy = instance["backup_policy"]
+        instance_expired_date = policy.expired_date(run.today)
+
+        #  Only instances without a recent AMI need to look up their newest (available) one
+        newest_ami = recent_amis.get(instance_id)
+        if not newest_ami:
+            newest_ami = run.catalog.newest(region, instance_id)
+
+        check_instance(
+            run=run,
+            region=region,
+            instance=instance,
+            newest_ami=newest_ami,
+            expired_amis=[
+                row for row in expired_amis.get(instance_id, []) if row['image_create_dt'] < instance_expired_date
+            ],
+            recent_backup_date=policy.recent_date(run.today)
+        )
+
+    return
+
+
+def summary_add(summaries, entry):
+    """
+    Fold one AMI into its instance's summary (newest AMI, oldest AMI), returning True if that changed it
+
+    Folding in the same AMI again changes nothing.
+    """
+    changed = entry['instance_id'] not in summaries
+    summary = summaries.setdefault(entry['instance_id'], {
+        "instance_id": entry['instance_id'],
+        "newest_id": None,
+        "newest_name": None,
+        "newest_dt": None,
+        "oldest_id": None,
+        "oldest_dt": None
+    })
+    if not summary['newest_dt'] or entry['image_create_dt'] > summary['newest_dt']:
+        summary['newest_id'] = entry['image_id']
+        summary['newest_name'] = entry['image_name']
+        summary['newest_dt'] = entry['image_create_dt']
+        changed = True
+    if not summary['oldest_dt'] or entry['image_create_dt'] < summary['oldest_dt']:
+        summary['oldest_id'] = entry['image_id']
+        summary['oldest_dt'] = entry['image_create_dt']
+        changed = True
+    return changed
+
+
+def refresh_summaries(run, region):
+    """
+    Bring a region's per-instance summaries up to date, fetching only AMIs newer than the watermark
+
+    The watermark kept on the catalog is the creation time up to which every
+    AMI has been folded in. It is held back behind any AMI still pending, so
+    the AMIs after it are fetched (and folded in, to no effect) again.
+    """
+    state = run.catalog.get_meta('monitor:%s' % (region))
+    rescan_date = run.today - datetime.timedelta(hours=MONITOR_RESCAN_HOURS)
+
+    if not state or parse_datetime(state['rescanned']) < rescan_date:
+        #  Bootstrap (or periodic rescan): fold in every AMI
+        summaries = {}
+        images = automation_backups(region, states=('available', 'pending'))
+        state = {'rescanned': run.today.isoformat(), 'watermark': None}
+        watermark = None
+    else:
+        #  Only AMIs from the watermark's day onwards
+        summaries = run.catalog.summaries(region)
+        watermark = parse_datetime(state['watermark'])
+        images = automation_backups(
+            region,
+            states=('available', 'pending'),
+            creation_dates=date_prefixes(watermark.date(), run.today.date())
+        )
+
+    newest_dt = watermark
+    pending_dt = None
+    changed = {}
+    folded = 0
+    for entry in images:
+        if not entry['instance_id'] or (watermark and entry['image_create_dt'] <= watermark):
+            continue
+        if entry['state'] == 'pending':
+            pending_dt = min(pending_dt or entry['image_create_dt'], entry['image_create_dt'])
+            continue
+        newest_dt = max(newest_dt or entry['image_create_dt'], entry['image_create_dt'])
+        if summary_add(summaries, entry):
+            changed[entry['instance_id']] = summaries[entry['instance_id']]
+            folded += 1
+
+    #  Move watermark forward, but not past any AMI still pending
+    if pending_dt and (not newest_dt or pending_dt <= newest_dt):
+        newest_dt = pending_dt - datetime.timedelta(milliseconds=1)
+    state['watermark'] = (newest_dt or run.today).isoformat()
+
+    run.catalog.put_summaries(region, changed.values())
+    run.catalog.put_meta('monitor:%s' % (region), state)
+    run.variables_add(
+        var_title='Watermark %s' % (region),
+        var_value='%s (%d new AMIs)' % (state['watermark'], folded)
+    )
+    return summaries
+
+
+def check_region_incremental(run, region, recent_backup_date, expired_backup_date):
+    """
+    Check AMIs for tagged instances in a region, from per-instance summaries
+    """
+    summaries = refresh_summaries(run, region)
+
+    #  EC2 instances with backup tag, and when their AMIs expire (instances without a policy use the run's date)
+    instances = list(iter_instances(region))
+    expired_dates = dict(
+        (instance["instance_id"], instance["backup_policy"].expired_date(run.today)) for instance in instances
+    )
+
+    #
+    #  Summaries can't see AMIs pruned since, so an old "oldest" AMI only makes an
+    #  instance a suspect. Fetch just the AMIs that really are expired, in bulk,
+    #  and bring the suspects' "oldest" up to the expiration date if none are left.
+    #
+    expired_amis = {}
+    suspects = [
+        summary
+        for summary in summaries.values()
+        if summary['oldest_dt']
+        and summary['oldest_dt'] < expired_dates.get(summary['instance_id'], expired_backup_date)
+    ]
+    if suspects:
+        first_day = min(summary['oldest_dt'] for summary in suspects).date()
+        last_day = max(expired_dates.get(summary['instance_id'], expired_backup_date) for summary in suspects).date()
+        images = automation_backups(
+            region,
+            creation_dates=date_prefixes(first_day, last_day)
+        )
+        for entry in images:
+            if entry['instance_id'] and \
+                    entry['image_create_dt'] < expired_dates.get(entry['instance_id'], expired_backup_date):
+                expired_amis.setdefault(entry['instance_id'], []).append(entry)
+        for summary in suspects:
+            amis = sorted(expired_amis.get(summary['instance_id'], []), key=lambda k: k['image_create_dt'])
+            expired_amis[summary['instance_id']] = amis
+            summary['oldest_id'] = amis[0]['image_id'] if amis else None
+            summary['oldest_dt'] = amis[0]['image_create_dt'] if amis else \
+                expired_dates.get(summary['instance_id'], expired_backup_date)
+        run.catalog.put_summaries(region, suspects)
+
+    for instance in instances:
+        summary = summaries.get(instance["instance_id"])
+        newest_ami = None
+        if summary and summary['newest_id']:
+            newest_ami = {
+                "image_id": summary['newest_id'],
+                "image_name": summary['newest_name'],
+                "image_create_dt": summary['newest_dt']
+            }
+
+        check_instance(
+            run=run,
+            region=region,
+            instance=instance,
+            newest_ami=newest_ami,
+            expired_amis=expired_amis.get(instance["instance_id"], []),
+            recent_backup_date=instance["backup_policy"].recent_date(run.today)
+        )
+
+    return
+
+
+def monitor_dates(run):
+    """
+    Date range limits (earliest & latest) monitor checks backups against, added to the run's report
+
+    Instances with their own backup policy are checked against their own dates.
+    """
+    recent_backup_date = run.today - datetime.timedelta(hours=BACKUP_HOURS_GRACE)
+    expired_backup_date = run.today - datetime.timedelta(
+        days=retention_horizon_days() + RETENTION_DAYS_GRACE - RETENTION_DAYS)
+    run.variables_add(
+        var_title='Latest backup date',
+        var_value=recent_backup_date.isoformat()
+    )
+    run.variables_add(
+        var_title='Oldest backup date',
+        var_value=expired_backup_date.isoformat()
+    )
+    return recent_backup_date, expired_backup_date
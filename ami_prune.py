@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+
+"""
+ Prune stage: remove expired AMI backups, used by the prune and reconcile lambda functions
+"""
+
+#  Imports are bundled local to the lambda function
+from ami_shared import *
+from ami_catalog import *
+
+
+def expired_images(region, expiry_date, resume_date=None):
+    """
+    Yield tagged + stable EC2 images (and snapshot sets) in a region created before a date
+
+    EC2 does the selecting: automation AMIs only, created on the days up to the
+    date ("creation-date" wildcards), so the listing follows the expired images
+    rather than every AMI in the region.
+    resume_date: only list images from this date's day on (where an earlier invocation of the run stopped)
+    """
+    first_day = resume_date.date() if resume_date else PRUNE_SCAN_FROM
+    creation_dates = date_prefixes(first_day, expiry_date.date())
+    for entry in automation_backups(region, creation_dates=creation_dates):
+        #  The date's own day can hold newer images
+        if entry['instance_id'] and entry['image_create_dt'] < expiry_date:
+            yield entry
+
+
+def with_snapshot_ids(run, region, images):
+    """
+    Fill in missing snapshot ids for catalog rows, dropping images EC2 no longer has
+    """
+
+    #  Snapshot ids are only known once an AMI is available, look up any missing ones in bulk
+    #  (snapshot sets know theirs from the start)
+    lookup = dict(
+        (image['image_id'], image)
+        for image in images
+        if not image['snapshot_ids'] and not is_snapshot_set(image['image_id'])
+    )
+    image_ids = list(lookup)
+    for i in range(0, len(image_ids), 100):
+        found = aws_client('ec2', region).describe_images(
+            Filters=[{
+                'Name': 'image-id',
+                'Values': image_ids[i:i + 100]
+            }],
+            Owners=['self']
+        )
+        for image in found['Images']:
+            row = lookup.pop(image['ImageId'], None)
+            if row:
+                row['snapshot_ids'] = image_entry(region, image)['snapshot_ids']
+
+    #  Anything not found was already removed outside of the lambda functions
+    for image_id in lookup:
+        run.catalog.update(image_id, state='deregistered')
+
+    return [image for image in images if image['image_id'] not in lookup]
+
+
+class SnapshotRefs(object):
+    """
+    Which AMIs still use each snapshot of the images being pruned
+
+    Built with bulk "describe_images" lookups by snapshot id before any image
+    is deregistered. A snapshot is only released for deletion once every
+    AMI using it (copies, images registered from it, ...) is gone.
+    referenced: AMIs using each snapshot, when already listed (see RegionInventory)
+    """
+
+    def __init__(self, region, images=(), referenced=None):
+        self.region = region
+        self.referenced = referenced
+        self.lock = threading.Lock()
+        self.refs = {}
+        self.released = set()
+        self.add(images)
+
+    def add(self, images):
+        """
+        Look up the AMIs using the snapshots of more images to prune, before any of them is deregistered
+
+        Snapshots already looked up keep their users: one shared with an image
+        of a later batch is released when that image is deregistered.
+        """
+        refs = dict(
+            (snapshot_id, set()) for image in images for snapshot_id in image['snapshot_ids']
+            if snapshot_id not in self.refs
+        )
+
+        snapshot_ids = list(refs) if self.referenced is None else []
+        for snapshot_id, users in refs.items():
+            users.update((self.referenced or {}).get(snapshot_id, ()))
+        paginator = aws_client('ec2', self.region).get_paginator('describe_images')
+        for i in range(0, len(snapshot_ids), 200):
+            pages = paginator.paginate(
+                Filters=[{
+                    'Name': 'block-device-mapping.snapshot-id',
+                    'Values': snapshot_ids[i:i + 200]
+                }],
+                Owners=['self']
+            )
+            for page in pages:
+                for image in page['Images']:
+                    if image['State'] == 'deregistered':
+                        continue
+                    for snapshot_id in image_snapshot_ids(image):
+                        if snapshot_id in refs:
+                            refs[snapshot_id].add(image['ImageId'])
+
+        with self.lock:
+            self.refs.update(refs)
+
+            #  Images being pruned use their own snapshots, even if EC2 is slow to list them
+            for image in images:
+                for snapshot_id in image['snapshot_ids']:
+                    self.refs[snapshot_id].add(image['image_id'])
+        return
+
+    def release(self, image_id, snapshot_ids):
+        """
+        Drop a deregistered image's references, returning the snapshots nothing uses anymore
+        """
+        unused = []
+        with self.lock:
+            for snapshot_id in snapshot_ids:
+                users = self.refs.get(snapshot_id, set())
+                users.discard(image_id)
+                self.released.add(snapshot_id)
+                if not users:
+                    unused.append(snapshot_id)
+        return unused
+
+    def in_use(self):
+        """
+        Snapshots of deregistered images kept because other AMIs still use them
+        """
+        with self.lock:
+            return sorted(snapshot_id for snapshot_id in self.released if self.refs.get(snapshot_id))
+
+
+def snapshot_image_id(snapshot):
+    """
+    Get the AMI a snapshot was created for, from its "Created by CreateImage(...) for ami-..." description
+    """
+    for word in snapshot.get('Description', '').split():
+        if word.startswith('ami-'):
+            return word
+    return 'unknown'
+
+
+def sweep_due(run, region):
+    """
+    Check if it is time to look for orphan snapshots in a region
+
+    Without a catalog to remember the last look, only the run starting in
+    the first schedule "interval" (BACKUP_HOURS if there is none) of every
+    SNAPSHOT_SWEEP_HOURS looks.
+    """
+    if run.setting('sweep'):
+        return True
+    if not run.catalog:
+        slot_seconds = interval_seconds(run.setting('interval')) or BACKUP_HOURS * 3600.0
+        return calendar.timegm(run.today.utctimetuple()) % (SNAPSHOT_SWEEP_HOURS * 3600) < slot_seconds
+    last = run.catalog.get_meta('swept:%s' % (region))
+    if not last:
+        return True
+    return parse_datetime(last) < run.today - datetime.timedelta(hours=SNAPSHOT_SWEEP_HOURS)
+
+
+def reclaim_orphans(run, region, snapshot_pool, stats, unreferenced=None):
+    """
+    Delete old automation snapshots no AMI uses anymore, a batch at a time
+
+    unreferenced: automation snapshots no AMI uses, when already listed (see RegionInventory)
+    """
+    ec2 = aws_client('ec2', region)
+    started_before = run.today - datetime.timedelta(hours=SNAPSHOT_ORPHAN_HOURS)
+
+    if unreferenced is None:
+        #  Every snapshot still behind one of our AMIs, automation or not, in any state
+        referenced = set()
+        for page in ec2.get_paginator('describe_images').paginate(Owners=['self']):
+            for image in page['Images']:
+                referenced.update(image_snapshot_ids(image))
+
+        #  Automation snapshots (tagged on creation) nothing references
+        #  (snapshot sets are backups of their own, pruned like AMIs)
+        unreferenced = (
+            snapshot for snapshot in automation_snapshots(region)
+            if snapshot['SnapshotId'] not in referenced and not tag_value(snapshot.get('Tags'), 'backup_set')
+        )
+
+    #  Old enough not to be in flight
+    orphans = [snapshot for snapshot in unreferenced if snapshot['StartTime'] < started_before]
+
+    batch = orphans[:run.setting('orphan_batch', SNAPSHOT_ORPHAN_BATCH)]
+    for snapshot in batch:
+        snapshot_pool.apply_async(delete_snapshot, (region, snapshot['SnapshotId'], snapshot_image_id(snapshot), stats))
+    if orphans:
+        run.variables_add(
+            var_title='Orphan snapshots %s' % (region),
+            var_value='%d found, %d queued for deletion' % (len(orphans), len(batch))
+        )
+
+    if run.catalog:
+        run.catalog.put_meta('swept:%s' % (region), run.today.isoformat())
+    return
+
+
+def delete_snapshot(region, snapshot_id, image_id, stats):
+    """
+    Stage 2: delete a snapshot left behind by a deregistered image
+    """
+    started = time.time()
+    try:
+        aws_client('ec2', region).delete_snapshot(
+            SnapshotId=snapshot_id
+        )
+        logger.info('Great Success! Deleting snapshot [%s] created by ami [%s]' %
+                    (snapshot_id, image_id))
+    except Exception as e:
+        logger.error('ERR! Unable to delete snapshot [%s] created by ami [%s]' %
+                     (snapshot_id, image_id))
+        logger.exception(e)
+    stats.record('Snapshot delete', started)
+    return
+
+
+def deregister_image(run, region, image, snapshot_refs, snapshot_pool, stats):
+    """
+    Stage 1: deregister an expired image, then queue the snapshots only it used for deletion
+
+    Snapshot sets have nothing to deregister, their snapshots are queued right away.
+    """
+    started = time.time()
+
+    #  Get image info
+    image_id = image["image_id"]
+    image_date = image["image_create_dt"]
+    instance_id = image["instance_id"]
+    instance_name = image["instance_name"]
+
+    #  Deregister image/ami
+    kind = 'snapshot set' if is_snapshot_set(image_id) else 'ami'
+    try:
+        if kind == 'ami':
+            aws_client('ec2', region).deregister_image(
+                ImageId=image_id
+            )
+        logger.info('Great Success! Deleting %s [%s] for instance [%s:%s] created on [%s]' %
+                    (kind, image_id, instance_name, instance_id, image_date.isoformat()))
+
+        #  Record deleted image
+        if run.catalog:
+            run.catalog.update(image_id, state='deregistered')
+
+        run.image_status_add(
+            instance_id=instance_id,
+            instance_name=instance_name,
+            image_id=image_id,
+            image_name=image["image_name"],
+            create_dt=image_date,
+            action='DELETE',
+            is_success=True,
+            region=region
+        )
+
+        # TODO: You can remove this block if snapshots should not to be deleted
+        for snapshot_id in snapshot_refs.release(image_id, image['snapshot_ids']):
+            snapshot_pool.apply_async(delete_snapshot, (region, snapshot_id, image_id, stats))
+
+    except Exception as e:
+        logger.error('ERR! Unable to delete %s [%s] for instance [%s:%s] created on [%s]' %
+                     (kind, image_id, instance_name, instance_id, image_date.isoformat()))
+        logger.exception(e)
+
+        #  Record failure
+        run.image_status_add(
+            instance_id=instance_id,
+            instance_name=instance_name,
+            image_id=image_id,
+            image_name=image["image_name"],
+            create_dt=image_date,
+            action='DELETE',
+            is_success=False,
+            region=region
+        )
+
+    stats.record('Deregister', started)
+    return
+
+
+def region_policies(run, region, instances=None):
+    """
+    Backup policies of a region's tagged instances that differ from the default, by instance id
+    """
+    policies = {}
+    for instance in iter_instances(region) if instances is None else instances:
+        if not instance['backup_policy'].is_default():
+            policies[instance['instance_id']] = instance['backup_policy']
+    if policies:
+        run.variables_add(
+            var_title='Backup policies %s' % (region),
+            var_value='%d instance(s) with their own policy' % (len(policies))
+        )
+    return policies
+
+
+def prune_region(run, region, candidate_date, snapshot_pool, stats, inventory=None):
+    """
+    Deregister expired images in a region, several at a time
+
+    inventory: instances + backups already listed (see RegionInventory), instead of listing them here
+    """
+
+    #  Reclaim snapshots earlier runs left behind, before this run frees any more
+    if run.part == 1 and sweep_due(run, region):
+        reclaim_orphans(run, region, snapshot_pool, stats, inventory.unreferenced if inventory else None)
+
+    #  Instances with their own retention policy may keep backups for less time than the default
+    policies = region_policies(run, region, inventory.instances if inventory else None)
+    candidate_date = max(
+        [candidate_date] + [run.today - datetime.timedelta(days=policy.keep_all_days()) for policy in policies.values()]
+    )
+
+    #
+    #  Images are deregistered oldest first. An earlier invocation of the run that
+    #  stopped early left the creation time of the first image it did not get to,
+    #  only images from there on are looked at again (the retention tiers decide
+    #  on each AMI from the AMIs newer than it alone, so the plan stays the same).
+    #
+    resume_date = run.region_cursor(region).get('from')
+    resume_date = parse_datetime(resume_date) if resume_date else None
+
+    #  Find images old enough to be pruned from the inventory, the catalog (kept honest by a periodic reconcile) or EC2
+    if inventory:
+        images = inventory.created_before(candidate_date)
+    elif run.catalog:
+        if reconcile_due(run, run.catalog, region):
+            reconcile_catalog(run, run.catalog, region)
+        images = run.catalog.expired(region, candidate_date)
+    else:
+        images = expired_images(region, candidate_date, resume_date)
+    if resume_date:
+        images = [image for image in images if image['image_create_dt'] >= resume_date]
+
+    #  Let the retention tiers pick which ones go
+    images = retention_deletes(run, region, images, policies)
+    images.sort(key=lambda k: (k['image_create_dt'], k['image_id']))
+    if run.catalog and not inventory:
+        images = with_snapshot_ids(run, region, images)
+
+    #  Snapshots are only deleted once no other AMI uses them (looked up a batch at a time)
+    snapshot_refs = SnapshotRefs(region, referenced=inventory.referenced if inventory else None)
+
+    taken = []
+
+    def deregister(image):
+        taken.append(image['image_id'])
+        deregister_image(run, region, image, snapshot_refs, snapshot_pool, stats)
+
+    finished = True
+    batch_size = run.setting('prune_batch', PRUNE_BATCH)
+    for i in range(0, len(images), batch_size):
+        if i and run.out_of_time():
+            finished = False
+            break
+        batch = images[i:i + batch_size]
+        snapshot_refs.add(batch)
+        finished = run_parallel(
+            func=deregister,
+            items=batch,
+            workers=run.setting('workers', PRUNE_WORKERS),
+            stop=run.out_of_time
+        )
+        if not finished:
+            break
+    if not finished:
+        run.save_cursor(region, {'from': images[len(taken)]['image_create_dt'].isoformat()})
+
+    in_use = snapshot_refs.in_use()
+    if in_use:
+        run.variables_add(
+            var_title='Snapshots in use %s' % (region),
+            var_value='%d kept: %s' % (len(in_use), ', '.join(in_use[:20]) + (' ...' if len(in_use) > 20 else ''))
+        )
+    return
+
+
+def prune_dates(run):
+    """
+    Dates prune compares backups with, added to the run's report
+
+    - Expiration date: nothing older is kept
+    - Candidate date: everything newer is kept, older images go thru the retention tiers
+    """
+    expiry_date = run.today - datetime.timedelta(days=retention_horizon_days())
+    candidate_date = run.today - datetime.timedelta(days=retention_keep_all_days())
+    run.variables_add(
+        var_title='Expiration date',
+        var_value=expiry_date.isoformat()
+    )
+    if candidate_date != expiry_date:
+        run.variables_add(
+            var_title='Retention tiers',
+            var_value=', '.join('%sd every %sh' % (days, every_hours) for days, every_hours in retention_tiers())
+        )
+    return expiry_date, candidate_date
@@ -5,330 +5,1847 @@
 """
 
 #  General libraries
-import boto3
 import logging
 import datetime
-import dateutil.parser
 import dateutil.tz
 import time
 import json
+import calendar
+import math
+import zlib
+import fnmatch
+import threading
+import os
+from multiprocessing.pool import ThreadPool
 
 #  Constants
 
 #  ONLY servers with these tag:value combo are backed-up
 TAG_KEY = 'AMIBackup'
 TAG_VALUE = 'yes'
+#  How each server is backed-up, set by this tag:
+#  - 'image' (or no tag): an AMI
+#  - 'snapshots': a crash-consistent snapshot set of every attached EBS volume, no AMI
+#  - 'data': same as 'snapshots', without the boot volume
+TAG_MODE_KEY = 'AMIBackupMode'
+BACKUP_MODES = ('image', 'snapshots', 'data')
+#  Per-instance schedule + retention, overriding the defaults below, e.g. "every=12h keep=30d grace=6h":
+#  - every: hours between backups (create skips the instance until then)
+#  - keep: days backups are kept for
+#  - grace: hours late a backup can be before monitor alerts
+#  Durations take an "h", "d" or "w" suffix (plain numbers: hours, days for keep)
+TAG_POLICY_KEY = 'AMIBackupPolicy'
+#  Snapshot sets stand in for AMIs with ids made of this prefix, the instance id and the time taken
+SNAPSHOT_SET_PREFIX = 'snapset-'
 
 #  How long to keep backups (days)
 RETENTION_DAYS = 7
+#  Tiered (grandfather-father-son) retention, used instead of RETENTION_DAYS when set
+#  Each tier: (up to this many days old, keep one backup per this many hours (0: keep all))
+#  e.g. every backup for 2 days, daily for 2 weeks, weekly for 3 months:
+#  RETENTION_TIERS = [(2, 0), (14, 24), (90, 24 * 7)]
+RETENTION_TIERS = []
 #  How often to backup (hours) (NOTE: this is set on 'deploy.sh')
 BACKUP_HOURS = 4
 
+#  Regions to process in each run (empty: only the lambda function's own region)
+#  Override via "regions" in the event
+REGIONS = []
+#  Roles to assume in other accounts, to process the regions above in each of them instead of
+#  the lambda function's own account, e.g. ['arn:aws:iam::123456789012:role/ami-backup-buddy']
+#  Override via "accounts" in the event
+ACCOUNT_ROLES = []
+#  How long assumed-role credentials last (seconds), and how long before they expire they are renewed
+ASSUME_ROLE_SECONDS = 3600
+ASSUME_ROLE_REFRESH_SECONDS = 300
+ASSUME_ROLE_SESSION_NAME = 'ami-backup-buddy'
+#  How many regions (across all accounts) to process at once
+REGION_WORKERS = 16
+
+#  How many AMIs to create at once (override via "workers" in the event)
+CREATE_WORKERS = 10
+#  Spread backups over the BACKUP_HOURS window: each run only images one of this many shards
+#  Override via "shards" (+ "shard", else picked from the time of the run) in the event
+CREATE_SHARDS = 1
+#  How long create waits for new AMIs to become available (minutes, 0: don't wait)
+#  and how often it checks on them (seconds), override via "wait_minutes" + "poll_seconds" in the event
+#  (the wait also stops 30 seconds before the lambda function would time out, see 'deploy.sh')
+#  With a catalog, AMIs left pending are looked up by the next run instead
+CREATE_WAIT_MINUTES = 0
+CREATE_POLL_SECONDS = 15
+#  Report AMIs (followed up from the catalog) still pending this long after they were requested (hours)
+CREATE_PENDING_HOURS = 6
+#  Skip stopped instances unchanged (same stop, volumes + backup mode) since their newest backup,
+#  unless that backup is older than CREATE_SKIP_REFRESH_HOURS (keep it well under the retention)
+#  Override via "skip_unchanged" in the event
+CREATE_SKIP_UNCHANGED = True
+CREATE_SKIP_REFRESH_HOURS = 24 * 3
+
+#  How many AMIs to deregister, and snapshots to delete, at once
+PRUNE_WORKERS = 10
+SNAPSHOT_WORKERS = 20
+#  AMIs prune looks up snapshot users for and deregisters per batch, checking the lambda timeout in between
+PRUNE_BATCH = 500
+#  Without a catalog, prune asks EC2 for AMIs created from this day up to the cutoff (EC2 AMIs can't be older)
+PRUNE_SCAN_FROM = datetime.date(2006, 1, 1)
+
+#  Automation snapshots left without an AMI (e.g. by an earlier failed prune) are deleted
+#  once older than this (hours), at most SNAPSHOT_ORPHAN_BATCH per region and run
+SNAPSHOT_ORPHAN_HOURS = 24
+SNAPSHOT_ORPHAN_BATCH = 500
+#  How often to look for orphan snapshots (hours): when a catalog can remember the last look, or else
+#  on the run starting in the first schedule interval of every period. Force via "sweep" in the event
+SNAPSHOT_SWEEP_HOURS = 24
+
 #  How old the "oldest" backup can be before we alert
 RETENTION_DAYS_GRACE = 8
 
 #  How much time since "newest" backup before we alert
 BACKUP_HOURS_GRACE = 8
 
+#  Where to keep the AMI catalog (empty: no catalog, scan EC2 every run)
+#  - 'sqlite:///tmp/ami-catalog.db' : local SQLite file, for testing
+#  - 'dynamodb://ami-backup-catalog' : DynamoDB table, for production
+CATALOG_URI = ''
+#  How often to reconcile the catalog against EC2 (hours)
+CATALOG_RECONCILE_HOURS = 24
+
+#  Monitor only looks at AMIs created since its last run (needs CATALOG_URI)
+#  Override via "incremental" in the event
+MONITOR_INCREMENTAL = False
+#  How often the incremental monitor rebuilds its summaries from a full scan (hours)
+MONITOR_RESCAN_HOURS = 24 * 7
+
+#  Stop this long before the lambda function would time out (seconds) and hand the rest of
+#  the run to a new invocation of the function, at most RESUME_MAX_PARTS invocations per run
+RESUME_MARGIN_SECONDS = 60
+RESUME_MAX_PARTS = 10
+#  Size of the event handed from one invocation to the next (bytes, asynchronous invocations take
+#  up to 256 KB): what room the cursors leave goes to status records, the rest are only counted
+RESUME_EVENT_BYTES = 250 * 1024
+
 #  Global notification
 ARN_TOPIC_ALERT = 'arn:aws:sns:us-east-1:999999999999:my_alerts'  # ! Change to your own!
 
+#  SNS rejects messages over 256 KB, keep each report part safely below it
+REPORT_PART_BYTES = 240 * 1024
+#  Send a summary with counts only if the report would need more parts than this
+REPORT_MAX_PARTS = 10
+
+#  With a catalog, reports only list failures that started or cleared since the last one
+#  (per instance + action), plus a digest of every ongoing failure this often (hours)
+#  Force a digest via "digest" in the event, 0: every report lists everything
+ALERT_DIGEST_HOURS = 24
+#  Alerts from runs that don't email (create, prune) wait for the monitor's report, and are sent
+#  by whichever run comes first once they have waited this long (hours)
+ALERT_BATCH_HOURS = 4
+#  Queued alerts are stored this many per catalog item (well under DynamoDB's 400 KB item limit)
+ALERT_QUEUE_CHUNK = 500
+#  Lambda functions that queue alerts
+ALERT_SOURCES = ('ami-create-backups', 'ami-prune-backups', 'ami-monitor-backups')
+
+#  Print per-API-call metrics at the end of each invocation (CloudWatch embedded metric format)
+METRICS_EMF = True
+METRICS_NAMESPACE = 'AMIBackupBuddy'
+#  Latency histogram bucket upper bounds (ms), anything slower goes in an overflow bucket
+METRICS_LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+#  Error codes AWS uses for throttled calls
+THROTTLE_CODES = (
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled', 'RequestThrottledException',
+    'RequestLimitExceeded', 'TooManyRequestsException', 'ProvisionedThroughputExceededException', 'SlowDown'
+)
+
+#  Report sections, in order: (bucket, heading)
+REPORT_SECTIONS = [
+    (('CREATE', True), 'Backups taken (Pass):'),
+    (('CREATE', False), 'Backups NOT taken (Fail):'),
+    (('CREATE_PENDING', False), 'Backups still pending (Check):'),
+    (('SKIP', True), 'Backups skipped, not due or unchanged (Pass):'),
+    (('DELETE', True), 'Expired backups deleted (Pass):'),
+    (('DELETE', False), 'Expired backups NOT deleted (Fail):'),
+    (('CHECK_MISSING', False), 'Server(s) with NO backups (Fail):'),
+    (('CHECK_EXPIRED', False), 'Expired backups left behind (Fail):'),
+    (('CHECK_RECENT', False), 'Server(s) missing recent backups taken (Fail):'),
+    (('RECOVERED', True), 'Failures cleared since the last report (Pass):'),
+]
+
 #  Global objects
-ec2 = boto3.client('ec2')
-sns = boto3.client('sns')
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-#  Timestamp with today's date in UTC
-today = datetime.datetime.utcnow().replace(tzinfo=dateutil.tz.tzutc())
+#  Timezone of every AWS timestamp
+UTC = dateutil.tz.tzutc()
+
+#  Cached boto3 clients, one per (service, region), reused by warm invocations
+clients = {}
+clients_lock = threading.RLock()
+
+#  botocore session behind every client, created along with the first one
+botocore_session = None
+
+#  Role to assume by account id, and its cached credentials (+ a lock per role), reused by warm invocations
+account_roles = {}
+role_credentials_cache = {}
+role_locks = {}
+
+#  Access key each cached client of another account was created with
+client_access_keys = {}
+
+#  Compiled backup policies by policy tag value, reused by warm invocations
+policy_cache = {}
+
+#  Global classes
+class ApiMetrics(object):
+    """
+    Count, latency histogram, retries, errors + throttles for every AWS API call
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}
+
+    def reset(self):
+        """
+        Start over, warm containers reuse the same collector for every invocation
+        """
+        with self.lock:
+            self.operations = {}
+        return
+
+    def record(self, operation, started, response=None, error=None):
+        """
+        Record one API call (or one page of a paginated call)
+        """
+        elapsed_ms = (time.time() - started) * 1000.0
+
+        #  botocore retries throttled/failed attempts itself, and says how many it took
+        metadata = {}
+        if isinstance(response, dict):
+            metadata = response.get('ResponseMetadata') or {}
+        elif error is not None:
+            metadata = (getattr(error, 'response', None) or {}).get('ResponseMetadata') or {}
+        code = ''
+        if error is not None:
+            code = ((getattr(error, 'response', None) or {}).get('Error') or {}).get('Code', '')
+
+        bucket = len(METRICS_LATENCY_BUCKETS)
+        for i, bound in enumerate(METRICS_LATENCY_BUCKETS):
+            if elapsed_ms <= bound:
+                bucket = i
+                break
+
+        with self.lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = {
+                    'calls': 0,
+                    'errors': 0,
+                    'throttles': 0,
+                    'retries': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'buckets': [0] * (len(METRICS_LATENCY_BUCKETS) + 1)
+                }
+            stats['calls'] += 1
+            stats['errors'] += 1 if error is not None else 0
+            stats['throttles'] += 1 if code in THROTTLE_CODES else 0
+            stats['retries'] += metadata.get('RetryAttempts', 0) or 0
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['buckets'][bucket] += 1
+        return
+
+    @staticmethod
+    def percentile(stats, fraction):
+        """
+        Estimate a latency percentile (ms) as the upper bound of the bucket it falls in (capped at the max)
+        """
+        rank = fraction * stats['calls']
+        seen = 0
+        for i, count in enumerate(stats['buckets']):
+            seen += count
+            if count and seen >= rank:
+                return min(METRICS_LATENCY_BUCKETS[i], stats['max_ms']) if i < len(METRICS_LATENCY_BUCKETS) else stats['max_ms']
+        return stats['max_ms']
+
+    def emf_record(self, function_name):
+        """
+        Build a single CloudWatch embedded metric format record for every operation seen
+        """
+        record = {'Function': function_name}
+        metrics = []
+        with self.lock:
+            operations = dict((operation, dict(stats)) for operation, stats in self.operations.items())
 
-#  Global lists
-image_status_list = []
-create_success_list = []
-create_failure_list = []
-delete_success_list = []
-delete_failure_list = []
-missing_backup_list = []
-expired_backup_list = []
-no_recent_backup_list = []
-#  Hold custom values
-variables_list = []
+        for operation in sorted(operations):
+            stats = operations[operation]
+            values = [
+                ('Calls', stats['calls'], 'Count'),
+                ('Errors', stats['errors'], 'Count'),
+                ('Throttles', stats['throttles'], 'Count'),
+                ('Retries', stats['retries'], 'Count'),
+                ('LatencyTotal', round(stats['total_ms'], 1), 'Milliseconds'),
+                ('LatencyMax', round(stats['max_ms'], 1), 'Milliseconds'),
+                ('LatencyP50', round(self.percentile(stats, 0.50), 1), 'Milliseconds'),
+                ('LatencyP99', round(self.percentile(stats, 0.99), 1), 'Milliseconds')
+            ]
+            for name, value, unit in values:
+                metrics.append({'Name': '%s.%s' % (operation, name), 'Unit': unit})
+                record['%s.%s' % (operation, name)] = value
+
+            #  Full histogram as a plain property, searchable in Logs Insights
+            bounds = ['<=%dms' % (bound) for bound in METRICS_LATENCY_BUCKETS] + ['>%dms' % (METRICS_LATENCY_BUCKETS[-1])]
+            record['%s.LatencyHistogram' % (operation)] = dict(
+                (bound, count) for bound, count in zip(bounds, stats['buckets']) if count
+            )
+
+        #  EMF allows at most 100 metrics per directive
+        record['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [
+                {
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Function']],
+                    'Metrics': metrics[i:i + 100]
+                }
+                for i in range(0, len(metrics), 100)
+            ]
+        }
+        return record
+
+
+class InstrumentedPaginator(object):
+    """
+    Paginator wrapper timing every page fetched
+    """
+
+    def __init__(self, paginator, operation):
+        self.paginator = paginator
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        pages = iter(self.paginator.paginate(**kwargs))
+        while True:
+            started = time.time()
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            except Exception as e:
+                api_metrics.record(self.operation, started, error=e)
+                raise
+            api_metrics.record(self.operation, started, response=page)
+            yield page
+
+
+class InstrumentedClient(object):
+    """
+    Thin wrapper around a boto3 client recording every API call in api_metrics
+    """
+
+    #  Client methods that don't call AWS
+    LOCAL_METHODS = ('can_paginate', 'close', 'get_waiter', 'generate_presigned_url', 'generate_presigned_post')
+
+    def __init__(self, client, service):
+        self.client = client
+        self.service = service
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        operation = '%s.%s' % (self.service, name)
+        if name == 'get_paginator':
+            return lambda operation_name: InstrumentedPaginator(
+                attr(operation_name), '%s.%s' % (self.service, operation_name))
+        if name.startswith('_') or name in self.LOCAL_METHODS or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            started = time.time()
+            try:
+                response = attr(*args, **kwargs)
+            except Exception as e:
+                api_metrics.record(operation, started, error=e)
+                raise
+            api_metrics.record(operation, started, response=response)
+            return response
+        return call
+
+
+#  Single collector, reset by every RunContext (lambda runs one invocation at a time per container)
+api_metrics = ApiMetrics()
+
+
+class RunContext(object):
+    """
+    State for a single lambda invocation: clock, status records and report variables
+    """
+
+    def __init__(self, event=None, context=None):
+        self.event = event
+        self.context = context
+
+        #  Where an earlier invocation of the same run stopped (see continue_run)
+        self.resume = self.setting('resume') or {}
+        self.part = self.resume.get('part', 1)
+        self.cursors = {}
+        self.failed_regions = set()
+
+        #  Timestamp with today's date in UTC (kept by every invocation of a run)
+        if self.resume:
+            self.today = parse_datetime(self.resume['today'])
+        else:
+            self.today = datetime.datetime.utcnow().replace(tzinfo=UTC)
+
+        #  Regions to process, as "<account id>/<region>" when they are in other accounts
+        self.regions = list(self.setting('regions', REGIONS)) or [default_region()]
+        accounts = list(self.setting('accounts', ACCOUNT_ROLES))
+        if accounts:
+            self.regions = account_regions(accounts, self.regions)
+
+        #  Actions/results and custom values for this run only
+        self.image_status_list = []
+        self.variables_list = []
+
+        #  AMI catalog, for handlers using one (see ami_catalog.py)
+        self.catalog = None
+
+        #  Guard lists shared with worker threads
+        self.lock = threading.Lock()
+
+        #  API call metrics start from zero for every invocation
+        self.metrics = api_metrics
+        self.metrics.reset()
+
+        #  Pick up the report of earlier invocations
+        if self.resume:
+            report_restore(self, self.resume.get('report', {}))
+
+    def image_status_add(self, instance_id, instance_name, image_id, image_name, create_dt, action, is_success,
+                         region=None, duration=None):
+        """
+        Add items to actions/results list
+        """
+
+        with self.lock:
+            self.image_status_list.append({
+                "region": region or self.regions[0],
+                "instance_id": instance_id,
+                "instance_name": instance_name.replace(".guruse.com", ""),
+                "image_id": image_id,
+                "image_name": image_name,
+                "create_dt": create_dt,
+                "action": action,
+                "is_success": is_success,
+                "duration": duration
+            })
+        return
+
+    def variables_add(self, var_title, var_value):
+        """
+        Add items to variables list
+        """
+
+        variable = {
+            "var_title": var_title.upper(),
+            "var_value": var_value
+        }
+        with self.lock:
+            #  Resumed runs set the same values again
+            if variable not in self.variables_list:
+                self.variables_list.append(variable)
+        return
+
+    def setting(self, key, default=None):
+        """
+        Get a setting from the lambda event payload, if any
+        """
+        if isinstance(self.event, dict) and self.event.get(key) is not None:
+            return self.event[key]
+        return default
+
+    def time_left(self):
+        """
+        Seconds left before lambda times out (None when not running on lambda)
+        """
+        if hasattr(self.context, 'get_remaining_time_in_millis'):
+            return self.context.get_remaining_time_in_millis() / 1000.0
+        return None
+
+    def out_of_time(self):
+        """
+        Check if it is time to stop taking on work and let another invocation finish the run
+        """
+        time_left = self.time_left()
+        return time_left is not None and time_left < RESUME_MARGIN_SECONDS
+
+    def region_cursor(self, region):
+        """
+        Where an earlier invocation stopped in a region (empty if it did not)
+        """
+        return self.resume.get('regions', {}).get(region) or {}
+
+    def save_cursor(self, region, cursor):
+        """
+        Record where this invocation stopped in a region, for the next one to carry on from
+        """
+        with self.lock:
+            self.cursors[region] = cursor
+        return
+
+    def region_finished(self, region):
+        """
+        Check if a region was fully processed by this run (by this or an earlier invocation)
+        """
+        if region in self.failed_regions:
+            return False
+        return (self.cursors.get(region) or self.region_cursor(region)).get('finished', False)
+
+
+class StageStats(object):
+    """
+    Track items processed and elapsed time per pipeline stage
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def record(self, stage, started):
+        """
+        Record one item for a stage, given the time it started processing
+        """
+        ended = time.time()
+        with self.lock:
+            count, first, last = self.stages.get(stage, (0, started, ended))
+            self.stages[stage] = (count + 1, min(first, started), max(last, ended))
+        return
+
+    def report(self, run):
+        """
+        Add per-stage throughput to the run's report variables
+        """
+        for stage in sorted(self.stages):
+            count, first, last = self.stages[stage]
+            elapsed = max(last - first, 0.001)
+            run.variables_add(
+                var_title='%s rate' % (stage),
+                var_value='%d in %.1fs (%.1f/s)' % (count, elapsed, count / elapsed)
+            )
+            logger.info('Stage [%s] processed %d item(s) in %.1fs' % (stage, count, elapsed))
+        return
 
 
 #  Global functions
-def image_status_add(instance_id, instance_name, image_id, image_name, create_dt, action, is_success):
+def aws_session():
+    """
+    Get the shared botocore session, importing botocore on first use
+
+    Clients come straight from botocore: boto3 adds nothing the lambda
+    functions use but pulls in s3transfer and friends on every cold start.
+    """
+    global botocore_session
+    with clients_lock:
+        if botocore_session is None:
+            import botocore.session
+            botocore_session = botocore.session.get_session()
+        return botocore_session
+
+
+def default_region():
     """
-    Add items to actions/results list
+    Get the AWS region the lambda function runs in
     """
+    return os.environ.get('AWS_REGION') or aws_session().get_config_variable('region')
 
-    image_status_list.append({
-        "instance_id": instance_id,
-        "instance_name": instance_name.replace(".guruse.com", ""),
-        "image_id": image_id,
-        "image_name": image_name,
-        "create_dt": create_dt,
-        "action": action,
-        "is_success": is_success
-    })
-    return
+
+def account_regions(role_arns, regions):
+    """
+    Regions to process in the accounts of some roles, as "<account id>/<region>"
+    """
+    account_ids = []
+    with clients_lock:
+        for role_arn in role_arns:
+            account_id = role_arn.split(':')[4]
+            account_roles[account_id] = role_arn
+            account_ids.append(account_id)
+    return ['%s/%s' % (account_id, region) for account_id in account_ids for region in regions]
+
+
+def split_region(region):
+    """
+    Split a region to process into (account id, AWS region), the account id is None for the own account
+    """
+    if region and '/' in region:
+        return tuple(region.split('/', 1))
+    return None, region
+
+
+def role_credentials(role_arn):
+    """
+    Get temporary credentials for a role, assumed on first use and again shortly before they expire
+
+    Each role is only assumed by one thread at a time, others wait for its credentials.
+    """
+    with clients_lock:
+        lock = role_locks.setdefault(role_arn, threading.Lock())
+    with lock:
+        credentials = role_credentials_cache.get(role_arn)
+        renew_after = datetime.datetime.utcnow().replace(tzinfo=UTC) + \
+            datetime.timedelta(seconds=ASSUME_ROLE_REFRESH_SECONDS)
+        if not credentials or credentials['Expiration'] <= renew_after:
+            credentials = aws_client('sts').assume_role(
+                RoleArn=role_arn,
+                RoleSessionName=ASSUME_ROLE_SESSION_NAME,
+                DurationSeconds=ASSUME_ROLE_SECONDS
+            )['Credentials']
+            role_credentials_cache[role_arn] = credentials
+            logger.info('Great Success! Assumed role [%s] until [%s]' %
+                        (role_arn, credentials['Expiration'].isoformat()))
+        return credentials
+
+
+def aws_client(service, region=None):
+    """
+    Get a cached client for a service + region, created on first use and instrumented by api_metrics
+
+    Regions in other accounts ("<account id>/<region>") get clients with the
+    credentials of the account's role, created again once they are renewed.
+    """
+    key = (service, region)
+    account_id, region_name = split_region(region)
+    credentials = role_credentials(account_roles[account_id]) if account_id else None
+    with clients_lock:
+        renewed = credentials and key in client_access_keys and \
+            client_access_keys[key] != credentials['AccessKeyId']
+        if key not in clients or renewed:
+            kwargs = {}
+            if credentials:
+                kwargs = {
+                    'aws_access_key_id': credentials['AccessKeyId'],
+                    'aws_secret_access_key': credentials['SecretAccessKey'],
+                    'aws_session_token': credentials['SessionToken']
+                }
+                client_access_keys[key] = credentials['AccessKeyId']
+            clients[key] = aws_session().create_client(service, region_name=region_name, **kwargs)
+        return InstrumentedClient(clients[key], service)
 
 
-def variables_add(var_title, var_value):
+def run_regions(run, func):
     """
-    Add items to variables list
+    Call func(run, region) for every region in the run not already finished by an earlier invocation,
+    up to REGION_WORKERS regions (across all accounts) at once
     """
+    regions = [region for region in run.regions if not run.region_cursor(region).get('finished')]
 
-    variables_list.append({
-        "var_title": var_title.upper(),
-        "var_value": var_value
-    })
+    def region_run(region):
+        try:
+            func(run, region)
+        except Exception:
+            with run.lock:
+                run.failed_regions.add(region)
+            raise
+        finally:
+            #  Regions that did not save a cursor are done with
+            if region not in run.cursors:
+                run.save_cursor(region, {'finished': True})
+
+    run_parallel(
+        func=region_run,
+        items=regions,
+        workers=min(len(regions), REGION_WORKERS)
+    )
+    if run.failed_regions:
+        run.variables_add(
+            var_title='Failed regions',
+            var_value=', '.join(sorted(run.failed_regions))
+        )
     return
 
 
-def send_via_email(script_file, title):
+def parse_datetime(value):
+    """
+    Parse an AWS timestamp, dateutil's parser is only imported once a date needs parsing
+
+    EC2's fixed 'YYYY-MM-DDTHH:MM:SS.mmmZ' format (every AMI "CreationDate") is sliced directly.
+    """
+    if len(value) == 24 and value[10] == 'T' and value[19] == '.' and value[23] == 'Z':
+        try:
+            return datetime.datetime(
+                int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                int(value[20:23]) * 1000, UTC
+            )
+        except ValueError:
+            pass
+    import dateutil.parser
+    return dateutil.parser.parse(value)
+
+
+def tag_value(tags, key, default=None):
+    """
+    Get value for a tag key from a boto3 tag list
+    """
+    for tag in tags or []:
+        if tag['Key'] == key:
+            return tag['Value']
+    return default
+
+
+def instance_record(instance):
+    """
+    Normalize a raw EC2 instance into the fields used by lambda functions
+    """
+
+    #  Full instance name
+    instance_fullname = tag_value(instance.get('Tags'), 'Name', instance['InstanceId']).strip()
+
+    #  Sanitize instance name (drop "env:" prefix)
+    instance_name = instance_fullname
+    if ":" in instance_name:
+        instance_name = instance_name.split(":")[1].strip()
+
+    return {
+        "instance_id": instance['InstanceId'],
+        "instance_fullname": instance_fullname,
+        "instance_name": instance_name,
+        "instance_hostname": instance_name.split(".")[0].strip(),
+        "instance_type": instance['InstanceType'],
+        "instance_keyname": instance.get('KeyName', ''),
+        "instance_state": instance['State']['Name'],
+        "instance_avail_zone": instance['Placement']['AvailabilityZone'],
+        "instance_sec_groups": [
+            security_group['GroupId']
+            for security_group in instance.get('SecurityGroups', [])
+            if security_group['GroupId']
+        ],
+        "instance_state_reason": instance.get('StateTransitionReason', ''),
+        "instance_volumes": sorted(
+            bdm['Ebs']['VolumeId']
+            for bdm in instance.get('BlockDeviceMappings', [])
+            if 'Ebs' in bdm
+        ),
+        "backup_mode": backup_mode(instance.get('Tags')),
+        "backup_policy": backup_policy(instance.get('Tags'))
+    }
+
+
+def instance_fingerprint(instance):
+    """
+    Short hash of what decides if an instance has changed since a backup:
+    state, last state change (e.g. "User initiated (<stop time>)"), volumes and backup mode
+    """
+    values = [instance["instance_state"], instance["instance_state_reason"], instance["backup_mode"]]
+    values.extend(instance["instance_volumes"])
+    return '%08x' % (zlib.crc32('|'.join(values).encode('utf-8')) & 0xffffffff)
+
+
+def backup_mode(tags):
+    """
+    Get how an instance is backed-up from its tags (unknown values fall back to an AMI)
+    """
+    mode = tag_value(tags, TAG_MODE_KEY, BACKUP_MODES[0]).strip().lower()
+    return mode if mode in BACKUP_MODES else BACKUP_MODES[0]
+
+
+def instance_shard(instance_id, shards):
+    """
+    Stable shard (0 to shards - 1) an instance belongs to
+    """
+    return (zlib.crc32(instance_id.encode('utf-8')) & 0xffffffff) % shards
+
+
+def interval_seconds(interval):
+    """
+    Length of a schedule "rate" interval such as "30 minutes" or "1 day" (None if there is none)
+    """
+    units = {'minute': 60, 'hour': 3600, 'day': 86400}
+    try:
+        count, unit = str(interval).split()
+        return int(count) * units[unit.lower().rstrip('s')]
+    except (ValueError, KeyError):
+        return None
+
+
+def run_shard(run):
+    """
+    Get the (shard, shards) a run covers
+
+    deploy_job.sh gives every shard a schedule of its own, passing "shard".
+    Without one, time is split into slots as long as the schedule's
+    "interval" (BACKUP_HOURS / shards if there is none) and the run takes
+    the slot nearest its start time, so consecutive runs walk thru every
+    shard (as long as runs start on time).
+    """
+    shards = int(run.setting('shards', CREATE_SHARDS))
+    if shards < 1:
+        raise ValueError('Invalid shard count [%s]' % (shards))
+    shard = run.setting('shard')
+    if shard is None:
+        slot_seconds = interval_seconds(run.setting('interval')) or BACKUP_HOURS * 3600.0 / shards
+        shard = int(round(calendar.timegm(run.today.utctimetuple()) / slot_seconds)) % shards
+    shard = int(shard)
+    if not 0 <= shard < shards:
+        raise ValueError('Invalid shard [%s] of [%s]' % (shard, shards))
+    return shard, shards
+
+
+def iter_instances(region):
+    """
+    Yield tagged EC2 instances in a region one at a time, across all result pages
+    """
+    for _, instances in instance_pages(region):
+        for instance in instances:
+            yield instance
+
+
+def instance_pages(region, token=None):
+    """
+    Yield (page token, instances) for each result page of tagged EC2 instances, starting at a page token
+    """
+    ec2 = aws_client('ec2', region)
+    while True:
+        kwargs = {}
+        if token:
+            kwargs['NextToken'] = token
+        page = ec2.describe_instances(
+            Filters=[{
+                'Name': 'tag:%s' % (TAG_KEY),
+                'Values': [TAG_VALUE]
+            }],
+            **kwargs
+        )
+        yield token, [
+            instance_record(instance)
+            for reservation in page['Reservations']
+            for instance in reservation['Instances']
+        ]
+        token = page.get('NextToken')
+        if not token:
+            break
+
+
+class ImageEntry(object):
+    """
+    Fields of one automation AMI used by lambda functions
+
+    A slotted record instead of a dict, prune and monitor hold one per AMI.
+    Fields are read and set like dict keys (entry['image_id']) or attributes,
+    so entries mix with catalog rows.
+    """
+
+    __slots__ = (
+        'region', 'image_id', 'image_name', 'image_create_dt',
+        'instance_id', 'instance_name', 'snapshot_ids', 'state', 'fingerprint'
+    )
+
+    def __init__(self, region, image_id, image_name, image_create_dt, instance_id, instance_name,
+                 snapshot_ids, state, fingerprint=None):
+        self.region = region
+        self.image_id = image_id
+        self.image_name = image_name
+        self.image_create_dt = image_create_dt
+        self.instance_id = instance_id
+        self.instance_name = instance_name
+        self.snapshot_ids = snapshot_ids
+        self.state = state
+        self.fingerprint = fingerprint
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in self.__slots__
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def __repr__(self):
+        return 'ImageEntry(%s)' % (', '.join('%s=%r' % (field, getattr(self, field)) for field in self.__slots__))
+
+
+def image_entry(region, image):
+    """
+    Normalize a raw automation AMI into the fields used by lambda functions
+    """
+
+    #  One pass over the tags for every value
+    instance_id = None
+    instance_name = ''
+    fingerprint = None
+    for tag in image.get('Tags') or []:
+        if tag['Key'] == 'instance_id':
+            instance_id = tag['Value']
+        elif tag['Key'] == 'instance_name':
+            instance_name = tag['Value']
+        elif tag['Key'] == 'instance_fingerprint':
+            fingerprint = tag['Value']
+
+    return ImageEntry(
+        region,
+        image['ImageId'],
+        image['Name'],
+        parse_datetime(image['CreationDate']),
+        instance_id,
+        instance_name,
+        image_snapshot_ids(image),
+        image['State'],
+        fingerprint
+    )
+
+
+def is_snapshot_set(image_id):
+    """
+    Check if a backup id is a snapshot set rather than an AMI
+    """
+    return image_id.startswith(SNAPSHOT_SET_PREFIX)
+
+
+def snapshot_set_state(states):
+    """
+    State of a snapshot set, in AMI terms, from the states of its snapshots
+    """
+    if not states or 'error' in states:
+        return 'failed'
+    if 'pending' in states:
+        return 'pending'
+    return 'available'
+
+
+def backup_states(region, backups):
+    """
+    Look up the state of some backups (AMIs + snapshot sets), in bulk, returning {image_id: (state, snapshot_ids)}
+
+    AMIs go 200 per "describe_images" call, the snapshots of every set 200
+    per "describe_snapshots" call. AMIs EC2 no longer lists are left out.
+    """
+    ec2 = aws_client('ec2', region)
+    states = {}
+
+    image_ids = [backup['image_id'] for backup in backups if not is_snapshot_set(backup['image_id'])]
+    for i in range(0, len(image_ids), 200):
+        found = ec2.describe_images(
+            Filters=[{
+                'Name': 'image-id',
+                'Values': image_ids[i:i + 200]
+            }],
+            Owners=['self']
+        )
+        for image in found['Images']:
+            states[image['ImageId']] = (image['State'], image_snapshot_ids(image))
+
+    #  Snapshot sets are done once every snapshot is
+    sets = [backup for backup in backups if is_snapshot_set(backup['image_id'])]
+    snapshot_ids = [snapshot_id for backup in sets for snapshot_id in backup['snapshot_ids']]
+    snapshot_states = {}
+    for i in range(0, len(snapshot_ids), 200):
+        found = ec2.describe_snapshots(
+            SnapshotIds=snapshot_ids[i:i + 200],
+            OwnerIds=['self']
+        )
+        for snapshot in found['Snapshots']:
+            snapshot_states[snapshot['SnapshotId']] = snapshot['State']
+    for backup in sets:
+        states[backup['image_id']] = (
+            snapshot_set_state([snapshot_states.get(snapshot_id, 'error') for snapshot_id in backup['snapshot_ids']]),
+            backup['snapshot_ids']
+        )
+    return states
+
+
+def automation_snapshots(region, filters=()):
+    """
+    Yield raw automation snapshots in a region (AMI snapshots + snapshot sets), optionally further filtered
+    """
+    paginator = aws_client('ec2', region).get_paginator('describe_snapshots')
+    pages = paginator.paginate(
+        Filters=[
+            {
+                'Name': 'tag:CreatedBy',
+                'Values': ['ami-automation']
+            }
+        ] + list(filters),
+        OwnerIds=['self']
+    )
+    for page in pages:
+        for snapshot in page['Snapshots']:
+            yield snapshot
+
+
+def snapshot_sets(region, states=('available',), creation_dates=None, snapshots=None):
+    """
+    Yield automation snapshot sets in a region as image entries, optionally only those matching
+    "creation-date" style wildcards (matched here, snapshots can't be filtered by them)
+
+    snapshots: raw automation snapshots already listed, instead of listing them here
+    """
+    if creation_dates is not None and not creation_dates:
+        return
+    if snapshots is None:
+        snapshots = automation_snapshots(region, [{'Name': 'tag-key', 'Values': ['backup_set']}])
+    sets = {}
+    for snapshot in snapshots:
+        set_id = tag_value(snapshot.get('Tags'), 'backup_set')
+        if not set_id:
+            continue
+        if set_id not in sets:
+            sets[set_id] = ImageEntry(
+                region,
+                set_id,
+                tag_value(snapshot['Tags'], 'backup_name', set_id),
+                snapshot['StartTime'],
+                tag_value(snapshot['Tags'], 'instance_id'),
+                tag_value(snapshot['Tags'], 'instance_name', ''),
+                [],
+                [],
+                tag_value(snapshot['Tags'], 'instance_fingerprint')
+            )
+        entry = sets[set_id]
+        entry.image_create_dt = min(entry.image_create_dt, snapshot['StartTime'])
+        entry.snapshot_ids.append(snapshot['SnapshotId'])
+        entry.state.append(snapshot['State'])
+
+    for entry in sets.values():
+        entry.state = snapshot_set_state(entry.state)
+        if states is not None and entry.state not in states:
+            continue
+        if creation_dates is not None:
+            created = entry.image_create_dt.astimezone(UTC).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            if not any(fnmatch.fnmatchcase(created, pattern) for pattern in creation_dates):
+                continue
+        yield entry
+
+
+def image_snapshot_ids(image):
+    """
+    Get the EBS snapshot ids behind a raw AMI
+    """
+    return [
+        bdm['Ebs']['SnapshotId']
+        for bdm in image.get('BlockDeviceMappings', [])
+        if 'Ebs' in bdm and bdm['Ebs'].get('SnapshotId')
+    ]
+
+
+def date_prefixes(first_day, last_day):
+    """
+    Shortest list of "creation-date" filter wildcards covering every day in a range
+
+    Whole years become 'YYYY-*', whole months 'YYYY-MM-*', other days 'YYYY-MM-DD*'.
+    """
+    prefixes = []
+    day = first_day
+    while day <= last_day:
+        next_year = datetime.date(day.year + 1, 1, 1)
+        next_month = datetime.date(day.year + day.month // 12, day.month % 12 + 1, 1)
+        if day.month == 1 and day.day == 1 and next_year - datetime.timedelta(days=1) <= last_day:
+            prefixes.append(day.strftime('%Y-*'))
+            day = next_year
+        elif day.day == 1 and next_month - datetime.timedelta(days=1) <= last_day:
+            prefixes.append(day.strftime('%Y-%m-*'))
+            day = next_month
+        else:
+            prefixes.append(day.strftime('%Y-%m-%d*'))
+            day += datetime.timedelta(days=1)
+    return prefixes
+
+
+def automation_images(region, states=('available',), creation_dates=None):
+    """
+    Yield automation AMIs in a region (in any state if states is None),
+    optionally only those matching "creation-date" wildcards
+    """
+    filters = [
+        {
+            'Name': 'tag:CreatedBy',
+            'Values': ['ami-automation']
+        }
+    ]
+    if states is not None:
+        filters.append({
+            'Name': 'state',
+            'Values': list(states)
+        })
+    if creation_dates is not None:
+        if not creation_dates:
+            return
+        filters.append({
+            'Name': 'creation-date',
+            'Values': list(creation_dates)
+        })
+    paginator = aws_client('ec2', region).get_paginator('describe_images')
+    for page in paginator.paginate(Filters=filters, Owners=['self']):
+        for image in page['Images']:
+            yield image
+
+
+def automation_backups(region, states=('available',), creation_dates=None):
+    """
+    Yield every automation backup in a region as image entries: AMIs, then snapshot sets
+    """
+    for image in automation_images(region, states, creation_dates):
+        yield image_entry(region, image)
+    for entry in snapshot_sets(region, states, creation_dates):
+        yield entry
+
+
+def image_index(region):
+    """
+    Index available automation backups (AMIs + snapshot sets) in a region by instance id, newest first
+    """
+    index = {}
+    for entry in automation_backups(region):
+        if entry['instance_id']:
+            index.setdefault(entry['instance_id'], []).append(entry)
+
+    #  Sort each AMI list by "creation date" descending (most recent backup, first)
+    for instance_ami_list in index.values():
+        instance_ami_list.sort(key=lambda k: k['image_create_dt'], reverse=True)
+
+    return index
+
+
+class RegionInventory(object):
+    """
+    One listing of a region's tagged instances and AMIs, shared by reconcile stages
+
+    Every AMI the account owns is listed once, for both the available
+    automation backups (by instance id, newest first) and which AMIs use
+    each snapshot. Stages fold what the run did back in (see apply), so later
+    stages see backups taken or pruned earlier in the run without listing again.
+
+    snapshots: also list every automation snapshot (for snapshot sets and the
+    orphan sweep in one go), keeping those no AMI uses in unreferenced
+    """
+
+    def __init__(self, region, snapshots=False):
+        self.region = region
+        self.instances = list(iter_instances(region))
+        self.backups = {}
+        self.referenced = {}
+        self.unreferenced = None
+
+        paginator = aws_client('ec2', region).get_paginator('describe_images')
+        for page in paginator.paginate(Owners=['self']):
+            for image in page['Images']:
+                if image['State'] == 'deregistered':
+                    continue
+                for snapshot_id in image_snapshot_ids(image):
+                    self.referenced.setdefault(snapshot_id, set()).add(image['ImageId'])
+                if image['State'] == 'available' and tag_value(image.get('Tags'), 'CreatedBy') == 'ami-automation':
+                    entry = image_entry(region, image)
+                    if entry['instance_id']:
+                        self.backups.setdefault(entry['instance_id'], []).append(entry)
+        set_snapshots = None
+        if snapshots:
+            set_snapshots, self.unreferenced = [], []
+            for snapshot in automation_snapshots(region):
+                if tag_value(snapshot.get('Tags'), 'backup_set'):
+                    set_snapshots.append(snapshot)
+                elif snapshot['SnapshotId'] not in self.referenced:
+                    self.unreferenced.append(snapshot)
+        for entry in snapshot_sets(region, snapshots=set_snapshots):
+            if entry['instance_id']:
+                self.backups.setdefault(entry['instance_id'], []).append(entry)
+
+        for instance_ami_list in self.backups.values():
+            instance_ami_list.sort(key=lambda k: k['image_create_dt'], reverse=True)
+
+    def newest_backups(self, instance_ids):
+        """
+        Newest backup of some instances, by instance id (like ami_create.newest_backups)
+        """
+        newest = {}
+        for instance_id in instance_ids:
+            backups = self.backups.get(instance_id)
+            if backups:
+                newest[instance_id] = {
+                    "image_id": backups[0]['image_id'],
+                    "image_name": backups[0]['image_name'],
+                    "create_dt": backups[0]['image_create_dt'],
+                    "fingerprint": backups[0].get('fingerprint')
+                }
+        return newest
+
+    def created_before(self, date):
+        """
+        Backups created before a date, for any instance
+        """
+        return [
+            entry
+            for backups in self.backups.values()
+            for entry in backups
+            if entry['image_create_dt'] < date
+        ]
+
+    def apply(self, run):
+        """
+        Fold the backups this run created and deleted in the region into the inventory
+        """
+        for i in run.image_status_list:
+            if i['region'] != self.region or not i['is_success'] or not i['image_id'] or not i['instance_id']:
+                continue
+            backups = self.backups.setdefault(i['instance_id'], [])
+            known = [entry for entry in backups if entry['image_id'] == i['image_id']]
+            if i['action'] == 'CREATE' and not known:
+                backups.insert(0, ImageEntry(
+                    self.region, i['image_id'], i['image_name'], i['create_dt'], i['instance_id'],
+                    i['instance_name'], [], 'available'
+                ))
+            elif i['action'] == 'DELETE' and known:
+                backups.remove(known[0])
+        return
+
+
+def retention_tiers():
+    """
+    Retention tiers in effect, oldest tier last
+    """
+    return sorted(RETENTION_TIERS) or [(RETENTION_DAYS, 0)]
+
+
+def retention_horizon_days():
+    """
+    Age (days) past which no backup is kept
+    """
+    return retention_tiers()[-1][0]
+
+
+def retention_keep_all_days():
+    """
+    Age (days) below which every backup is kept
+    """
+    days, every_hours = retention_tiers()[0]
+    return days if not every_hours else 0
+
+
+class BackupPolicy(object):
+    """
+    Backup schedule + retention of an instance, compiled once per policy tag value
+    """
+
+    __slots__ = ('backup_hours', 'grace_hours', 'tiers')
+
+    def __init__(self, backup_hours=None, grace_hours=None, keep_days=None):
+        self.backup_hours = backup_hours or BACKUP_HOURS
+        self.grace_hours = grace_hours if grace_hours is not None else BACKUP_HOURS_GRACE - BACKUP_HOURS
+        self.tiers = [(keep_days, 0)] if keep_days else retention_tiers()
+
+    def horizon_days(self):
+        """
+        Age (days) past which no backup is kept
+        """
+        return self.tiers[-1][0]
+
+    def keep_all_days(self):
+        """
+        Age (days) below which every backup is kept
+        """
+        days, every_hours = self.tiers[0]
+        return days if not every_hours else 0
+
+    def recent_date(self, now):
+        """
+        Creation date the newest backup must be past, else monitor alerts
+        """
+        return now - datetime.timedelta(hours=self.backup_hours + self.grace_hours)
+
+    def expired_date(self, now):
+        """
+        Creation date backups older than should have been pruned, else monitor alerts
+        """
+        return now - datetime.timedelta(days=self.horizon_days() + RETENTION_DAYS_GRACE - RETENTION_DAYS)
+
+    def is_default(self):
+        return (self.backup_hours, self.grace_hours, self.tiers) == (
+            BACKUP_HOURS, BACKUP_HOURS_GRACE - BACKUP_HOURS, retention_tiers())
+
+
+def policy_hours(value, unit):
+    """
+    Parse a policy duration such as "12h", "30d", "2w" or "6" (in unit) into hours
+    """
+    units = {'h': 1, 'd': 24, 'w': 24 * 7}
+    value = value.strip().lower()
+    if value and value[-1] in units:
+        unit, value = value[-1], value[:-1]
+    hours = float(value) * units[unit]
+    if hours < 0:
+        raise ValueError('negative duration')
+    return hours
+
+
+def parse_policy(value):
+    """
+    Compile a policy tag value ("every=12h keep=30d grace=6h") into a BackupPolicy
+    """
+    fields = {}
+    for item in value.replace(',', ' ').replace(';', ' ').split():
+        key, _, amount = item.partition('=')
+        key = key.strip().lower()
+        try:
+            if key == 'every':
+                fields['backup_hours'] = policy_hours(amount, 'h') or None
+            elif key == 'keep':
+                fields['keep_days'] = policy_hours(amount, 'd') / 24.0 or None
+            elif key == 'grace':
+                fields['grace_hours'] = policy_hours(amount, 'h')
+            else:
+                raise ValueError('unknown setting')
+        except (ValueError, KeyError):
+            logger.warning('Ignoring [%s] in backup policy [%s]' % (item, value))
+    return BackupPolicy(**fields)
+
+
+def backup_policy(tags):
+    """
+    Get an instance's compiled backup policy from its tags, parsing each policy tag value only once
+    """
+    value = tag_value(tags, TAG_POLICY_KEY, '').strip()
+    policy = policy_cache.get(value)
+    if policy is None:
+        policy = policy_cache[value] = parse_policy(value)
+    return policy
+
+
+def retention_plan(now, instance_ami_list, tiers):
+    """
+    Split one instance's AMIs (newest first) into keep and delete lists
+
+    Each AMI falls in the first tier its age fits in. Within a thinned tier,
+    AMIs share a bucket when they fall in the same "every N hours" slot of
+    wall-clock time, and only the newest one in each bucket is kept. Buckets
+    are fixed in time, so the same AMIs are kept from one run to the next.
+    """
+    keep = []
+    delete = []
+    buckets = set()
+    tier = 0
+    for ami in instance_ami_list:
+        age = now - ami['image_create_dt']
+        while tier < len(tiers) and age > datetime.timedelta(days=tiers[tier][0]):
+            tier += 1
+        if tier == len(tiers):
+            #  Older than every tier
+            delete.append(ami)
+            continue
+        every_hours = tiers[tier][1]
+        if not every_hours:
+            keep.append(ami)
+            continue
+        bucket = (tier, int(calendar.timegm(ami['image_create_dt'].utctimetuple()) // (every_hours * 3600)))
+        if bucket in buckets:
+            delete.append(ami)
+        else:
+            buckets.add(bucket)
+            keep.append(ami)
+    return keep, delete
+
+
+def retention_deletes(run, region, images, policies=None):
+    """
+    Group a region's AMIs by instance and return the ones the retention tiers no longer keep
+
+    policies: backup policy by instance id (instances without one use the default tiers)
+    """
+    default_tiers = retention_tiers()
+    policies = policies or {}
+    by_instance = {}
+    for image in images:
+        by_instance.setdefault(image['instance_id'], []).append(image)
+
+    kept = 0
+    deletes = []
+    for instance_id, instance_ami_list in by_instance.items():
+        instance_ami_list.sort(key=lambda k: k['image_create_dt'], reverse=True)
+        policy = policies.get(instance_id)
+        keep, delete = retention_plan(run.today, instance_ami_list, policy.tiers if policy else default_tiers)
+        kept += len(keep)
+        deletes.extend(delete)
+
+    run.variables_add(
+        var_title='Retention plan %s' % (region),
+        var_value='%d kept, %d to delete' % (kept, len(deletes))
+    )
+    return deletes
+
+
+def run_parallel(func, items, workers, stop=None):
+    """
+    Call func for every item using a bounded pool of worker threads
+
+    Items are pulled from the iterable only as workers free up, so
+    generators stay lazy. A failing item is logged and does not stop
+    the rest. Returns False if stop() asked to stop before every item
+    was taken on (items already started are finished first). The first
+    item for each worker is always taken on, so every call gets some
+    work done however late it starts.
+    """
+    workers = max(1, int(workers))
+    slots = threading.BoundedSemaphore(workers * 2)
+    stopped = []
+
+    def throttled():
+        for taken, item in enumerate(items):
+            slots.acquire()
+            if stop and taken >= workers and stop():
+                slots.release()
+                stopped.append(item)
+                break
+            yield item
+
+    def call(item):
+        try:
+            func(item)
+        except Exception as e:
+            logger.error('ERR! Unhandled error processing [%s]' % (item,))
+            logger.exception(e)
+        finally:
+            slots.release()
+
+    pool = ThreadPool(processes=workers)
+    try:
+        for _ in pool.imap_unordered(call, throttled()):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+    return not stopped
+
+
+def format_duration(seconds):
+    """
+    Format a number of seconds as e.g. "1h02m", "4m10s" or "35s"
+    """
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%ds' % (seconds)
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a sorted list of numbers
+    """
+    rank = max(int(math.ceil(fraction * len(values))), 1)
+    return values[rank - 1]
+
+
+def report_buckets(image_status_list):
+    """
+    Group status records by (action, result) in a single pass
+    """
+    buckets = {}
+    for i in image_status_list:
+        is_success = i['is_success'] if i['action'] in ('CREATE', 'DELETE', 'RECOVERED', 'SKIP') else False
+        buckets.setdefault((i['action'], is_success), []).append(i)
+    return buckets
+
+
+def report_table(heading, items):
+    """
+    Format a list of status records as a text table
+    """
+    lines = []
+    lines.append(heading)
+    lines.append('-' * 120)
+    lines.append(
+        '{:14} | '.format('REGION') +
+        '{:21} | '.format('INSTANCE') +
+        '{:21} | '.format('AMI ID') +
+        '{:25} | '.format('TIMESTAMP') +
+        '{:60}   '.format('COMPLETED')
+    )
+    lines.append('-' * 120)
+    for x in items:
+        lines.append(
+            '{:14} | '.format(x['region']) +
+            '{:21} | '.format(x['instance_name']) +
+            '{:21} | '.format(x['image_id'] or '-') +
+            '{:25} | '.format(x['create_dt'].isoformat() if x['create_dt'] else '-') +
+            '{:60}   '.format(
+                str(x['is_success']) if x.get('duration') is None
+                else '%s (%s)' % (x['is_success'], format_duration(x['duration'])))
+        )
+    lines.append('-' * 120)
+    lines.append('{:>14} | Items(s)'.format(len(items)))
+    lines.append('')
+    lines.append('')
+    return lines
+
+
+def report_parts(header, lines, part_bytes):
+    """
+    Split report lines into ordered parts, each with the header and under part_bytes
+    """
+    header_size = sum(len(line.encode('utf-8')) + 1 for line in header)
+    parts = []
+    part = []
+    size = header_size
+    for line in lines:
+        line_size = len(line.encode('utf-8')) + 1
+        if part and size + line_size > part_bytes:
+            parts.append(part)
+            part = []
+            size = header_size
+        part.append(line)
+        size += line_size
+    parts.append(part)
+    return ["\n".join(header + part) for part in parts]
+
+
+def send_via_email(run, script_file, title, buckets):
     """
     Format report with AMI/image status
     """
-    if image_status_list:
+    items = sum(len(bucket) for bucket in buckets.values())
+    if items:
 
-        #  Get current AWS region
-        sess = boto3.session.Session()
+        #  AWS region(s) covered by this run
+        accounts = set(split_region(region)[0] for region in run.regions)
+        if len(run.regions) == 1:
+            region_name = run.regions[0]
+        elif None not in accounts:
+            region_name = '%d regions in %d accounts' % (len(run.regions), len(accounts))
+        else:
+            region_name = '%d regions' % (len(run.regions))
 
         #  Header
         report_msg = []
         report_msg.append('-' * 40)
         report_msg.append('AMI-AUTOMATION STATUS REPORT')
         report_msg.append('-' * 40)
-        report_msg.append('{:13} : '.format('AWS REGION') + '{:16}'.format(sess.region_name))
-        report_msg.append('{:13} : '.format('DATE-TIME') + '{:16}'.format(today.isoformat()))
-        report_msg.append('{:13} : '.format('ITEMS') + '{0}'.format(len(image_status_list)))
+        report_msg.append('{:13} : '.format('AWS REGION') + '{:16}'.format(', '.join(run.regions)))
+        report_msg.append('{:13} : '.format('DATE-TIME') + '{:16}'.format(run.today.isoformat()))
+        report_msg.append('{:13} : '.format('ITEMS') + '{0}'.format(items))
         report_msg.append('{:13} : '.format('TITLE') + '{:16}'.format(title))
         report_msg.append('{:13} : '.format('SCRIPT') + '{:16}'.format(script_file))
         report_msg.append('-' * 40)
 
         #  Add custom variables
-        if variables_list:
-            for var in variables_list:
+        if run.variables_list:
+            for var in run.variables_list:
                 report_msg.append('{:13} : '.format(var['var_title']) + '{:16}'.format(var['var_value']))
             report_msg.append('-' * 40)
 
         report_msg.append('')
         report_msg.append('')
 
-        if create_success_list:
-            report_msg.append('Backups taken (Pass):')
-            report_msg.append('-' * 120)
-            report_msg.append(
-                '{:21} | '.format('INSTANCE') +
-                '{:21} | '.format('AMI ID') +
-                '{:25} | '.format('TIMESTAMP') +
-                '{:60}   '.format('COMPLETED')
-            )
-            report_msg.append('-' * 120)
-            for x in create_success_list:
-                report_msg.append(
-                    '{:21} | '.format(x['instance_name']) +
-                    '{:21} | '.format(x['image_id']) +
-                    '{:25} | '.format(x['create_dt'].isoformat()) +
-                    '{:60}   '.format(str(x['is_success']))
-                )
-            report_msg.append('-' * 120)
-            report_msg.append('{:>21} | Items(s)'.format(len(create_success_list)))
-            report_msg.append('')
-            report_msg.append('')
-
-        if create_failure_list:
-            report_msg.append('Backups NOT taken (Fail):')
-            report_msg.append('-' * 120)
-            report_msg.append(
-                '{:21} | '.format('INSTANCE') +
-                '{:21} | '.format('AMI ID') +
-                '{:25} | '.format('TIMESTAMP') +
-                '{:60}   '.format('COMPLETED')
-            )
-            report_msg.append('-' * 120)
-            for x in create_failure_list:
-                report_msg.append(
-                    '{:21} | '.format(x['instance_name']) +
-                    '{:21} | '.format(x['image_id']) +
-                    '{:25} | '.format(x['create_dt'].isoformat()) +
-                    '{:60}   '.format(str(x['is_success']))
-                )
-            report_msg.append('-' * 120)
-            report_msg.append('{:>21} | Items(s)'.format(len(create_failure_list)))
-            report_msg.append('')
-            report_msg.append('')
-
-        if delete_success_list:
-            report_msg.append('Expired backups deleted (Pass):')
-            report_msg.append('-' * 120)
-            report_msg.append(
-                '{:21} | '.format('INSTANCE') +
-                '{:21} | '.format('AMI ID') +
-                '{:25} | '.format('TIMESTAMP') +
-                '{:60}   '.format('COMPLETED')
-            )
-            report_msg.append('-' * 120)
-            for x in delete_success_list:
-                report_msg.append(
-                    '{:21} | '.format(x['instance_name']) +
-                    '{:21} | '.format(x['image_id']) +
-                    '{:25} | '.format(x['create_dt'].isoformat()) +
-                    '{:60}   '.format(str(x['is_success']))
-                )
-            report_msg.append('-' * 120)
-            report_msg.append('{:>21} | Items(s)'.format(len(delete_success_list)))
-            report_msg.append('')
-            report_msg.append('')
-
-        if delete_failure_list:
-            report_msg.append('Expired backups NOT deleted (Fail):')
-            report_msg.append('-' * 120)
-            report_msg.append(
-                '{:21} | '.format('INSTANCE') +
-                '{:21} | '.format('AMI ID') +
-                '{:25} | '.format('TIMESTAMP') +
-                '{:60}   '.format('COMPLETED')
-            )
-            report_msg.append('-' * 120)
-            for x in delete_failure_list:
-                report_msg.append(
-                    '{:21} | '.format(x['instance_name']) +
-                    '{:21} | '.format(x['image_id']) +
-                    '{:25} | '.format(x['create_dt'].isoformat()) +
-                    '{:60}   '.format(str(x['is_success']))
-                )
-            report_msg.append('-' * 120)
-            report_msg.append('{:>21} | Items(s)'.format(len(delete_failure_list)))
-            report_msg.append('')
-            report_msg.append('')
-
-        if missing_backup_list:
-            report_msg.append('Server(s) with NO backups (Fail):')
-            report_msg.append('-' * 120)
-            report_msg.append(
-                '{:21} | '.format('INSTANCE') +
-                '{:21} | '.format('AMI ID') +
-                '{:25} | '.format('TIMESTAMP') +
-                '{:60}   '.format('COMPLETED')
-            )
-            report_msg.append('-' * 120)
-            for x in missing_backup_list:
-                report_msg.append(
-                    '{:21} | '.format(x['instance_name']) +
-                    '{:21} | '.format(x['image_id']) +
-                    '{:25} | '.format(x['create_dt'].isoformat()) +
-                    '{:60}   '.format(str(x['is_success']))
-                )
-            report_msg.append('-' * 120)
-            report_msg.append('{:>21} | Items(s)'.format(len(missing_backup_list)))
-            report_msg.append('')
-            report_msg.append('')
-
-        if expired_backup_list:
-            report_msg.append('Expired backups left behind (Fail):')
-            report_msg.append('-' * 120)
-            report_msg.append(
-                '{:21} | '.format('INSTANCE') +
-                '{:21} | '.format('AMI ID') +
-                '{:25} | '.format('TIMESTAMP') +
-                '{:60}   '.format('COMPLETED')
-            )
-            report_msg.append('-' * 120)
-            for x in expired_backup_list:
-                report_msg.append(
-                    '{:21} | '.format(x['instance_name']) +
-                    '{:21} | '.format(x['image_id']) +
-                    '{:25} | '.format(x['create_dt'].isoformat()) +
-                    '{:60}   '.format(str(x['is_success']))
-                )
-            report_msg.append('-' * 120)
-            report_msg.append('{:>21} | Items(s)'.format(len(expired_backup_list)))
-            report_msg.append('')
-            report_msg.append('')
-
-        if no_recent_backup_list:
-            report_msg.append('Server(s) missing recent backups taken (Fail):')
-            report_msg.append('-' * 120)
-            report_msg.append(
-                '{:21} | '.format('INSTANCE') +
-                '{:21} | '.format('AMI ID') +
-                '{:25} | '.format('TIMESTAMP') +
-                '{:60}   '.format('COMPLETED')
-            )
-            report_msg.append('-' * 120)
-            for x in no_recent_backup_list:
-                report_msg.append(
-                    '{:21} | '.format(x['instance_name']) +
-                    '{:21} | '.format(x['image_id']) +
-                    '{:25} | '.format(x['create_dt'].isoformat()) +
-                    '{:60}   '.format(str(x['is_success']))
-                )
-            report_msg.append('-' * 120)
-            report_msg.append('{:>21} | Items(s)'.format(len(no_recent_backup_list)))
-            report_msg.append('')
-            report_msg.append('')
+        #  One table per non-empty section
+        report_lines = []
+        for bucket, heading in REPORT_SECTIONS:
+            if buckets.get(bucket):
+                report_lines.extend(report_table(heading, buckets[bucket]))
+
+        #  Split into parts that fit in a single SNS message
+        messages = report_parts(report_msg, report_lines, REPORT_PART_BYTES)
+        if len(messages) > REPORT_MAX_PARTS:
+            #  Too big to email, send item counts and leave the details in the logs
+            logger.info("\n".join(report_msg + report_lines))
+            summary = ['Report too large to send (%d parts), item counts only:' % (len(messages)), '']
+            for bucket, heading in REPORT_SECTIONS:
+                if buckets.get(bucket):
+                    summary.append('{:>21} | {}'.format(len(buckets[bucket]), heading))
+            messages = ["\n".join(report_msg + summary)]
 
         #  Send report via SNS notification
-        sns.publish(
-            TopicArn=ARN_TOPIC_ALERT,
-            Subject="AMI Automation - Status Report [%s] @ [%s]" % (sess.region_name, today.strftime('%Y-%m-%d %H:%M %Z')),
-            Message="\n".join(report_msg))
+        subject = "AMI Automation - Status Report [%s] @ [%s]" % (region_name, run.today.strftime('%Y-%m-%d %H:%M %Z'))
+        for count, message in enumerate(messages, 1):
+            aws_client('sns', ARN_TOPIC_ALERT.split(':')[3]).publish(
+                TopicArn=ARN_TOPIC_ALERT,
+                Subject=subject if len(messages) == 1 else '%s (%d/%d)' % (subject, count, len(messages)),
+                Message=message)
     else:
         logger.info('Woo-hoo! No errors reported!')
 
     return
 
 
-def generate_report(script_file, title='', email_report=False):
+def status_record(i):
+    """
+    Pack a status record into a JSON-friendly list
+    """
+    return [
+        i['region'], i['instance_id'], i['instance_name'], i['image_id'], i['image_name'],
+        i['create_dt'].isoformat() if i['create_dt'] else None, i['action'], i['is_success'], i['duration']
+    ]
+
+
+def status_unpack(record):
+    """
+    Rebuild a status record packed by status_record()
+    """
+    region, instance_id, instance_name, image_id, image_name, create_dt, action, is_success, duration = record
+    return {
+        "region": region,
+        "instance_id": instance_id,
+        "instance_name": instance_name,
+        "image_id": image_id,
+        "image_name": image_name,
+        "create_dt": parse_datetime(create_dt) if create_dt else None,
+        "action": action,
+        "is_success": is_success,
+        "duration": duration
+    }
+
+
+def status_failed(i):
+    """
+    Check if a status record needs attention (failures, pending backups, checks)
+    """
+    return i['action'] not in ('CREATE', 'DELETE', 'SKIP') or i['is_success'] is not True
+
+
+def alert_family(action):
+    """
+    Group actions by the lambda function reporting them (CREATE_PENDING goes with CREATE, ...)
+    """
+    return action.split('_')[0]
+
+
+class AlertState(object):
+    """
+    Ongoing failures per instance + action, kept on the catalog to only report changes
+
+    Stored as one catalog item per instance + action, grouped per action family
+    and region ('alerts:CREATE:us-east-1', ...), so lambda functions never write
+    over each other's state and an outage of any size fits. A failure clears
+    once the same instance succeeds at the same family of actions, or, for
+    actions a run checks on every instance (the monitor's), once the run no
+    longer finds it. Failures not seen for longer than the retention period
+    (e.g. of terminated instances) are dropped.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def load(self, family, region):
+        return self.catalog.meta_items('alerts:%s:%s' % (family, region))
+
+    def update(self, run, complete_actions=()):
+        """
+        Fold a run's status records in, returning its (new, cleared, ongoing) status records
+        """
+        failing = {}
+        passed = set()
+        for i in run.image_status_list:
+            family = alert_family(i['action'])
+            if status_failed(i):
+                key = '%s|%s' % (i['instance_id'], i['action'])
+                failing.setdefault((family, i['region']), {}).setdefault(key, []).append(i)
+            else:
+                passed.add((family, i['region'], i['instance_id']))
+
+        #  Families + regions this run can tell anything about
+        complete = set(
+            (alert_family(action), region)
+            for action in complete_actions
+            for region in run.regions
+            if run.region_finished(region)
+        )
+        scopes = set(failing).union(complete).union((family, region) for family, region, _ in passed)
+
+        stale = run.today - datetime.timedelta(days=retention_horizon_days())
+        new, cleared, ongoing = [], [], []
+        for family, region in sorted(scopes):
+            state = self.load(family, region)
+            current = failing.get((family, region), {})
+
+            gone = []
+            for key in sorted(state):
+                if key in current:
+                    continue
+                record = status_unpack(state[key]['status'])
+                if ((family, region) in complete and record['action'] in complete_actions) or \
+                        (family, region, record['instance_id']) in passed:
+                    gone.append(key)
+                    record.update(action='RECOVERED', is_success=True, image_name=record['action'])
+                    cleared.append(record)
+                elif parse_datetime(state[key]['seen']) < stale:
+                    gone.append(key)
+
+            for key, records in current.items():
+                if key in state:
+                    ongoing.extend(records)
+                else:
+                    new.extend(records)
+                    state[key] = {'since': run.today.isoformat()}
+                state[key]['seen'] = run.today.isoformat()
+                state[key]['status'] = status_record(records[0])
+
+            self.catalog.delete_meta_items('alerts:%s:%s' % (family, region), gone)
+            self.catalog.put_meta_items(
+                'alerts:%s:%s' % (family, region), dict((key, state[key]) for key in current))
+        return new, cleared, ongoing
+
+    def ongoing(self, regions, skip_families):
+        """
+        Every ongoing failure in some regions, except for some families of actions
+        """
+        records = []
+        for family in sorted(set(alert_family(bucket[0]) for bucket, _ in REPORT_SECTIONS)):
+            if family in skip_families or family == 'RECOVERED':
+                continue
+            for region in regions:
+                state = self.load(family, region)
+                records.extend(status_unpack(state[key]['status']) for key in sorted(state))
+        return records
+
+
+def outbox_batches(catalog):
+    """
+    Alerts queued by lambda functions that don't email, as (function, batch) pairs
+
+    Each batch lists the catalog items it was stored in ("items"), ALERT_QUEUE_CHUNK status records each.
+    """
+    batches = []
+    for function_name in ALERT_SOURCES:
+        by_id = {}
+        for name, chunk in sorted(catalog.meta_items('outbox:%s' % (function_name)).items()):
+            batch = by_id.get(chunk['id'])
+            if not batch:
+                batch = by_id[chunk['id']] = {'id': chunk['id'], 'queued': chunk['queued'], 'statuses': [], 'items': []}
+                batches.append((function_name, batch))
+            batch['statuses'].extend(chunk['statuses'])
+            batch['items'].append(name)
+    return batches
+
+
+def outbox_add(run, function_name, statuses):
+    """
+    Queue a run's alerts for the next report sent
+    """
+    batch_id = '%s@%s' % (function_name, run.today.isoformat())
+    records = [status_record(i) for i in statuses]
+    run.catalog.put_meta_items('outbox:%s' % (function_name), dict(
+        ('%s#%05d' % (batch_id, i // ALERT_QUEUE_CHUNK), {
+            'id': batch_id,
+            'queued': run.today.isoformat(),
+            'statuses': records[i:i + ALERT_QUEUE_CHUNK]
+        })
+        for i in range(0, len(records), ALERT_QUEUE_CHUNK)
+    ))
+    return
+
+
+def outbox_clear(catalog, sent):
+    """
+    Drop sent batches, keeping any queued since they were read
+    """
+    for function_name in set(function_name for function_name, _ in sent):
+        catalog.delete_meta_items(
+            'outbox:%s' % (function_name),
+            [name for sender, batch in sent if sender == function_name for name in batch['items']]
+        )
+    return
+
+
+def report_alerts(run, script_file, title, email_report, complete_actions):
+    """
+    Report only what changed since the last report, batching alerts from several lambda functions
+
+    A run that emails (the monitor) sends its changes along with every queued batch,
+    and a digest of all ongoing failures every ALERT_DIGEST_HOURS. Other runs queue
+    their changes, sending the queue themselves once it has waited ALERT_BATCH_HOURS.
+    """
+    function_name = os.path.splitext(os.path.basename(script_file))[0]
+    alerts = AlertState(run.catalog)
+    new, cleared, ongoing = alerts.update(run, complete_actions)
+    run.variables_add(
+        var_title='Alerts',
+        var_value='%d new, %d cleared, %d ongoing' % (len(new), len(cleared), len(ongoing))
+    )
+
+    #  Digest: everything, as a report without a catalog would have it
+    digest = False
+    if email_report:
+        last = run.catalog.get_meta('digested')
+        digest = bool(run.setting('digest')) or not last or \
+            parse_datetime(last) <= run.today - datetime.timedelta(hours=ALERT_DIGEST_HOURS)
+
+    batches = outbox_batches(run.catalog)
+    batch_due = run.today - datetime.timedelta(hours=ALERT_BATCH_HOURS)
+    due = email_report or any(parse_datetime(batch['queued']) <= batch_due for _, batch in batches)
+
+    if not due:
+        if new or cleared:
+            outbox_add(run, function_name, new + cleared)
+            logger.info('Great Success! Queued %d alert(s) for the next report' % (len(new) + len(cleared)))
+        return
+
+    statuses = list(run.image_status_list if digest else new) + cleared
+    extra = []
+    if digest:
+        families = set(alert_family(i['action']) for i in run.image_status_list)
+        extra.extend(alerts.ongoing(run.regions, families))
+    for name, batch in batches:
+        extra.extend(status_unpack(record) for record in batch['statuses'])
+
+    #  Ongoing + queued alerts only add what this run has not reported on the same instance + action
+    seen = set((i['region'], i['instance_id'], i['action']) for i in statuses)
+    for i in extra:
+        key = (i['region'], i['instance_id'], i['action'])
+        if key not in seen:
+            seen.add(key)
+            statuses.append(i)
+    if batches:
+        counts = {}
+        for name, batch in batches:
+            counts[name] = counts.get(name, 0) + len(batch['statuses'])
+        run.variables_add(
+            var_title='Queued alerts',
+            var_value=', '.join('%s: %d' % (name, counts[name]) for name in sorted(counts))
+        )
+
+    if statuses:
+        send_via_email(run, script_file, '%s (digest)' % (title) if digest else title, report_buckets(statuses))
+    else:
+        logger.info('Woo-hoo! No alert changes to report!')
+
+    #  The report is out, a batch left queued is only sent again
+    try:
+        outbox_clear(run.catalog, batches)
+        if digest:
+            run.catalog.put_meta('digested', run.today.isoformat())
+    except Exception as e:
+        logger.error('ERR! Unable to clear sent alerts from the catalog')
+        logger.exception(e)
+    return
+
+
+def generate_report(run, script_file, title='', email_report=False, complete_actions=()):
     """
     Generate report on errors
+
+    complete_actions: actions the run checked on every instance of its regions
     """
 
-    #  Global lists
-    global create_success_list, create_failure_list
-    global delete_success_list, delete_failure_list
-    global missing_backup_list, expired_backup_list, no_recent_backup_list
+    #  With a catalog to remember what was already reported, only send changes
+    if run.catalog and ALERT_DIGEST_HOURS:
+        try:
+            report_alerts(run, script_file, title, email_report, complete_actions)
+            return
+        except Exception as e:
+            #  Alerts could be neither compared nor queued, send everything this run found
+            logger.error('ERR! Unable to keep alert state on the catalog, sending the full report')
+            logger.exception(e)
+            email_report = True
 
-    if image_status_list:
+    if run.image_status_list:
         #
-        #  Create lists with different status
+        #  Group records with different status
         #
-        create_success_list = [
-            i
-            for i in image_status_list
-            if i['action'] == 'CREATE' and i['is_success'] is True
-        ]
-        create_failure_list = [
-            i
-            for i in image_status_list
-            if i['action'] == 'CREATE' and i['is_success'] is False
-        ]
-        delete_success_list = [
-            i
-            for i in image_status_list
-            if i['action'] == 'DELETE' and i['is_success'] is True
-        ]
-        delete_failure_list = [
-            i
-            for i in image_status_list
-            if i['action'] == 'DELETE' and i['is_success'] is False
-        ]
-        missing_backup_list = [
-            i
-            for i in image_status_list
-            if i['action'] == 'CHECK_MISSING'
-        ]
-        expired_backup_list = [
-            i
-            for i in image_status_list
-            if i['action'] == 'CHECK_EXPIRED'
-        ]
-        no_recent_backup_list = [
-            i
-            for i in image_status_list
-            if i['action'] == 'CHECK_RECENT'
-        ]
+        buckets = report_buckets(run.image_status_list)
 
         #
         #  Determine message alert level:
@@ -336,16 +1853,8 @@ def generate_report(script_file, title='', email_report=False):
         #  - warning/yellow: some errors
         #  - danger/red: all errors
         #
-        has_success = [
-            i
-            for i in image_status_list
-            if i['is_success'] is True
-        ]
-        has_failures = [
-            i
-            for i in image_status_list
-            if i['is_success'] is False
-        ]
+        has_success = any(bucket[1] is True for bucket in buckets)
+        has_failures = any(bucket[1] is False for bucket in buckets)
         if has_success and not has_failures:
             msg_status = 'good'
         elif not has_success and has_failures:
@@ -355,8 +1864,109 @@ def generate_report(script_file, title='', email_report=False):
 
         #  Send email report
         if email_report:
-            send_via_email(script_file, title)
+            send_via_email(run, script_file, title, buckets)
     else:
         logger.info('Woo-hoo! No AMI errors reported!')
 
     return
+
+
+def report_compact(run, budget):
+    """
+    Pack a run's report to hand to its next invocation
+
+    Failures go first; status records past the byte budget are only counted.
+    """
+    statuses = sorted(run.image_status_list, key=lambda i: i['is_success'] is True)
+    earlier = run.resume.get('report', {})
+    counts = dict(earlier.get('counts', {}))
+    records = []
+    size = 0
+    for i in statuses:
+        record = status_record(i)
+        size += len(json.dumps(record)) + 2
+        if size <= budget:
+            records.append(record)
+        else:
+            key = '%s %s' % (i['action'], 'pass' if i['is_success'] else 'fail')
+            counts[key] = counts.get(key, 0) + 1
+    return {
+        'statuses': records,
+        'counts': counts,
+        'variables': [[v['var_title'], v['var_value']] for v in run.variables_list]
+    }
+
+
+def report_restore(run, report):
+    """
+    Load the report handed over by an earlier invocation of the run
+    """
+    for record in report.get('statuses', []):
+        run.image_status_add(**status_unpack(record))
+    for var_title, var_value in report.get('variables', []):
+        run.variables_add(var_title, var_value)
+    return
+
+
+def continue_run(run):
+    """
+    Hand the rest of a run to a new invocation of the lambda function, if this one stopped early
+
+    Returns True if it did, the last invocation of a run sends the report.
+    """
+    unfinished = sorted(region for region, cursor in run.cursors.items() if not cursor.get('finished'))
+
+    if unfinished and run.part < RESUME_MAX_PARTS and hasattr(run.context, 'function_name'):
+        #  Regions finished by this or earlier invocations are skipped by the next one
+        regions = dict(run.resume.get('regions', {}))
+        regions.update(run.cursors)
+
+        event = dict(run.event) if isinstance(run.event, dict) else {}
+        event['resume'] = {
+            'today': run.today.isoformat(),
+            'part': run.part + 1,
+            'regions': regions,
+            'report': report_compact(run, 0)
+        }
+        budget = RESUME_EVENT_BYTES - len(json.dumps(event))
+        event['resume']['report'] = report_compact(run, budget)
+        try:
+            if budget < 0:
+                raise ValueError('Resume event over %d bytes without any status records' % (RESUME_EVENT_BYTES))
+            aws_client('lambda').invoke(
+                FunctionName=run.context.function_name,
+                InvocationType='Event',
+                Payload=json.dumps(event)
+            )
+            logger.info('Great Success! Handed regions [%s] to invocation %d of the run' %
+                        (', '.join(unfinished), run.part + 1))
+            return True
+        except Exception as e:
+            logger.error('ERR! Unable to hand regions [%s] to a new invocation' % (', '.join(unfinished)))
+            logger.exception(e)
+
+    #  Last invocation: report on whatever the run got done
+    if unfinished:
+        logger.error('ERR! Run stopped before finishing regions [%s] after %d invocation(s)' %
+                     (', '.join(unfinished), run.part))
+        run.variables_add(var_title='Unfinished regions', var_value=', '.join(unfinished))
+    if run.part > 1:
+        run.variables_add(var_title='Invocations', var_value=str(run.part))
+        counts = run.resume.get('report', {}).get('counts')
+        if counts:
+            run.variables_add(
+                var_title='Not listed (earlier invocations)',
+                var_value=', '.join('%s: %d' % (key, counts[key]) for key in sorted(counts))
+            )
+    return False
+
+
+def emit_metrics(run, script_file):
+    """
+    Print the invocation's API call metrics as one CloudWatch embedded metric format record
+    """
+    if not METRICS_EMF:
+        return
+    function_name = os.path.splitext(os.path.basename(script_file))[0]
+    print(json.dumps(run.metrics.emf_record(function_name), sort_keys=True))
+    return
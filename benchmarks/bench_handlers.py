@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+"""
+ Benchmark the create, prune and monitor lambda functions against a synthetic fleet
+
+ No AWS account is needed: the "ec2", "sns", "lambda" and "sts" clients cached by ami_shared
+ are replaced by the in-process fakes in fake_aws.py. With --accounts, every
+ account gets a fleet of its own, reached thru a role the fake STS hands
+ credentials for. For every fleet size
+ the three handlers run one after another (like the schedule would), or
+ the reconcile handler runs once in their place (--reconcile). Each one
+ reports wall time, API calls (per operation), throttled attempts and peak
+ traced memory.
+
+    python benchmarks/bench_handlers.py --sizes 100 1000 10000
+    python benchmarks/bench_handlers.py --sizes 5000 --latency-ms 20 --throttle-rate 0.05
+    python benchmarks/bench_handlers.py --sizes 50000 --catalog --no-memory --json results.json
+    python benchmarks/bench_handlers.py --sizes 1000 10000 --reconcile
+    python benchmarks/bench_handlers.py --sizes 1000 --accounts 20 --latency-ms 20 --role-seconds 310
+"""
+
+#  General libraries
+import argparse
+import importlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ami_shared
+import ami_catalog
+from fake_aws import FakeContext, FakeEC2, FakeLambda, FakeSNS, FakeSTS
+
+#  Handlers, in the order they run on the schedule
+HANDLERS = ['ami-create-backups', 'ami-prune-backups', 'ami-monitor-backups']
+
+#  Handlers that create images (only the first shard of the fleet)
+CREATE_HANDLERS = ['ami-create-backups', 'ami-reconcile-backups']
+
+REGION = 'us-east-1'
+
+
+def load_handler(name):
+    """
+    Import a lambda function module from its (hyphenated) file name
+    """
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(ROOT, '%s.py' % (name)))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def account_roles(args):
+    """
+    Roles to assume in each fake account (none without --accounts)
+    """
+    return ['arn:aws:iam::%012d:role/ami-backup-buddy' % (100000000000 + i) for i in range(args.accounts)]
+
+
+def install_fakes(args, size):
+    """
+    Build a synthetic fleet (per account) and swap the fakes in for the real clients
+
+    Returns the fake EC2 of every account, then the fake SNS, STS and lambda clients.
+    """
+    options = dict(latency_ms=args.latency_ms, throttle_rate=args.throttle_rate, seed=args.seed)
+    regions = ['%s/%s' % (role_arn.split(':')[4], REGION) for role_arn in account_roles(args)] or [REGION]
+    ec2s = []
+    for i, region in enumerate(regions):
+        ec2 = FakeEC2(region=REGION, pending_seconds=args.pending_seconds, **dict(options, seed=args.seed + i))
+        ec2.add_fleet(size, args.history_days, args.backup_hours, stopped_ratio=args.stopped_ratio,
+                      orphan_ratio=args.orphan_ratio, shared_ratio=args.shared_ratio,
+                      snapshot_ratio=args.snapshot_ratio)
+        ec2s.append(ec2)
+    sns = FakeSNS(**options)
+    sts = FakeSTS(max_seconds=args.role_seconds, **options)
+    lam = FakeLambda(**options)
+
+    with ami_shared.clients_lock:
+        ami_shared.clients.clear()
+        ami_shared.client_access_keys.clear()
+        ami_shared.role_credentials_cache.clear()
+        for region, ec2 in zip(regions, ec2s):
+            ami_shared.clients[('ec2', region)] = ec2
+        ami_shared.clients[('sns', ami_shared.ARN_TOPIC_ALERT.split(':')[3])] = sns
+        ami_shared.clients[('sts', None)] = sts
+        ami_shared.clients[('lambda', None)] = lam
+    return ec2s, sns, sts, lam
+
+
+def run_handler(module, fakes, event, trace_memory, work_seconds=None):
+    """
+    Run one handler, returning its wall time, API calls and peak memory
+
+    With work_seconds, every invocation gets that long before it has to
+    hand over, and the invocations it queues are run until the run is done.
+    """
+    lam = fakes[-1]
+    before = [(dict(fake.calls), dict(fake.throttles)) for fake in fakes]
+    if trace_memory:
+        tracemalloc.start()
+
+    def context():
+        if not work_seconds:
+            return None
+        return FakeContext(module.__name__, work_seconds + ami_shared.RESUME_MARGIN_SECONDS)
+
+    started = time.time()
+    module.lambda_handler(event, context())
+    invocations = 1
+    while lam.invocations:
+        _, payload = lam.invocations.pop(0)
+        module.lambda_handler(payload, context())
+        invocations += 1
+    elapsed = time.time() - started
+
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    calls, throttles = {}, {}
+    for fake, (calls_before, throttles_before) in zip(fakes, before):
+        for operation, count in fake.calls.items():
+            if count - calls_before.get(operation, 0):
+                calls[operation] = calls.get(operation, 0) + count - calls_before.get(operation, 0)
+        for operation, count in fake.throttles.items():
+            if count - throttles_before.get(operation, 0):
+                throttles[operation] = throttles.get(operation, 0) + count - throttles_before.get(operation, 0)
+
+    return {
+        'invocations': invocations,
+        'seconds': round(elapsed, 3),
+        'calls': calls,
+        'throttles': throttles,
+        'peak_bytes': peak
+    }
+
+
+def bench_size(args, size, modules):
+    """
+    Run every handler once against a fresh fleet of a given size
+    """
+    fakes = install_fakes(args, size)
+    ec2s = fakes[0]
+    results = {
+        'size': size,
+        'images': sum(len(ec2.images) for ec2 in ec2s),
+        'handlers': {}
+    }
+
+    #  A fresh catalog per fleet, built by the first reconcile
+    workdir = None
+    if args.catalog:
+        workdir = tempfile.mkdtemp(prefix='ami-bench-')
+        ami_catalog.CATALOG_URI = 'sqlite://%s' % (os.path.join(workdir, 'catalog.db'))
+        ami_catalog.catalogs.clear()
+
+    event = {'regions': [REGION], 'wait_minutes': args.wait_minutes, 'poll_seconds': args.poll_seconds}
+    if args.accounts:
+        event['accounts'] = account_roles(args)
+    if args.incremental:
+        event['incremental'] = True
+
+    try:
+        for name in modules:
+            #  Create only images the first shard (all of the fleet by default)
+            handler_event = dict(event, shards=args.shards, shard=0) if name in CREATE_HANDLERS else event
+            results['handlers'][name] = run_handler(
+                modules[name], tuple(ec2s) + fakes[1:], handler_event, not args.no_memory, args.work_seconds)
+    finally:
+        if workdir:
+            ami_catalog.CATALOG_URI = ''
+            ami_catalog.catalogs.clear()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results['images_after'] = sum(len(ec2.images) for ec2 in ec2s)
+    return results
+
+
+def print_results(results):
+    """
+    Print one table row per size/handler, followed by the API calls it made
+    """
+    print('{:>8} | {:>9} | {:<21} | {:>9} | {:>7} | {:>9} | {:>9}'.format(
+        'FLEET', 'AMIS', 'HANDLER', 'WALL (s)', 'CALLS', 'THROTTLED', 'PEAK MiB'))
+    print('-' * 91)
+    for result in results:
+        for name, handler in result['handlers'].items():
+            peak = '-' if handler['peak_bytes'] is None else '%.1f' % (handler['peak_bytes'] / 1048576.0)
+            print('{:>8} | {:>9} | {:<21} | {:>9.3f} | {:>7} | {:>9} | {:>9}'.format(
+                result['size'], result['images'], name, handler['seconds'],
+                sum(handler['calls'].values()), sum(handler['throttles'].values()), peak))
+            print('{:>8}   {:>9}   {}'.format(
+                '', '', ', '.join('%s=%s' % (op, count) for op, count in sorted(handler['calls'].items()))))
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the AMI lambda functions against a fake EC2')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000],
+                        help='fleet sizes (instances) to run, e.g. 100 1000 50000')
+    parser.add_argument('--history-days', type=int, default=ami_shared.RETENTION_DAYS + 2,
+                        help='days of AMI history per instance')
+    parser.add_argument('--backup-hours', type=int, default=ami_shared.BACKUP_HOURS,
+                        help='hours between historical backups')
+    parser.add_argument('--stopped-ratio', type=float, default=0.0,
+                        help='share of instances that are stopped')
+    parser.add_argument('--orphan-ratio', type=float, default=0.0,
+                        help='share of instances with a snapshot left behind by an earlier prune')
+    parser.add_argument('--shared-ratio', type=float, default=0.0,
+                        help='share of instances whose oldest backup\'s snapshots another AMI also uses')
+    parser.add_argument('--snapshot-ratio', type=float, default=0.0,
+                        help='share of instances backed-up as snapshot sets instead of AMIs')
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='latency added to every API call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='chance of an API attempt being throttled (and retried)')
+    parser.add_argument('--pending-seconds', type=float, default=0,
+                        help='seconds new AMIs stay pending')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='split the fleet into this many shards, create only images the first')
+    parser.add_argument('--wait-minutes', type=float, default=ami_shared.CREATE_WAIT_MINUTES,
+                        help='how long create waits for pending AMIs')
+    parser.add_argument('--poll-seconds', type=float, default=1,
+                        help='how often create checks on pending AMIs')
+    parser.add_argument('--work-seconds', type=float, default=None,
+                        help='seconds each invocation gets before it must hand the rest of the run over')
+    parser.add_argument('--catalog', action='store_true',
+                        help='use a (temporary) SQLite catalog')
+    parser.add_argument('--incremental', action='store_true',
+                        help='run the monitor incrementally (needs --catalog)')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='run the reconcile handler instead of create, prune and monitor')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip tracemalloc, which slows the handlers down')
+    parser.add_argument('--accounts', type=int, default=0,
+                        help='spread the run over this many accounts (each with a fleet of the given size)')
+    parser.add_argument('--role-seconds', type=float, default=None,
+                        help='how long the fake STS credentials last (over ASSUME_ROLE_REFRESH_SECONDS)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results as JSON')
+    parser.add_argument('--verbose', action='store_true',
+                        help='keep the handlers\' INFO logging and metric records')
+    args = parser.parse_args()
+
+    #  ami_shared turns on INFO logging + metric records for lambda, which would swamp the timings
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        ami_shared.METRICS_EMF = False
+
+    handlers = ['ami-reconcile-backups'] if args.reconcile else HANDLERS
+    modules = dict((name, load_handler(name)) for name in handlers)
+    results = []
+    for size in args.sizes:
+        results.append(bench_size(args, size, modules))
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': vars(args), 'results': results}, f, indent=2, sort_keys=True)
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""
+ Benchmark turning raw AMIs into the records prune and monitor work with
+
+ Compares, on a synthetic describe_images result:
+ - dict: a dict per AMI with dateutil parsing every "CreationDate" (the old image_entry)
+ - slots: ami_shared.image_entry (slotted ImageEntry + fixed-format timestamp slicing)
+ Each one reports CPU time per AMI (median of --repeat runs) and the memory
+ held by the resulting list of records.
+
+    python benchmarks/bench_records.py
+    python benchmarks/bench_records.py --count 500000 --repeat 3 --json records.json
+"""
+
+#  General libraries
+import argparse
+import datetime
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import dateutil.parser
+import ami_shared
+
+
+def dict_entry(region, image):
+    """
+    Normalize a raw AMI the way image_entry used to
+    """
+    return {
+        "region": region,
+        "image_id": image['ImageId'],
+        "image_name": image['Name'],
+        "image_create_dt": dateutil.parser.parse(image['CreationDate']),
+        "instance_id": ami_shared.tag_value(image.get('Tags'), 'instance_id'),
+        "instance_name": ami_shared.tag_value(image.get('Tags'), 'instance_name', ''),
+        "snapshot_ids": ami_shared.image_snapshot_ids(image),
+        "state": image['State'],
+        "fingerprint": ami_shared.tag_value(image.get('Tags'), 'instance_fingerprint')
+    }
+
+
+#  Ways of building records, by name
+BUILDERS = [
+    ('dict', dict_entry),
+    ('slots', ami_shared.image_entry)
+]
+
+
+def raw_images(count):
+    """
+    Synthetic describe_images output, shaped like the automation AMIs
+    """
+    started = datetime.datetime(2026, 1, 1)
+    images = []
+    for i in range(count):
+        created = started + datetime.timedelta(seconds=i * 37, milliseconds=i % 1000)
+        instance_id = 'i-%017x' % (i // 10)
+        images.append({
+            'ImageId': 'ami-%017x' % (i),
+            'Name': 'server%05d-%s' % (i // 10, created.strftime('%Y%m%d%H%M')),
+            'CreationDate': created.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (created.microsecond // 1000),
+            'State': 'available',
+            'BlockDeviceMappings': [
+                {'DeviceName': '/dev/xvda', 'Ebs': {'SnapshotId': 'snap-%017x' % (i)}}
+            ],
+            'Tags': [
+                {'Key': 'CreatedBy', 'Value': 'ami-automation'},
+                {'Key': 'instance_id', 'Value': instance_id},
+                {'Key': 'instance_name', 'Value': 'server%05d' % (i // 10)}
+            ]
+        })
+    return images
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def bench(builder, images, repeat):
+    """
+    CPU time to build every record, and the memory the records hold on to
+    """
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.process_time()
+        records = [builder('us-east-1', image) for image in images]
+        timings.append(time.process_time() - started)
+        del records
+
+    gc.collect()
+    tracemalloc.start()
+    records = [builder('us-east-1', image) for image in images]
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return {
+        'cpu_seconds': round(median(timings), 4),
+        'us_per_ami': round(median(timings) / len(images) * 1e6, 2),
+        'held_bytes': held,
+        'bytes_per_ami': held // len(images)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark building AMI records from describe_images output')
+    parser.add_argument('--count', type=int, default=100000,
+                        help='AMIs in the synthetic describe_images result')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed runs per builder (the median is reported)')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results as JSON')
+    args = parser.parse_args()
+
+    images = raw_images(args.count)
+
+    #  Both builders have to agree before they are compared
+    for image in images[:1000]:
+        if dict(ami_shared.image_entry('us-east-1', image)) != dict_entry('us-east-1', image):
+            raise SystemExit('image_entry disagrees with the dict builder on %s' % (image['ImageId']))
+
+    results = {}
+    print('{:<8} | {:>9} | {:>10} | {:>10} | {:>9}'.format('RECORDS', 'CPU (s)', 'US / AMI', 'HELD MiB', 'B / AMI'))
+    print('-' * 58)
+    for name, builder in BUILDERS:
+        results[name] = bench(builder, images, args.repeat)
+        print('{:<8} | {:>9.3f} | {:>10.2f} | {:>10.1f} | {:>9}'.format(
+            name, results[name]['cpu_seconds'], results[name]['us_per_ami'],
+            results[name]['held_bytes'] / 1048576.0, results[name]['bytes_per_ami']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'count': args.count, 'repeat': args.repeat, 'results': results}, f, indent=2, sort_keys=True)
+    return
+
+
+if __name__ == "__main__":
+    main()
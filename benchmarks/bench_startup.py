@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""
+ Benchmark cold start of the create, prune, monitor and reconcile lambda functions
+
+ Every sample runs in a fresh interpreter, like a new lambda container,
+ and measures:
+ - import: loading the handler module (and everything it imports)
+ - init: what a handler does before its first API call (RunContext + clients)
+ - total: wall time of the whole process, interpreter start included
+ - cpu: CPU time of the whole process, steadier than wall time on a busy box
+ No API call is made; credentials come from dummy environment variables,
+ the way lambda hands them out.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 20 --root /path/to/other/checkout
+"""
+
+#  General libraries
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#  Handlers and the clients each one creates up front
+HANDLERS = [
+    ('ami-create-backups', ['ec2']),
+    ('ami-prune-backups', ['ec2']),
+    ('ami-monitor-backups', ['ec2', 'sns']),
+    ('ami-reconcile-backups', ['ec2', 'sns'])
+]
+
+#  Runs inside the fresh interpreter, prints its timings as JSON
+PROBE = '''
+import importlib.util, json, sys, time
+sys.path.insert(0, %(root)r)
+started = time.time()
+spec = importlib.util.spec_from_file_location('handler', %(path)r)
+handler = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(handler)
+imported = time.time()
+run = handler.RunContext({}, None)
+for service in %(services)r:
+    if hasattr(handler, 'aws_client'):
+        handler.aws_client(service, run.regions[0])
+    else:
+        getattr(handler, service)
+done = time.time()
+print(json.dumps({'import': imported - started, 'init': done - imported}))
+'''
+
+
+def sample(root, name, services):
+    """
+    Time one cold start of a handler in a new interpreter
+    """
+    env = dict(os.environ)
+    env.update({
+        'AWS_REGION': 'us-east-1',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'AKIDBENCHMARK',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'AWS_EC2_METADATA_DISABLED': 'true',
+        'PYTHONDONTWRITEBYTECODE': '1'
+    })
+    code = PROBE % {'root': root, 'path': os.path.join(root, '%s.py' % (name)), 'services': services}
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.time()
+    output = subprocess.check_output([sys.executable, '-c', code], env=env, cwd=root)
+    total = time.time() - started
+    used = resource.getrusage(resource.RUSAGE_CHILDREN)
+    timings = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    timings['total'] = total
+    timings['cpu'] = (used.ru_utime - usage.ru_utime) + (used.ru_stime - usage.ru_stime)
+    return timings
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cold start of the AMI lambda functions')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='cold starts per handler (the median is reported)')
+    parser.add_argument('--root', default=ROOT,
+                        help='checkout holding the lambda functions (to compare revisions)')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results as JSON')
+    args = parser.parse_args()
+    root = os.path.abspath(args.root)
+
+    results = {}
+    print('{:<21} | {:>11} | {:>11} | {:>11} | {:>11}'.format(
+        'HANDLER', 'IMPORT (ms)', 'INIT (ms)', 'TOTAL (ms)', 'CPU (ms)'))
+    print('-' * 77)
+    for name, services in HANDLERS:
+        samples = [sample(root, name, services) for _ in range(args.repeat)]
+        results[name] = dict(
+            (key, round(median([s[key] for s in samples]) * 1000, 1)) for key in ('import', 'init', 'total', 'cpu')
+        )
+        print('{:<21} | {:>11.1f} | {:>11.1f} | {:>11.1f} | {:>11.1f}'.format(
+            name, results[name]['import'], results[name]['init'], results[name]['total'], results[name]['cpu']))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'root': root, 'repeat': args.repeat, 'results': results}, f, indent=2, sort_keys=True)
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,575 @@
+# -*- coding: utf-8 -*-
+
+"""
+ In-process stand-ins for the boto3 "ec2", "sns", "lambda" and "sts" clients used by the lambda functions
+
+ Only the calls + filters the lambda functions use are implemented. Each
+ call can be slowed down by a fixed latency and throttled at random, with
+ throttled calls retried the way botocore does (and reported in
+ ResponseMetadata.RetryAttempts) until they run out of attempts.
+"""
+
+#  General libraries
+import datetime
+import fnmatch
+import itertools
+import json
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from dateutil.tz import tzutc
+
+#  Page sizes used by EC2 when paginating
+PAGE_SIZE = 1000
+
+#  SNS message + asynchronous lambda invocation size limits (bytes)
+SNS_MAX_BYTES = 256 * 1024
+INVOKE_ASYNC_MAX_BYTES = 256 * 1024
+
+
+class FakeService(object):
+    """
+    Call counting, latency and throttling shared by the fake clients
+    """
+
+    def __init__(self, latency_ms=0, throttle_rate=0.0, max_attempts=5, seed=0):
+        self.latency = latency_ms / 1000.0
+        self.throttle_rate = throttle_rate
+        self.max_attempts = max_attempts
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.throttles = {}
+
+    def _call(self, operation):
+        """
+        Account for one API call, returning its ResponseMetadata
+        """
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        for attempt in range(self.max_attempts):
+            if self.latency:
+                time.sleep(self.latency)
+            with self.lock:
+                throttled = self.random.random() < self.throttle_rate
+                if throttled:
+                    self.throttles[operation] = self.throttles.get(operation, 0) + 1
+            if not throttled:
+                return {'RetryAttempts': attempt}
+        raise ClientError(
+            {
+                'Error': {'Code': 'RequestLimitExceeded', 'Message': 'Request limit exceeded.'},
+                'ResponseMetadata': {'RetryAttempts': self.max_attempts - 1}
+            },
+            operation
+        )
+
+
+class FakePaginator(object):
+    """
+    Paginator over a fake client call returning all results at once
+    """
+
+    def __init__(self, client, operation, key):
+        self.client = client
+        self.operation = operation
+        self.key = key
+
+    def paginate(self, **kwargs):
+        kwargs.pop('PaginationConfig', None)
+        token = None
+        while True:
+            page = getattr(self.client, self.operation)(NextToken=token, **kwargs)
+            yield page
+            token = page.get('NextToken')
+            if not token:
+                break
+
+
+class FakeEC2(FakeService):
+    """
+    Fake EC2 client holding a synthetic fleet and its AMI history
+
+    AMIs are kept as compact tuples and only turned into boto3-shaped
+    dicts when returned, so large fleets fit in memory. New AMIs (and
+    snapshot sets) stay pending for pending_seconds, give or take 50%.
+    """
+
+    def __init__(self, region='us-east-1', pending_seconds=0, **kwargs):
+        super(FakeEC2, self).__init__(**kwargs)
+        self.region = region
+        self.pending_seconds = pending_seconds
+        self.ids = itertools.count(1)
+        self.instances = []
+        self.instances_by_id = {}
+        #  image_id -> [image_id, instance_id, name, creation_date, state, snapshot_ids, ready_at, automation,
+        #              tags (None: the fleet's own)]
+        self.images = {}
+        self.images_by_instance = {}
+        self.pending = set()
+        #  snapshot_id -> [creation_date, instance_id, image_id it was created for, tagged, image_ids using it,
+        #                 tags (None: the ones CreateImage gives), ready_at]
+        self.snapshots = {}
+        #  Results of paginated queries still being read, by query id
+        self.queries = {}
+
+    #  Fleet generation
+    def add_fleet(self, count, history_days, backup_hours, now=None, stopped_ratio=0.0, orphan_ratio=0.0,
+                  shared_ratio=0.0, snapshot_ratio=0.0):
+        """
+        Add tagged instances, each with a backup every backup_hours for history_days
+
+        orphan_ratio of the instances also get a snapshot left behind by a
+        deregistered AMI, and shared_ratio get an extra (non automation) AMI
+        registered from the snapshots of their oldest backup. snapshot_ratio
+        of the instances are backed-up as snapshot sets instead of AMIs.
+        """
+        now = now or datetime.datetime.utcnow()
+        for i in range(count):
+            instance_id = 'i-%017x' % (next(self.ids))
+            state = 'stopped' if self.random.random() < stopped_ratio else 'running'
+            snapshot_mode = self.random.random() < snapshot_ratio
+            self.instances.append({
+                'InstanceId': instance_id,
+                'InstanceType': 't3.medium',
+                'KeyName': 'ops',
+                'State': {'Name': state},
+                'StateTransitionReason': 'User initiated (%s GMT)' % (now.strftime('%Y-%m-%d %H:%M:%S'))
+                                         if state == 'stopped' else '',
+                'Placement': {'AvailabilityZone': '%sa' % (self.region)},
+                'SecurityGroups': [{'GroupId': 'sg-%08x' % (i % 50)}],
+                'BlockDeviceMappings': [
+                    {'DeviceName': '/dev/xvda', 'Ebs': {'VolumeId': 'vol-%017x' % (next(self.ids))}},
+                    {'DeviceName': '/dev/xvdb', 'Ebs': {'VolumeId': 'vol-%017x' % (next(self.ids))}}
+                ],
+                'Tags': [
+                    {'Key': 'Name', 'Value': 'prod: server%05d.example.com' % (i)},
+                    {'Key': 'AMIBackup', 'Value': 'yes'}
+                ] + ([{'Key': 'AMIBackupMode', 'Value': 'snapshots'}] if snapshot_mode else [])
+            })
+            self.instances_by_id[instance_id] = self.instances[-1]
+            #  Stagger backups so instances don't all share timestamps
+            offset = datetime.timedelta(minutes=self.random.randint(0, backup_hours * 60 - 1))
+            created = now - offset
+            oldest = None
+            while created > now - datetime.timedelta(days=history_days):
+                if snapshot_mode:
+                    self._add_snapshot_set(instance_id, 'server%05d' % (i), created)
+                else:
+                    oldest = self._add_image(instance_id, 'server%05d' % (i), created, 'available')
+                created -= datetime.timedelta(hours=backup_hours)
+
+            if self.random.random() < orphan_ratio:
+                orphan = self._add_image(instance_id, 'server%05d' % (i), created, 'available')
+                self._remove_image(orphan)
+            if oldest and self.random.random() < shared_ratio:
+                self._add_image(None, 'copy-of-server%05d' % (i), now, 'available',
+                                snapshot_ids=self.images[oldest][5], automation=False)
+        return
+
+    def _add_image(self, instance_id, instance_name, created, state, ready_at=0, snapshot_ids=None, automation=True,
+                   tag_snapshots=True):
+        image_id = 'ami-%017x' % (next(self.ids))
+        name = '%s_%s' % (instance_name, created.strftime('%Y-%m-%dT%H-%M-%S'))
+        creation_date = created.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        if snapshot_ids is None:
+            snapshot_ids = ('snap-%017x' % (next(self.ids)), 'snap-%017x' % (next(self.ids)))
+            for snapshot_id in snapshot_ids:
+                self.snapshots[snapshot_id] = [creation_date, instance_id, image_id, tag_snapshots, [], None, 0]
+        for snapshot_id in snapshot_ids:
+            self.snapshots[snapshot_id][4].append(image_id)
+        self.images[image_id] = [
+            image_id, instance_id, name, creation_date, state, snapshot_ids, ready_at, automation, None
+        ]
+        if automation:
+            self.images_by_instance.setdefault(instance_id, set()).add(image_id)
+        if state == 'pending':
+            self.pending.add(image_id)
+        return image_id
+
+    def _add_snapshot_set(self, instance_id, instance_name, created, tags=None, exclude_boot=False, ready_at=0):
+        """
+        Snapshot every EBS volume of an instance at once, like CreateSnapshots
+        """
+        if tags is None:
+            name = '%s_%s' % (instance_name, created.strftime('%Y-%m-%dT%H-%M-%S'))
+            tags = [
+                {'Key': 'instance_id', 'Value': instance_id},
+                {'Key': 'instance_name', 'Value': instance_name},
+                {'Key': 'CreatedBy', 'Value': 'ami-automation'},
+                {'Key': 'backup_set', 'Value': 'snapset-%s-%s' % (instance_id, created.strftime('%Y-%m-%dT%H-%M-%S'))},
+                {'Key': 'backup_name', 'Value': name}
+            ]
+        creation_date = created.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        volumes = self.instances_by_id[instance_id]['BlockDeviceMappings'][1 if exclude_boot else 0:]
+        snapshot_ids = []
+        for _ in volumes:
+            snapshot_id = 'snap-%017x' % (next(self.ids))
+            self.snapshots[snapshot_id] = [creation_date, instance_id, None, True, [], tags, ready_at]
+            snapshot_ids.append(snapshot_id)
+        return snapshot_ids
+
+    def _remove_image(self, image_id):
+        image = self.images.pop(image_id)
+        self.images_by_instance.get(image[1], set()).discard(image_id)
+        self.pending.discard(image_id)
+        for snapshot_id in image[5]:
+            self.snapshots[snapshot_id][4].remove(image_id)
+        return image
+
+    @staticmethod
+    def _image_tags(image):
+        if image[8] is not None:
+            return image[8]
+        if not image[7]:
+            return [{'Key': 'Name', 'Value': image[2]}]
+        return [
+            {'Key': 'instance_id', 'Value': image[1]},
+            {'Key': 'instance_name', 'Value': image[2].split('_')[0]},
+            {'Key': 'CreatedBy', 'Value': 'ami-automation'}
+        ]
+
+    def _image_dict(self, image):
+        image_id, instance_id, name, creation_date, state, snapshot_ids, ready_at, automation, tags = image
+        return {
+            'ImageId': image_id,
+            'Name': name,
+            'State': state,
+            'CreationDate': creation_date,
+            'BlockDeviceMappings': [
+                {'DeviceName': '/dev/xvd%s' % (chr(97 + i)), 'Ebs': {'SnapshotId': snapshot_id}}
+                for i, snapshot_id in enumerate(snapshot_ids)
+            ],
+            'Tags': self._image_tags(image)
+        }
+
+    def _snapshot_tags(self, snapshot_id):
+        creation_date, instance_id, image_id, tagged, users, tags, ready_at = self.snapshots[snapshot_id]
+        if tags is not None or not tagged:
+            return tags or []
+        return [
+            {'Key': 'instance_id', 'Value': instance_id},
+            {'Key': 'CreatedBy', 'Value': 'ami-automation'}
+        ]
+
+    def _snapshot_dict(self, snapshot_id):
+        creation_date, instance_id, image_id, tagged, users, tags, ready_at = self.snapshots[snapshot_id]
+        snapshot = {
+            'SnapshotId': snapshot_id,
+            'StartTime': datetime.datetime.strptime(creation_date, '%Y-%m-%dT%H:%M:%S.000Z').replace(tzinfo=tzutc()),
+            'State': 'pending' if ready_at > time.time() else 'completed',
+            'Description': (
+                'Created by CreateImage(%s) for %s' % (instance_id, image_id) if image_id
+                else 'Automated backup for [%s]' % (instance_id)
+            )
+        }
+        if tagged:
+            snapshot['Tags'] = self._snapshot_tags(snapshot_id)
+        return snapshot
+
+    def _refresh_states(self):
+        now = time.time()
+        with self.lock:
+            for image_id in list(self.pending):
+                image = self.images.get(image_id)
+                if not image or image[6] <= now:
+                    self.pending.discard(image_id)
+                    if image:
+                        image[4] = 'available'
+        return
+
+    def _page(self, query, token, key, metadata):
+        """
+        Return one page of a query, running the query only for its first page
+
+        Like EC2's, a token can be used again (e.g. by a resumed invocation re-reading its page).
+        """
+        if token:
+            query_id, start = token.split(':')
+            items, start = self.queries[query_id], int(start)
+        else:
+            query_id, items, start = str(next(self.ids)), query(), 0
+        page = {key: items[start:start + PAGE_SIZE], 'ResponseMetadata': metadata}
+        if start + PAGE_SIZE < len(items):
+            self.queries[query_id] = items
+            page['NextToken'] = '%s:%d' % (query_id, start + PAGE_SIZE)
+        return page
+
+    @staticmethod
+    def _matches(value, patterns):
+        for pattern in patterns:
+            if pattern == value or (pattern.endswith('*') and '*' not in pattern[:-1] and value.startswith(pattern[:-1])):
+                return True
+            if '*' in pattern[:-1] and fnmatch.fnmatchcase(value, pattern):
+                return True
+        return False
+
+    def get_paginator(self, operation):
+        return FakePaginator(self, operation, {
+            'describe_instances': 'Reservations',
+            'describe_images': 'Images',
+            'describe_snapshots': 'Snapshots'
+        }[operation])
+
+    #  API calls
+    def describe_instances(self, Filters=None, NextToken=None, **kwargs):
+        metadata = self._call('describe_instances')
+
+        def query():
+            instances = self.instances
+            for flt in Filters or []:
+                if flt.get('Name', '').startswith('tag:'):
+                    key = flt['Name'][4:]
+                    instances = [
+                        i for i in instances
+                        if any(t['Key'] == key and t['Value'] in flt['Values'] for t in i['Tags'])
+                    ]
+                elif flt.get('Name') == 'instance-id':
+                    instances = [i for i in instances if i['InstanceId'] in flt['Values']]
+            return [{'Instances': [i]} for i in instances]
+
+        return self._page(query, NextToken, 'Reservations', metadata)
+
+    def describe_images(self, Filters=None, ImageIds=None, Owners=None, NextToken=None, **kwargs):
+        metadata = self._call('describe_images')
+        if not NextToken:
+            self._refresh_states()
+        page = self._page(lambda: self._find_images(Filters, ImageIds), NextToken, 'Images', metadata)
+        page['Images'] = [self._image_dict(image) for image in page['Images']]
+        return page
+
+    def _find_images(self, Filters, ImageIds):
+        if ImageIds:
+            missing = [image_id for image_id in ImageIds if image_id not in self.images]
+            if missing:
+                raise ClientError(
+                    {'Error': {'Code': 'InvalidAMIID.NotFound', 'Message': 'The image id %s does not exist' % missing}},
+                    'DescribeImages'
+                )
+            candidates = [self.images[image_id] for image_id in ImageIds]
+        else:
+            candidates = None
+            for flt in Filters or []:
+                if flt.get('Name') == 'tag:instance_id':
+                    candidates = [
+                        self.images[image_id]
+                        for instance_id in flt['Values']
+                        for image_id in self.images_by_instance.get(instance_id, ())
+                    ]
+                elif flt.get('Name') == 'image-id':
+                    candidates = [self.images[image_id] for image_id in flt['Values'] if image_id in self.images]
+                elif flt.get('Name') == 'block-device-mapping.snapshot-id':
+                    image_ids = set(
+                        image_id
+                        for snapshot_id in flt['Values'] if snapshot_id in self.snapshots
+                        for image_id in self.snapshots[snapshot_id][4]
+                    )
+                    candidates = [self.images[image_id] for image_id in image_ids]
+            if candidates is None:
+                candidates = list(self.images.values())
+
+        #  Filters without a "Name" are ignored, like unknown keys in a lenient client
+        for flt in Filters or []:
+            name, values = flt.get('Name'), flt.get('Values', [])
+            if name == 'state':
+                candidates = [image for image in candidates if image[4] in values]
+            elif name == 'creation-date':
+                candidates = [image for image in candidates if self._matches(image[3], values)]
+            elif name == 'tag:CreatedBy':
+                candidates = [image for image in candidates if image[7] and 'ami-automation' in values]
+            elif name == 'tag-key':
+                candidates = [
+                    image for image in candidates
+                    if any(tag['Key'] in values for tag in self._image_tags(image))
+                ]
+            elif name == 'block-device-mapping.snapshot-id':
+                wanted = set(values)
+                candidates = [image for image in candidates if wanted.intersection(image[5])]
+
+        return candidates
+
+    def describe_snapshots(self, Filters=None, OwnerIds=None, SnapshotIds=None, NextToken=None, **kwargs):
+        metadata = self._call('describe_snapshots')
+
+        def query():
+            missing = [snapshot_id for snapshot_id in SnapshotIds or [] if snapshot_id not in self.snapshots]
+            if missing:
+                raise ClientError(
+                    {'Error': {'Code': 'InvalidSnapshot.NotFound', 'Message': 'The snapshot %s does not exist' % missing}},
+                    'DescribeSnapshots'
+                )
+            snapshot_ids = SnapshotIds or list(self.snapshots)
+            for flt in Filters or []:
+                if flt.get('Name') == 'tag:CreatedBy':
+                    wanted = 'ami-automation' in flt['Values']
+                    snapshot_ids = [
+                        snapshot_id for snapshot_id in snapshot_ids
+                        if wanted and self.snapshots[snapshot_id][3]
+                    ]
+                elif flt.get('Name', '').startswith('tag:'):
+                    key = flt['Name'][4:]
+                    snapshot_ids = [
+                        snapshot_id for snapshot_id in snapshot_ids
+                        if any(tag['Key'] == key and tag['Value'] in flt['Values']
+                               for tag in self._snapshot_tags(snapshot_id))
+                    ]
+                elif flt.get('Name') == 'tag-key':
+                    snapshot_ids = [
+                        snapshot_id for snapshot_id in snapshot_ids
+                        if any(tag['Key'] in flt['Values'] for tag in self._snapshot_tags(snapshot_id))
+                    ]
+            return snapshot_ids
+
+        page = self._page(query, NextToken, 'Snapshots', metadata)
+        page['Snapshots'] = [self._snapshot_dict(snapshot_id) for snapshot_id in page['Snapshots']]
+        return page
+
+    def create_image(self, InstanceId, Name, TagSpecifications=None, **kwargs):
+        metadata = self._call('create_image')
+        created = datetime.datetime.utcnow()
+        tagged = any(spec['ResourceType'] == 'snapshot' for spec in TagSpecifications or [])
+        with self.lock:
+            image_id = self._add_image(
+                InstanceId, Name.split('_')[0], created,
+                'pending' if self.pending_seconds else 'available',
+                time.time() + self.pending_seconds * self.random.uniform(0.5, 1.5),
+                tag_snapshots=tagged
+            )
+            self.images[image_id][2] = Name
+            self.images[image_id][8] = [
+                tag for spec in TagSpecifications or [] if spec['ResourceType'] == 'image' for tag in spec['Tags']
+            ] or None
+        return {'ImageId': image_id, 'ResponseMetadata': metadata}
+
+    def create_snapshots(self, InstanceSpecification, TagSpecifications=None, **kwargs):
+        metadata = self._call('create_snapshots')
+        tags = [tag for spec in TagSpecifications or [] if spec['ResourceType'] == 'snapshot' for tag in spec['Tags']]
+        with self.lock:
+            snapshot_ids = self._add_snapshot_set(
+                InstanceSpecification['InstanceId'], None, datetime.datetime.utcnow(), tags,
+                InstanceSpecification.get('ExcludeBootVolume', False),
+                time.time() + self.pending_seconds * self.random.uniform(0.5, 1.5) if self.pending_seconds else 0
+            )
+        return {
+            'Snapshots': [{'SnapshotId': snapshot_id, 'State': 'pending'} for snapshot_id in snapshot_ids],
+            'ResponseMetadata': metadata
+        }
+
+    def create_tags(self, Resources, Tags, **kwargs):
+        return {'ResponseMetadata': self._call('create_tags')}
+
+    def deregister_image(self, ImageId, **kwargs):
+        metadata = self._call('deregister_image')
+        with self.lock:
+            if ImageId not in self.images:
+                raise ClientError(
+                    {'Error': {'Code': 'InvalidAMIID.Unavailable', 'Message': 'Image %s is not available' % ImageId}},
+                    'DeregisterImage'
+                )
+            self._remove_image(ImageId)
+        return {'ResponseMetadata': metadata}
+
+    def delete_snapshot(self, SnapshotId, **kwargs):
+        metadata = self._call('delete_snapshot')
+        with self.lock:
+            if SnapshotId not in self.snapshots:
+                raise ClientError(
+                    {'Error': {'Code': 'InvalidSnapshot.NotFound', 'Message': 'Snapshot %s does not exist' % SnapshotId}},
+                    'DeleteSnapshot'
+                )
+            if self.snapshots[SnapshotId][4]:
+                raise ClientError(
+                    {'Error': {'Code': 'InvalidSnapshot.InUse', 'Message': 'The snapshot %s is currently in use by %s' %
+                               (SnapshotId, self.snapshots[SnapshotId][4][0])}},
+                    'DeleteSnapshot'
+                )
+            del self.snapshots[SnapshotId]
+        return {'ResponseMetadata': metadata}
+
+
+class FakeSNS(FakeService):
+    """
+    Fake SNS client keeping published messages
+    """
+
+    def __init__(self, **kwargs):
+        super(FakeSNS, self).__init__(**kwargs)
+        self.messages = []
+
+    def publish(self, TopicArn, Message, Subject=None, **kwargs):
+        metadata = self._call('publish')
+        if len(Message.encode('utf-8')) > SNS_MAX_BYTES:
+            raise ClientError(
+                {'Error': {'Code': 'InvalidParameter', 'Message': 'Message too long'}},
+                'Publish'
+            )
+        with self.lock:
+            self.messages.append({'TopicArn': TopicArn, 'Subject': Subject, 'Message': Message})
+        return {'MessageId': str(len(self.messages)), 'ResponseMetadata': metadata}
+
+
+class FakeLambda(FakeService):
+    """
+    Fake lambda client queueing asynchronous invocations
+    """
+
+    def __init__(self, **kwargs):
+        super(FakeLambda, self).__init__(**kwargs)
+        self.invocations = []
+
+    def invoke(self, FunctionName, Payload, InvocationType='RequestResponse', **kwargs):
+        metadata = self._call('invoke')
+        if InvocationType == 'Event' and len(Payload.encode('utf-8')) > INVOKE_ASYNC_MAX_BYTES:
+            raise ClientError(
+                {'Error': {'Code': 'RequestEntityTooLargeException', 'Message': 'Request too large'}},
+                'Invoke'
+            )
+        with self.lock:
+            self.invocations.append((FunctionName, json.loads(Payload)))
+        return {'StatusCode': 202 if InvocationType == 'Event' else 200, 'ResponseMetadata': metadata}
+
+
+class FakeSTS(FakeService):
+    """
+    Fake STS client handing out credentials for any role, lasting at most max_seconds
+    """
+
+    def __init__(self, max_seconds=None, **kwargs):
+        super(FakeSTS, self).__init__(**kwargs)
+        self.max_seconds = max_seconds
+        self.assumed = {}
+
+    def assume_role(self, RoleArn, RoleSessionName, DurationSeconds=3600, **kwargs):
+        metadata = self._call('assume_role')
+        seconds = min(DurationSeconds, self.max_seconds or DurationSeconds)
+        with self.lock:
+            count = self.assumed[RoleArn] = self.assumed.get(RoleArn, 0) + 1
+        account_id = RoleArn.split(':')[4]
+        return {
+            'Credentials': {
+                'AccessKeyId': 'ASIA%s%04d' % (account_id, count),
+                'SecretAccessKey': 'fake-secret',
+                'SessionToken': 'fake-token',
+                'Expiration': datetime.datetime.now(tzutc()) + datetime.timedelta(seconds=seconds)
+            },
+            'AssumedRoleUser': {
+                'AssumedRoleId': 'AROAFAKE:%s' % (RoleSessionName),
+                'Arn': 'arn:aws:sts::%s:assumed-role/%s/%s' % (account_id, RoleArn.split('/')[-1], RoleSessionName)
+            },
+            'ResponseMetadata': metadata
+        }
+
+
+class FakeContext(object):
+    """
+    Lambda context object for a function given timeout_seconds from when it is created
+    """
+
+    def __init__(self, function_name, timeout_seconds):
+        self.function_name = function_name
+        self.deadline = time.time() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int(max(self.deadline - time.time(), 0) * 1000)
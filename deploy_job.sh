@@ -10,6 +10,8 @@
 #
 #  Note:
 #  - Lambda functions are region-specific, pushing job to us-east-1
+#  - Each function can process several regions per run (see REGIONS on ami_shared.py),
+#    in which case it only needs to be deployed to a single region
 #
 
 #  Constants
@@ -20,14 +22,20 @@ AWS_REGIONS=(
     'us-east-1'
 )
 
-ADDTL_ZIP_FILES="ami_shared.py"                         #  Include these file(s) in zip
+ADDTL_ZIP_FILES="ami_shared.py ami_catalog.py ami_create.py ami_prune.py ami_monitor.py"   #  Include these file(s) in zip
 ADDTL_ZIP_FOLDERS=""                                    #  Include these folder(s) in zip
 
 #  Function monikers match file names (no extension)
+#  An optional 3rd field splits the fleet into shards, one per run, e.g. to spread the
+#  create function's 4 hour window over 8 runs: 'ami-create-backups:30 minutes:8'
+#  Each shard gets a rule of its own, on a fixed (cron) slot, as long as the interval times
+#  the shards evenly divides an hour or a day
+#  (remove the old schedule rule(s) when changing an interval or shards, or both will fire)
 FUNCTION_INFO=(
     'ami-create-backups:4 hours'                        #  "Name of .py file" : "How often to run"
     'ami-prune-backups:6 hours'                         #  "Name of .py file" : "How often to run"
     'ami-monitor-backups:1 day'                         #  "Name of .py file" : "How often to run"
+#   'ami-reconcile-backups:4 hours'                     #  Or all three from one listing, in place of the above
 )
 
 DELETE_FILES=(
@@ -163,6 +171,71 @@ lambda () {
 }
 
 
+#  Cron expression running one shard of "interval" x "shards" on its own fixed slot, e.g. shard 3
+#  of "30 minutes" x 8 runs at 01:30, 05:30, ... (empty when the period can't be a fixed slot)
+shard_schedule () {
+    local count=$(echo ${1} | cut -d' ' -f1)
+    local unit=$(echo ${1} | cut -d' ' -f2)
+    local minutes
+    case "${unit}" in
+        minute|minutes) minutes=${count} ;;
+        hour|hours)     minutes=$(( count * 60 )) ;;
+        day|days)       minutes=$(( count * 1440 )) ;;
+        *)              return ;;
+    esac
+    local period=$(( minutes * ${2} ))
+    local offset=$(( minutes * ${3} ))
+    if (( period < 60 && 60 % period == 0 )); then
+        echo "cron(${offset}/${period} * * * ? *)"
+    elif (( period % 60 == 0 && 1440 % period == 0 )); then
+        echo "cron($(( offset % 60 )) $(( offset / 60 ))/$(( period / 60 )) * * ? *)"
+    fi
+}
+
+
+#  Set (create or update) a schedule rule invoking the current function (per region), with its target + permission
+schedule_rule () {
+    local rule_name=${1}
+    local expression=${2}
+    local input=${3}
+
+    echo "SCHEDULE: Setting rule [${rule_name}] (${expression}) for [${function_name}] function in [${region}]"
+    rule_arn=$(aws events put-rule                                                  \
+                    --name ${rule_name}                                             \
+                    --schedule-expression "${expression}"                           \
+                    --region ${region}                                              \
+                    --output text                                                   \
+    )
+
+    #  Set (create or update) rule target (per region)
+    echo "SCHEDULE: Setting target for [${rule_name}] in [${region}]"
+    x=$(aws events put-targets                                                                                  \
+            --rule ${rule_name}                                                                                 \
+            --targets "Id=${function_name},Arn=${function_arn},Input='${input}'"                                \
+            --region ${region}                                                                                  \
+    )
+
+    #  Check if function permission already exists
+    chk_func_perm=$(echo $function_policy_json | jq '.Statement[] | select(.Sid=="'${rule_name}'-rule")')
+    if [[ -z "${chk_func_perm}" ]]; then
+        #  Grant rule permission to invoke lambda function (per region)
+        #
+        #  Note: "statement-id" is the permission's unique identifier - use it when removing it via "lambda remove-permission" call
+        echo "SCHEDULE: Granting [${rule_name}] permission to invoke [${function_name}] function in [${region}]"
+        y=$(aws lambda add-permission                                               \
+                --function-name ${function_name}                                    \
+                --statement-id ${rule_name}-rule                                    \
+                --action 'lambda:InvokeFunction'                                    \
+                --principal events.amazonaws.com                                    \
+                --source-arn ${rule_arn}                                            \
+                --region ${region}                                                  \
+        )
+    else
+        echo "SCHEDULE: Rule [${rule_name}] has already permission to invoke [${function_name}] function in [${region}]"
+    fi
+}
+
+
 #  EVENT SCHEDULING
 schedule () {
     echo "SCHEDULE: Tasks [BEGIN]"
@@ -194,47 +267,31 @@ schedule () {
             for key in "${FUNCTION_INFO[@]}"; do
                 func_name=$(echo ${key} | cut -d':' -f1)
                 interval=$( echo ${key} | cut -d':' -f2)
+                shards=$(   echo ${key} | cut -s -d':' -f3)
 
                 #  Use sanitized interval for rule name
                 interval_title=$(echo ${interval} | gsed -e 's/[^a-zA-Z0-9]/\-/g')
 
                 #  If current function matches current function-interval
                 if [[ "${func_name}" == "${function_name}" ]]; then
-                    #  Set (create or update) rule per interval (per region)
-                    echo "SCHEDULE: Setting rule for [${function_name} @ ${interval_title}] function in [${region}]"
-                    rule_arn=$(aws events put-rule                                                  \
-                                    --name ${function_name}-schedule-${interval_title}              \
-                                    --schedule-expression "rate(${interval})"                       \
-                                    --region ${region}                                              \
-                                    --output text                                                   \
-                    )
-
-                    #  Set (create or update) rule target per interval (per region)
-                    echo "SCHEDULE: Setting target for [${function_name} @ ${interval}] function in [${region}]"
-                    x=$(aws events put-targets                                                                                  \
-                            --rule ${function_name}-schedule-${interval_title}                                                  \
-                            --targets "Id=${function_name},Arn=${function_arn},Input='{ \"interval\": \"${interval}\"  }'"      \
-                            --region ${region}                                                                                  \
-                    )
-
-                    #  Check if function permission already exists
-                    chk_func_perm=$(echo $function_policy_json | jq '.Statement[] | select(.Sid=="'${function_name}'-schedule-'${interval_title}'-rule")')
-                    if [[ -z "${chk_func_perm}" ]]; then
-                        #  Grant rule permission to invoke lambda function per interval (per region)
-                        #
-                        #  Note: "statement-id" is the permission's unique identifier - use it when removing it via "lambda remove-permission" call
-                        echo "SCHEDULE: Granting rule permission to invoke [${function_name} @ ${interval}] function in [${region}]"
-                        y=$(aws lambda add-permission                                               \
-                                --function-name ${function_name}                                    \
-                                --statement-id ${function_name}-schedule-${interval_title}-rule     \
-                                --action 'lambda:InvokeFunction'                                    \
-                                --principal events.amazonaws.com                                    \
-                                --source-arn ${rule_arn}                                            \
-                                --region ${region}                                                  \
-                        )
-                    else
-                        echo "SCHEDULE: Rule has already permission to invoke [${function_name} @ ${interval}] function in [${region}]"
+                    if [[ -z "${shards}" ]]; then
+                        schedule_rule "${function_name}-schedule-${interval_title}" "rate(${interval})" \
+                                      "{ \"interval\": \"${interval}\" }"
+                        continue
                     fi
+
+                    #  One rule per shard, telling each run which shard it covers
+                    for (( shard=0; shard<${shards}; shard++ )); do
+                        expression=$(shard_schedule "${interval}" ${shards} ${shard})
+                        if [[ -z "${expression}" ]]; then
+                            echo "SCHEDULE: WARNING [${interval}] x ${shards} shards fits no fixed slot, [${function_name}] picks its shard from the time of each run"
+                            schedule_rule "${function_name}-schedule-${interval_title}" "rate(${interval})" \
+                                          "{ \"interval\": \"${interval}\", \"shards\": ${shards} }"
+                            break
+                        fi
+                        schedule_rule "${function_name}-schedule-${interval_title}-shard-${shard}" "${expression}" \
+                                      "{ \"interval\": \"${interval}\", \"shards\": ${shards}, \"shard\": ${shard} }"
+                    done
                 fi
             done
         done
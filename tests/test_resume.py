@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+"""
+ Unit tests for stopping work before the lambda timeout
+
+    python -m pytest tests
+"""
+
+#  General libraries
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from ami_shared import run_parallel
+
+
+def test_run_parallel_takes_one_item_per_worker_when_out_of_time():
+    """
+    A call starting past the deadline still gets a batch done, in order
+    """
+    done = []
+    finished = run_parallel(func=done.append, items=range(100), workers=4, stop=lambda: True)
+    assert not finished
+    assert sorted(done) == [0, 1, 2, 3]
+
+
+def test_run_parallel_stops_once_asked():
+    """
+    Items are taken on in order until stop() says so
+    """
+    done = []
+    finished = run_parallel(func=done.append, items=range(100), workers=2, stop=lambda: len(done) >= 10)
+    assert not finished
+    assert sorted(done) == list(range(len(done)))
+    assert 10 <= len(done) < 100
+
+
+def test_run_parallel_finishes():
+    done = []
+    assert run_parallel(func=done.append, items=range(50), workers=3, stop=lambda: False)
+    assert sorted(done) == list(range(50))
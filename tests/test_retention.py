@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+"""
+ Unit tests for the logic deciding which AMIs and snapshots are deleted
+
+    python -m pytest tests
+"""
+
+#  General libraries
+import calendar
+import datetime
+import fnmatch
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ami_shared
+from ami_shared import BackupPolicy, RunContext, UTC, date_prefixes, retention_deletes, retention_plan
+from ami_prune import SnapshotRefs
+
+#  Every backup for 2 days, daily for 2 weeks, weekly for 90 days
+GFS_TIERS = [(2, 0), (14, 24), (90, 24 * 7)]
+
+START = datetime.datetime(2026, 1, 1, tzinfo=UTC)
+
+
+def ami(image_id, create_dt, instance_id='i-1', snapshot_ids=()):
+    """
+    Minimal image entry, as retention_plan + SnapshotRefs use them
+    """
+    return {
+        'image_id': image_id,
+        'image_create_dt': create_dt,
+        'instance_id': instance_id,
+        'snapshot_ids': list(snapshot_ids)
+    }
+
+
+def age_days(now, entry):
+    return (now - entry['image_create_dt']).total_seconds() / 86400.0
+
+
+def bucket(entry, every_hours):
+    return calendar.timegm(entry['image_create_dt'].utctimetuple()) // (every_hours * 3600)
+
+
+def run_at(now):
+    run = RunContext({'regions': ['us-east-1']})
+    run.today = now
+    return run
+
+
+def test_gfs_steady_state():
+    """
+    Backups every 4 hours, pruned on every run, settle into the same shape
+    """
+    amis = []
+    counts = []
+    for i in range(6 * 130):
+        now = START + datetime.timedelta(hours=4 * i)
+        amis.insert(0, ami('ami-%d' % (i), now))
+        keep, delete = retention_plan(now, amis, GFS_TIERS)
+
+        #  Every AMI lands in exactly one list, and the kept ones stay newest first
+        assert len(keep) + len(delete) == len(amis)
+        assert keep == sorted(keep, key=lambda k: k['image_create_dt'], reverse=True)
+
+        #  Planning again straight after pruning deletes nothing more
+        assert retention_plan(now, keep, GFS_TIERS)[1] == []
+
+        amis = keep
+        counts.append(len(keep))
+
+        if i < 6 * 91:
+            continue
+
+        #  Nothing past the last tier, every backup of the first tier
+        assert all(age_days(now, entry) <= 90 for entry in keep)
+        assert len([entry for entry in keep if age_days(now, entry) <= 2]) == 13
+
+        #  One per day, then one per week
+        daily = [bucket(entry, 24) for entry in keep if 2 < age_days(now, entry) <= 14]
+        weekly = [bucket(entry, 24 * 7) for entry in keep if 14 < age_days(now, entry)]
+        assert len(daily) == len(set(daily))
+        assert len(weekly) == len(set(weekly))
+        assert 12 <= len(daily) <= 13
+        assert 11 <= len(weekly) <= 12
+
+    #  Steady state: the number kept only moves with where the run falls in the week
+    assert min(counts[6 * 91:]) == 36
+    assert max(counts[6 * 91:]) == 38
+
+
+def test_tier_boundaries():
+    """
+    An AMI exactly as old as a tier still belongs to it
+    """
+    now = START + datetime.timedelta(days=200)
+    second = datetime.timedelta(seconds=1)
+    amis = [
+        ami('ami-keep-all-edge', now - datetime.timedelta(days=2)),
+        ami('ami-daily-first', now - datetime.timedelta(days=2) - second),
+        ami('ami-daily-same-day', now - datetime.timedelta(days=2) - 2 * second),
+        ami('ami-horizon-edge', now - datetime.timedelta(days=90)),
+        ami('ami-past-horizon', now - datetime.timedelta(days=90) - second)
+    ]
+    keep, delete = retention_plan(now, amis, GFS_TIERS)
+    assert [entry['image_id'] for entry in keep] == ['ami-keep-all-edge', 'ami-daily-first', 'ami-horizon-edge']
+    assert [entry['image_id'] for entry in delete] == ['ami-daily-same-day', 'ami-past-horizon']
+
+
+def test_tier_boundaries_plain_retention():
+    """
+    Without tiers, everything up to RETENTION_DAYS old is kept
+    """
+    now = START
+    days = datetime.timedelta(days=ami_shared.RETENTION_DAYS)
+    amis = [
+        ami('ami-newest', now),
+        ami('ami-edge', now - days),
+        ami('ami-expired', now - days - datetime.timedelta(milliseconds=1))
+    ]
+    keep, delete = retention_plan(now, amis, [(ami_shared.RETENTION_DAYS, 0)])
+    assert [entry['image_id'] for entry in keep] == ['ami-newest', 'ami-edge']
+    assert [entry['image_id'] for entry in delete] == ['ami-expired']
+
+
+def test_policy_keep_shorter_and_longer_than_default():
+    """
+    Instances with their own "keep" are pruned by it, the rest by the default tiers
+    """
+    now = START + datetime.timedelta(days=100)
+    images = [
+        ami('ami-%s-%d' % (instance_id, days), now - datetime.timedelta(days=days, hours=1), instance_id)
+        for instance_id in ('i-default', 'i-short', 'i-long')
+        for days in range(40)
+    ]
+    policies = {
+        'i-short': BackupPolicy(keep_days=3),
+        'i-long': BackupPolicy(keep_days=30)
+    }
+
+    deletes = retention_deletes(run_at(now), 'us-east-1', images, policies)
+
+    oldest_kept = {'i-default': ami_shared.RETENTION_DAYS, 'i-short': 3, 'i-long': 30}
+    for instance_id, keep_days in oldest_kept.items():
+        deleted = sorted(
+            int(age_days(now, entry)) for entry in deletes if entry['instance_id'] == instance_id
+        )
+        assert deleted == list(range(keep_days, 40))
+
+
+def covered_days(prefixes, first_day, last_day):
+    """
+    Days between two dates each wildcard matches (as EC2 would match "creation-date")
+    """
+    matches = {}
+    day = first_day
+    while day <= last_day:
+        stamp = day.strftime('%Y-%m-%dT12:00:00.000Z')
+        matches[day] = [prefix for prefix in prefixes if fnmatch.fnmatchcase(stamp, prefix)]
+        day += datetime.timedelta(days=1)
+    return matches
+
+
+def test_date_prefixes_collapse():
+    """
+    Whole years and months collapse into one wildcard
+    """
+    day = datetime.date
+    assert date_prefixes(day(2024, 1, 1), day(2024, 12, 31)) == ['2024-*']
+    assert date_prefixes(day(2024, 2, 1), day(2024, 2, 29)) == ['2024-02-*']
+    assert date_prefixes(day(2023, 2, 1), day(2023, 2, 27)) == ['2023-02-01*'] + [
+        '2023-02-%02d*' % (d) for d in range(2, 28)
+    ]
+    assert date_prefixes(day(2023, 12, 1), day(2024, 1, 1)) == ['2023-12-*', '2024-01-01*']
+    assert date_prefixes(day(2024, 1, 30), day(2024, 3, 2)) == [
+        '2024-01-30*', '2024-01-31*', '2024-02-*', '2024-03-01*', '2024-03-02*'
+    ]
+    assert date_prefixes(day(2006, 1, 1), day(2026, 10, 17)) == (
+        ['%d-*' % (year) for year in range(2006, 2026)] +
+        ['2026-%02d-*' % (month) for month in range(1, 10)] +
+        ['2026-10-%02d*' % (d) for d in range(1, 18)]
+    )
+
+
+def test_date_prefixes_boundary_days():
+    """
+    Single days, empty ranges, and every day in a range matched exactly once
+    """
+    day = datetime.date
+    assert date_prefixes(day(2024, 12, 31), day(2024, 12, 31)) == ['2024-12-31*']
+    assert date_prefixes(day(2024, 1, 1), day(2024, 1, 1)) == ['2024-01-01*']
+    assert date_prefixes(day(2024, 3, 2), day(2024, 3, 1)) == []
+
+    for first_day, last_day in [
+        (day(2023, 11, 15), day(2025, 2, 3)),
+        (day(2024, 2, 28), day(2024, 3, 1)),
+        (day(2023, 12, 31), day(2024, 12, 30)),
+        (day(2022, 1, 1), day(2023, 12, 31))
+    ]:
+        prefixes = date_prefixes(first_day, last_day)
+        around = covered_days(
+            prefixes, first_day - datetime.timedelta(days=40), last_day + datetime.timedelta(days=40))
+        for d, matched in around.items():
+            assert len(matched) == (1 if first_day <= d <= last_day else 0), (d, matched)
+
+
+def test_shared_snapshot_kept_until_last_user_is_gone():
+    """
+    A snapshot is only released once every AMI using it is deregistered
+    """
+    images = [
+        ami('ami-a', START, snapshot_ids=['snap-a', 'snap-shared']),
+        ami('ami-b', START, snapshot_ids=['snap-shared'])
+    ]
+    refs = SnapshotRefs('us-east-1', images, referenced={})
+
+    assert refs.release('ami-a', ['snap-a', 'snap-shared']) == ['snap-a']
+    assert refs.in_use() == ['snap-shared']
+    assert refs.release('ami-b', ['snap-shared']) == ['snap-shared']
+    assert refs.in_use() == []
+
+
+def test_snapshot_used_by_ami_not_being_pruned():
+    """
+    A snapshot another (kept) AMI uses is never released
+    """
+    images = [ami('ami-a', START, snapshot_ids=['snap-a', 'snap-shared'])]
+    refs = SnapshotRefs('us-east-1', images, referenced={'snap-shared': {'ami-copy'}})
+
+    assert refs.release('ami-a', ['snap-a', 'snap-shared']) == ['snap-a']
+    assert refs.in_use() == ['snap-shared']